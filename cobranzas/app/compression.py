@@ -0,0 +1,48 @@
+import gzip
+import zlib
+
+import brotli
+
+
+GZIP = 'gzip'
+BROTLI = 'br'
+# Supported encodings, from the most to the least preferred
+ENCODINGS = (BROTLI, GZIP)
+
+# Content types worth compressing, images and fonts are already compressed
+COMPRESSIBLE_TYPES = ('text/', 'application/json', 'application/javascript', 'application/xml', 'image/svg+xml')
+COMPRESSIBLE_SUFFIXES = ('+json', '+xml')
+
+
+def is_compressible(content_type):
+    content_type = content_type.split(';')[0].strip().lower()
+    return content_type.startswith(COMPRESSIBLE_TYPES) or content_type.endswith(COMPRESSIBLE_SUFFIXES)
+
+
+def compress(content, encoding, best=False):
+    '''
+    Compress "content" (bytes) with the encoding. The best compression is slow, and it's only
+    used for files compressed once (static files), not for responses
+    '''
+    if encoding == BROTLI:
+        return brotli.compress(content, quality=11 if best else 5)
+    return gzip.compress(content, compresslevel=9 if best else 6, mtime=0)
+
+
+def compress_sequence(sequence, encoding):
+    '''Compress an iterable of bytes (the content of a streaming response) chunk by chunk'''
+    if encoding == BROTLI:
+        compressor = brotli.Compressor(quality=5)
+        for item in sequence:
+            data = compressor.process(item)
+            if data:
+                yield data
+        yield compressor.finish()
+    else:
+        # Same output as gzip.compress(), flushing each chunk so it can be sent at once
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        for item in sequence:
+            data = compressor.compress(item) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            if data:
+                yield data
+        yield compressor.flush()
@@ -62,10 +62,11 @@ class SaleCreationForm(forms.ModelForm):
     price = forms.FloatField(widget=forms.NumberInput(attrs={'readonly': True}), label=_('Price'))
     collector = UserModelChoiceField(queryset=User.objects.order_by('first_name', 'last_name'), required=False, label=_('Collector'))
     remarks = forms.CharField(required=False, label=_('Remarks'))
+    payment_frequency = forms.ChoiceField(choices=Sale.PAYMENT_FREQUENCY, initial=Sale.MONTHLY, required=False, label=_('Payment Frequency'))
 
     class Meta:
         model = Sale
-        fields = ['sale_date', 'customer', 'collector', 'price', 'installment_amount', 'installments', 'uncollectible', 'remarks']
+        fields = ['sale_date', 'customer', 'collector', 'price', 'installment_amount', 'installments', 'payment_frequency', 'uncollectible', 'remarks']
 
     def clean_sale_date(self):
         sale_date = self.cleaned_data['sale_date']
@@ -77,6 +78,10 @@ class SaleCreationForm(forms.ModelForm):
 
         return sale_date
 
+    def clean_payment_frequency(self):
+        # Sales keep their payment frequency if it's not sent
+        return self.cleaned_data['payment_frequency'] or self.instance.payment_frequency
+
 
 class SaleWithPaymentsUpdateForm(forms.ModelForm):
     sale_date = forms.DateField(required=True, input_formats=('%Y-%m-%d',), widget=forms.DateInput(format='%Y-%m-%d', attrs={'type': 'date'}), label=_('Sale Date'))
@@ -86,10 +91,11 @@ class SaleWithPaymentsUpdateForm(forms.ModelForm):
     installment_amount = forms.FloatField(disabled=True, label=_('Installment Amount'))
     installments = forms.IntegerField(disabled=True, label=_('Installments'))
     remarks = forms.CharField(required=False, label=_('Remarks'))
+    payment_frequency = forms.ChoiceField(choices=Sale.PAYMENT_FREQUENCY, initial=Sale.MONTHLY, required=False, label=_('Payment Frequency'))
 
     class Meta:
         model = Sale
-        fields = ['sale_date', 'customer', 'collector', 'price', 'installment_amount', 'installments', 'uncollectible', 'remarks']
+        fields = ['sale_date', 'customer', 'collector', 'price', 'installment_amount', 'installments', 'payment_frequency', 'uncollectible', 'remarks']
 
     def clean_sale_date(self):
         sale_date = self.cleaned_data['sale_date']
@@ -101,6 +107,10 @@ class SaleWithPaymentsUpdateForm(forms.ModelForm):
 
         return sale_date
 
+    def clean_payment_frequency(self):
+        # Sales keep their payment frequency if it's not sent
+        return self.cleaned_data['payment_frequency'] or self.instance.payment_frequency
+
 
 class SaleProductCreationForm(forms.ModelForm):
     product = forms.ModelChoiceField(queryset=Product.objects.exclude(id=0), widget=forms.Select(attrs={'data-dselect-search': 'true', 'data-dselect-max-height': '360px'}), required=False, label=_('Product'))
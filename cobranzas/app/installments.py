@@ -0,0 +1,66 @@
+'''
+Installment plans of the sales, used by the sale signals, the sale views and the preview of the
+plan in the sale forms (create-sale.js), so all of them split the price in the same way.
+Amounts are calculated in cents, as integers, to avoid the rounding errors of floats.
+'''
+
+# If the price is not a multiple of the installment amount, the rest is paid in one more
+# installment, unless it's up to 60% of an installment: then it's added to the last installment
+# to prevent a last installment too small (percentage of an installment)
+REMAINDER_LIMIT = 60
+# Maximum number of installments of a sale, weekly installments for more than four years
+MAX_INSTALLMENTS = 240
+
+
+def to_cents(amount):
+    return round(amount * 100)
+
+
+def from_cents(cents):
+    return cents / 100
+
+
+def get_installments(price, installment_amount):
+    '''Number of installments to pay "price" in installments of "installment_amount" (in cents)'''
+    if price <= 0 or installment_amount <= 0:
+        raise ValueError('The price and the installment amount must be greater than zero')
+
+    installments, remainder = divmod(price, installment_amount)
+    if remainder and (installments == 0 or remainder * 100 > installment_amount * REMAINDER_LIMIT):
+        installments += 1
+    return installments
+
+
+def get_installment_amount(price, installments):
+    '''Amount (in cents) of each installment to pay "price" (in cents) in "installments"'''
+    if price <= 0 or installments <= 0:
+        raise ValueError('The price and the installments must be greater than zero')
+    # Rounded half up
+    return (2 * price + installments) // (2 * installments)
+
+
+def get_plan(price, installment_amount, installments=None):
+    '''
+    Return the amount (in cents) of each installment: "installments" - 1 installments of
+    "installment_amount" and a last installment with the rest of the price. The number of
+    installments is calculated from the price and the installment amount if it's None.
+    '''
+    if installments is None:
+        installments = get_installments(price, installment_amount)
+    fixed = installments - 1
+    return [installment_amount] * fixed + [price - fixed * installment_amount]
+
+
+def get_scheme(plan):
+    '''
+    Summary of a plan, as shown in the sale forms: a list of dictionaries with the number of
+    installments and the amount (in cents) of each group of consecutive installments with the
+    same amount
+    '''
+    scheme = []
+    for amount in plan:
+        if scheme and scheme[-1]['installment_amount'] == amount:
+            scheme[-1]['installments'] += 1
+        else:
+            scheme.append({'installments': 1, 'installment_amount': amount})
+    return scheme
@@ -0,0 +1,30 @@
+import random
+import timeit
+
+from django.core.management.base import BaseCommand
+
+from app.installments import get_plan
+
+
+class Command(BaseCommand):
+    help = 'Measure the time to calculate the installment plans of many sales, as when sales are imported'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sales', type=int, default=100000, help='Number of plans calculated in each run')
+        parser.add_argument('--repeat', type=int, default=5, help='Number of runs, the best one is reported')
+
+    def handle(self, *args, **options):
+        sales = options['sales']
+        # Random prices (in cents) with 1 to 24 installments
+        rng = random.Random(0)
+        prices = [rng.randint(1000, 10_000_000) for _ in range(sales)]
+        sales_data = [(price, max(price // rng.randint(1, 24), 1)) for price in prices]
+
+        def run():
+            for price, installment_amount in sales_data:
+                get_plan(price, installment_amount)
+
+        best = min(timeit.repeat(run, number=1, repeat=options['repeat']))
+        self.stdout.write(self.style.SUCCESS(
+            f'{sales} plans in {best:.3f} seconds ({sales / best:,.0f} plans per second)'
+        ))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from app.models import SyncTombstone
+
+
+class Command(BaseCommand):
+    help = 'Delete the synchronization tombstones older than SyncTombstone.RETENTION, it must run every night'
+
+    def handle(self, *args, **options):
+        deleted = SyncTombstone.prune()
+        self.stdout.write(self.style.SUCCESS(f'{deleted} tombstones deleted'))
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from app.models import CustomerBalance
+
+
+class Command(BaseCommand):
+    help = 'Recalculate the receivables of the customers, read by the pending balance report, from their pending sales'
+
+    def add_arguments(self, parser):
+        parser.add_argument('customers', nargs='*', type=int, help='IDs of the customers to rebuild (all the customers by default)')
+
+    def handle(self, *args, **options):
+        customers = options['customers'] or None
+        updated = CustomerBalance.update_balances(customers)
+        self.stdout.write(self.style.SUCCESS(f'{updated} customers with pending balance'))
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from app.models import SaleAging
+
+
+class Command(BaseCommand):
+    help = 'Recalculate the aging of the pending sales, read by the defaulters report, from their installments and payments'
+
+    def add_arguments(self, parser):
+        parser.add_argument('sales', nargs='*', type=int, help='IDs of the sales to rebuild (all the sales by default)')
+
+    def handle(self, *args, **options):
+        sales = options['sales'] or None
+        updated = SaleAging.update_sales(sales)
+        self.stdout.write(self.style.SUCCESS(f'{updated} pending sales updated'))
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from app.models import Sale
+
+
+class Command(BaseCommand):
+    help = 'Recalculate the paid amount and pending balance stored in the sales from their installments'
+
+    def add_arguments(self, parser):
+        parser.add_argument('sales', nargs='*', type=int, help='IDs of the sales to rebuild (all the sales by default)')
+
+    def handle(self, *args, **options):
+        sales = options['sales'] or None
+        updated = Sale.update_balances(sales)
+        self.stdout.write(self.style.SUCCESS(f'{updated} sales updated'))
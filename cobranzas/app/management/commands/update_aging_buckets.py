@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from app.models import SaleAging
+
+
+class Command(BaseCommand):
+    help = 'Move the pending sales to the bucket of days late they reached, it must run every night'
+
+    def handle(self, *args, **options):
+        moved = SaleAging.update_buckets()
+        self.stdout.write(self.style.SUCCESS(f'{moved} sales moved to a new bucket'))
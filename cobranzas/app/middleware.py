@@ -0,0 +1,60 @@
+from django.conf import settings
+from django.utils.cache import patch_vary_headers
+from django.utils.deprecation import MiddlewareMixin
+
+from app.compression import ENCODINGS, compress, compress_sequence, is_compressible
+
+
+class CompressionMiddleware(MiddlewareMixin):
+    '''
+    Compress responses with brotli or gzip, depending on the encodings accepted by the browser. Like django.middleware.gzip.GZipMiddleware, but also with brotli and only for
+    JSON/HTML/text responses bigger than COMPRESSION_MIN_SIZE.
+    '''
+
+    def get_encoding(self, request):
+        accepted = {}
+        for item in request.META.get('HTTP_ACCEPT_ENCODING', '').split(','):
+            encoding, _, params = item.strip().partition(';')
+            quality = 1.0
+            if params.strip().startswith('q='):
+                try:
+                    quality = float(params.strip()[2:])
+                except ValueError:
+                    pass
+            accepted[encoding.strip().lower()] = quality
+
+        for encoding in ENCODINGS:
+            if accepted.get(encoding, 0) > 0:
+                return encoding
+        return None
+
+    def process_response(self, request, response):
+        # Already compressed, or not worth compressing
+        if response.has_header('Content-Encoding') or not is_compressible(response.get('Content-Type', '')):
+            return response
+        if not response.streaming and len(response.content) < settings.COMPRESSION_MIN_SIZE:
+            return response
+
+        patch_vary_headers(response, ('Accept-Encoding',))
+
+        encoding = self.get_encoding(request)
+        if encoding is None:
+            return response
+
+        if response.streaming:
+            response.streaming_content = compress_sequence(response.streaming_content, encoding)
+            del response.headers['Content-Length']
+        else:
+            compressed_content = compress(response.content, encoding)
+            if len(compressed_content) >= len(response.content):
+                return response
+            response.content = compressed_content
+            response.headers['Content-Length'] = str(len(response.content))
+
+        # The compressed content is not byte by byte the same, so the ETag becomes weak
+        etag = response.get('ETag')
+        if etag and etag.startswith('"'):
+            response.headers['ETag'] = 'W/' + etag
+        response.headers['Content-Encoding'] = encoding
+
+        return response
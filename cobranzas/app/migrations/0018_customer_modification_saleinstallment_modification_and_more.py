@@ -0,0 +1,28 @@
+# Generated by Django 4.0.5 on 2026-10-18 09:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0017_alter_sale_sale_date'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customer',
+            name='modification',
+            field=models.DateTimeField(auto_now=True, db_index=True, verbose_name='Modification Date'),
+        ),
+        migrations.AddField(
+            model_name='saleinstallment',
+            name='modification',
+            field=models.DateTimeField(auto_now=True, db_index=True, verbose_name='Modification Date'),
+        ),
+        migrations.AlterField(
+            model_name='sale',
+            name='modification',
+            field=models.DateTimeField(auto_now=True, db_index=True, verbose_name='Modification Date'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 4.0.5 on 2026-10-18 09:26
+
+from django.db import migrations, models
+from django.db.models import F, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+
+def calculate_balances(apps, schema_editor):
+    Sale = apps.get_model('app', 'Sale')
+    SaleInstallment = apps.get_model('app', 'SaleInstallment')
+    paid = SaleInstallment.objects.filter(sale=OuterRef('pk')).values('sale').annotate(paid=Sum('paid_amount')).values('paid')
+    paid_amount = Coalesce(Subquery(paid), 0.0, output_field=models.FloatField())
+    Sale.objects.update(paid_amount=paid_amount, pending_balance=F('price') - paid_amount)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0018_customer_modification_saleinstallment_modification_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sale',
+            name='paid_amount',
+            field=models.FloatField(default=0.0, verbose_name='Paid Amount'),
+        ),
+        migrations.AddField(
+            model_name='sale',
+            name='pending_balance',
+            field=models.FloatField(default=0.0, verbose_name='Pending Balance'),
+        ),
+        migrations.RunPython(calculate_balances, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.0.5 on 2026-10-18 09:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0019_sale_paid_amount_sale_pending_balance'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='keyvaluestore',
+            name='key',
+            field=models.CharField(db_index=True, max_length=50),
+        ),
+    ]
@@ -0,0 +1,78 @@
+# Generated by Django 4.0.5 on 2026-10-18 10:40
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, F, Q, Subquery, Sum
+import django.db.models.deletion
+
+
+def calculate_balances(apps, schema_editor):
+    # Same rows as CustomerBalance.update_balances, copied because migrations use the historical
+    # models and must not change when the model code does
+    Sale = apps.get_model('app', 'Sale')
+    CustomerBalance = apps.get_model('app', 'CustomerBalance')
+    pending_sales = Sale.objects.\
+        filter(uncollectible=False).\
+        annotate(paid_installments=Count('saleinstallment__pk', filter=Q(saleinstallment__status='PAID'))).\
+        exclude(installments__lte=F('paid_installments'))
+    rows = Sale.objects.\
+        filter(pk__in=Subquery(pending_sales.values('pk'))).\
+        values('customer', 'customer__city', 'customer__collector', 'collector').\
+        annotate(sales=Count('pk'), price=Sum('price'), paid_amount=Sum('paid_amount')).\
+        order_by()
+    balances = {}
+    for row in rows:
+        sale_collectors = [None]
+        if row['collector'] not in (None, row['customer__collector']):
+            sale_collectors.append(row['collector'])
+        for sale_collector in sale_collectors:
+            balance = balances.get((row['customer'], sale_collector))
+            if balance is None:
+                balance = balances[(row['customer'], sale_collector)] = CustomerBalance(
+                    customer_id=row['customer'],
+                    city=row['customer__city'],
+                    collector_id=row['customer__collector'],
+                    sale_collector_id=sale_collector,
+                )
+            balance.sales += row['sales']
+            balance.price += row['price']
+            balance.paid_amount += row['paid_amount']
+            balance.pending_balance = balance.price - balance.paid_amount
+    CustomerBalance.objects.bulk_create(balances.values(), batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0020_alter_keyvaluestore_key'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CustomerBalance',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('city', models.CharField(choices=[('ARR', 'Arrecifes'), ('SAR', 'Capitan Sarmiento'), ('DUG', 'Duggan'), ('LUI', 'La Luisa'), ('SAL', 'Salto'), ('VLI', 'Villa Lía')], db_index=True, max_length=50, verbose_name='City')),
+                ('sales', models.PositiveIntegerField(default=0, verbose_name='Sales')),
+                ('price', models.FloatField(default=0.0, verbose_name='Price')),
+                ('paid_amount', models.FloatField(default=0.0, verbose_name='Paid Amount')),
+                ('pending_balance', models.FloatField(default=0.0, verbose_name='Pending Balance')),
+                ('collector', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL, verbose_name='Collector')),
+                ('customer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='app.customer', verbose_name='Customer')),
+                ('sale_collector', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='Sale Collector')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='customerbalance',
+            index=models.Index(fields=['-pending_balance', 'customer'], name='app_customerbalance_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='customerbalance',
+            constraint=models.UniqueConstraint(condition=models.Q(('sale_collector__isnull', True)), fields=('customer',), name='unique_customer_balance'),
+        ),
+        migrations.AddConstraint(
+            model_name='customerbalance',
+            constraint=models.UniqueConstraint(fields=('customer', 'sale_collector'), name='unique_customer_sale_collector_balance'),
+        ),
+        migrations.RunPython(calculate_balances, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,63 @@
+# Generated by Django 4.0.5 on 2026-10-18 10:44
+
+from django.db import migrations, models
+from django.db.models import Count, F, Max, Q
+from django.utils import timezone
+import django.db.models.deletion
+
+
+def calculate_aging(apps, schema_editor):
+    # Same rows as SaleAging.update_sales, and buckets as SaleAging.get_qualification, copied
+    # because migrations use the historical models and must not change when the model code does
+    Sale = apps.get_model('app', 'Sale')
+    SaleAging = apps.get_model('app', 'SaleAging')
+    rows = Sale.objects.\
+        filter(uncollectible=False).\
+        values('id', 'customer', 'sale_date').\
+        annotate(paid_installments=Count('saleinstallment__pk', filter=Q(saleinstallment__status='PAID'), distinct=True)).\
+        annotate(pending_installments=Count('saleinstallment__pk', filter=~Q(saleinstallment__status='PAID'), distinct=True)).\
+        exclude(installments__lte=F('paid_installments')).\
+        annotate(last_payment_date=Max('saleinstallment__collectioninstallment__collection__date')).\
+        order_by()
+    now = timezone.now()
+    agings = []
+    for row in rows:
+        since = row['last_payment_date'] or row['sale_date']
+        debt_days = (now - since).days
+        qualification = next((bucket for bucket in (30, 15, 7) if debt_days > bucket), 0)
+        agings.append(SaleAging(
+            sale_id=row['id'],
+            customer_id=row['customer'],
+            pending_installments=row['pending_installments'],
+            last_payment_date=row['last_payment_date'],
+            since=since,
+            qualification=qualification,
+        ))
+    SaleAging.objects.bulk_create(agings)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0021_customerbalance'),
+        ('collection', '0010_collectiondeliverybatch_collectiondelivery_batch'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SaleAging',
+            fields=[
+                ('sale', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to='app.sale', verbose_name='Sale')),
+                ('pending_installments', models.PositiveIntegerField(default=0, verbose_name='Pending Installments')),
+                ('last_payment_date', models.DateTimeField(blank=True, null=True, verbose_name='Last Payment Date')),
+                ('since', models.DateTimeField(verbose_name='Debt Date')),
+                ('qualification', models.PositiveSmallIntegerField(default=0, verbose_name='Qualification')),
+                ('customer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='app.customer', verbose_name='Customer')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='saleaging',
+            index=models.Index(fields=['-qualification', 'since', 'sale'], name='app_saleaging_bucket_idx'),
+        ),
+        migrations.RunPython(calculate_aging, migrations.RunPython.noop),
+    ]
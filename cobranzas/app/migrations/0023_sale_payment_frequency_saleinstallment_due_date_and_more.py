@@ -0,0 +1,50 @@
+# Generated by Django 4.0.5 on 2026-10-18 10:47
+
+from itertools import islice
+
+from dateutil.relativedelta import relativedelta
+from django.db import migrations, models
+from django.utils import timezone
+
+
+BATCH_SIZE = 1000
+
+
+def calculate_due_dates(apps, schema_editor):
+    # The existing sales are monthly. The installments are read and updated in batches, so the
+    # memory used doesn't depend on the number of installments
+    SaleInstallment = apps.get_model('app', 'SaleInstallment')
+    rows = SaleInstallment.objects.values_list('pk', 'installment', 'sale__sale_date').order_by('pk').iterator(chunk_size=BATCH_SIZE)
+    while True:
+        installments = [
+            SaleInstallment(pk=pk, due_date=timezone.localtime(sale_date).date() + relativedelta(months=installment))
+            for pk, installment, sale_date in islice(rows, BATCH_SIZE)
+        ]
+        if not installments:
+            break
+        SaleInstallment.objects.bulk_update(installments, ['due_date'], batch_size=BATCH_SIZE)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0022_saleaging_saleaging_app_saleaging_bucket_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sale',
+            name='payment_frequency',
+            field=models.CharField(choices=[('WEEKLY', 'Weekly'), ('BIWEEKLY', 'Biweekly'), ('MONTHLY', 'Monthly')], default='MONTHLY', max_length=50, verbose_name='Payment Frequency'),
+        ),
+        migrations.AddField(
+            model_name='saleinstallment',
+            name='due_date',
+            field=models.DateField(blank=True, null=True, verbose_name='Due Date'),
+        ),
+        migrations.AddIndex(
+            model_name='saleinstallment',
+            index=models.Index(fields=['status', 'due_date'], name='app_saleinst_overdue_idx'),
+        ),
+        migrations.RunPython(calculate_due_dates, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 4.0.5 on 2026-10-18 11:16
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0023_sale_payment_frequency_saleinstallment_due_date_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SyncTombstone',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('customer_id', models.PositiveIntegerField(verbose_name='Customer')),
+                ('date', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Date')),
+                ('collector', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL, verbose_name='Collector')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='synctombstone',
+            index=models.Index(fields=['collector', 'date'], name='app_synctombstone_idx'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.0.5 on 2026-10-18 11:26
+
+from django.db import migrations, models
+from django.db.models import Count, Max
+
+
+def remove_duplicated_keys(apps, schema_editor):
+    # Keep the last row written of each key
+    KeyValueStore = apps.get_model('app', 'KeyValueStore')
+    duplicated = KeyValueStore.objects.values('key').annotate(count=Count('pk'), last=Max('pk')).filter(count__gt=1).order_by()
+    for row in duplicated:
+        KeyValueStore.objects.filter(key=row['key']).exclude(pk=row['last']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0024_synctombstone'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicated_keys, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='keyvaluestore',
+            name='key',
+            field=models.CharField(max_length=50, unique=True),
+        ),
+    ]
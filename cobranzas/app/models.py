@@ -1,15 +1,21 @@
 import datetime
+from dateutil.relativedelta import relativedelta
 from django.utils import timezone
 import json
+import time
 from django.conf import settings
 from django.contrib import admin
 from django.contrib.auth.models import AbstractUser
+from django.core.exceptions import ValidationError
 from django.core.validators import MinValueValidator
-from django.db import models
-from django.db.models import Sum
+from django.db import models, transaction
+from django.db.models import Count, Max, Sum, F, OuterRef, Q, Subquery, Value
+from django.db.models.functions import Coalesce
 from django.utils.functional import cached_property
 from django.utils.translation import gettext_lazy as _
 
+from app.installments import MAX_INSTALLMENTS, get_installments, to_cents
+
 
 class User(AbstractUser):
     is_collector = models.BooleanField(default=False, verbose_name=_('Is a collector?'))
@@ -38,6 +44,7 @@ class Customer(models.Model):
     city = models.CharField(max_length=50, choices=CITY, verbose_name=_('City'))
     telephone = models.CharField(max_length=150, blank=True, null=True, verbose_name=_('Telephone'))
     collector = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, verbose_name=_('Collector'))
+    modification = models.DateTimeField(auto_now=True, db_index=True, verbose_name=_('Modification Date'))
 
     def __str__(self):
         return self.name
@@ -61,6 +68,15 @@ class Product(models.Model):
 
 
 class Sale(models.Model):
+    WEEKLY = 'WEEKLY'
+    BIWEEKLY = 'BIWEEKLY'
+    MONTHLY = 'MONTHLY'
+    PAYMENT_FREQUENCY = (
+        (WEEKLY, _('Weekly')),
+        (BIWEEKLY, _('Biweekly')),
+        (MONTHLY, _('Monthly')),
+    )
+
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, verbose_name=_('User'))
     customer = models.ForeignKey(Customer, db_index=True, on_delete=models.CASCADE, verbose_name=_('Customer'))
     price = models.FloatField(verbose_name=_('Price'))
@@ -70,25 +86,121 @@ class Sale(models.Model):
         verbose_name=_('Installments')
     )
     date = models.DateTimeField(auto_now_add=True, db_index=True, verbose_name=_('Date'))
-    modification = models.DateTimeField(auto_now=True, verbose_name=_('Modification Date'))
+    modification = models.DateTimeField(auto_now=True, db_index=True, verbose_name=_('Modification Date'))
     sale_date = models.DateTimeField(db_index=True, verbose_name=_('Sale Date'))
     collector = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, null=True, blank=True, related_name='collector', verbose_name=_('Collector'))
     uncollectible = models.BooleanField(default=False, verbose_name=_('Is uncollectible?'))
     remarks = models.TextField(default="", verbose_name=_('Remarks'))
+    payment_frequency = models.CharField(
+        max_length=50, default=MONTHLY, choices=PAYMENT_FREQUENCY, verbose_name=_('Payment Frequency')
+    )
+    # Totals of the sale installments, updated by the collection write paths through update_balances
+    paid_amount = models.FloatField(default=0.0, verbose_name=_('Paid Amount'))
+    pending_balance = models.FloatField(default=0.0, verbose_name=_('Pending Balance'))
 
     def __str__(self):
         return f"{self.sale_date.strftime('%m/%d/%Y')} - {self.customer.name} - {self.pk}"
 
-    @cached_property
-    @admin.display(description=_("Pending Balance"))
-    def pending_balance(self):
-        return self.price - self.paid_amount
+    # Fields whose original values are kept in the instance, read by the signals to know what
+    # changed when the sale is saved
+    TRACKED_FIELDS = (
+        'customer_id', 'collector_id', 'price', 'installment_amount', 'installments', 'sale_date', 'payment_frequency', 'uncollectible'
+    )
 
-    @cached_property
-    @admin.display(description=_("Paid Amount"))
-    def paid_amount(self):
-        paid = SaleInstallment.objects.filter(sale=self.id).aggregate(paid=Sum('paid_amount'))
-        return paid['paid']
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance.set_tracked_values({name: value for name, value in zip(field_names, values) if name in cls.TRACKED_FIELDS})
+        return instance
+
+    def set_tracked_values(self, values=None):
+        if values is None:
+            values = {name: getattr(self, name) for name in self.TRACKED_FIELDS}
+        self._tracked_values = values
+
+    def get_original(self):
+        '''
+        Return a sale with the values of the tracked fields when it was loaded or saved, None if
+        they are unknown (the sale was loaded with only() or defer())
+        '''
+        values = getattr(self, '_tracked_values', {})
+        if len(values) != len(self.TRACKED_FIELDS):
+            return None
+        return Sale(pk=self.pk, **values)
+
+    def has_plan_changed(self):
+        '''Return True if the sale is new, or its price or installments changed since it was loaded or saved'''
+        original = self.get_original()
+        return original is None or \
+            (original.price, original.installment_amount, original.installments) != (self.price, self.installment_amount, self.installments)
+
+    def clean(self):
+        # The installments are created from the price and the installment amount when the sale is saved
+        if self.price and self.installment_amount and self.price > 0 and self.installment_amount > 0 and self.has_plan_changed():
+            if get_installments(to_cents(self.price), to_cents(self.installment_amount)) > MAX_INSTALLMENTS:
+                raise ValidationError(
+                    {'installment_amount': _('The sale cannot have more than %(max)s installments') % {'max': MAX_INSTALLMENTS}}
+                )
+
+    def save(self, *args, **kwargs):
+        if self._state.adding or kwargs.get('force_insert', False):
+            # Keep the pending balance consistent with the price
+            self.pending_balance = self.price - self.paid_amount
+            super().save(*args, **kwargs)
+        else:
+            # The paid amount is updated by the collection write paths, and this instance may have
+            # been loaded before, so it's not saved: the pending balance is calculated from the
+            # stored paid amount in the same UPDATE, and both are loaded again
+            update_fields = kwargs.pop('update_fields', None)
+            if update_fields is None:
+                update_fields = [field.name for field in self._meta.concrete_fields if not field.primary_key]
+            update_fields = [name for name in update_fields if name not in ('paid_amount', 'pending_balance')]
+            if 'price' in update_fields:
+                self.pending_balance = Value(self.price) - F('paid_amount')
+                update_fields.append('pending_balance')
+            super().save(*args, update_fields=update_fields, **kwargs)
+            self.refresh_from_db(fields=['paid_amount', 'pending_balance'])
+        self.set_tracked_values()
+
+    def get_due_date(self, installment):
+        '''Due date of the installment number "installment", counted in periods of the payment frequency from the sale date'''
+        periods = {
+            self.WEEKLY: relativedelta(weeks=installment),
+            self.BIWEEKLY: relativedelta(weeks=2 * installment),
+            self.MONTHLY: relativedelta(months=installment),
+        }
+        # The sale forms set a date, and the saved sales have a datetime
+        sale_date = self.sale_date
+        if isinstance(sale_date, datetime.datetime):
+            sale_date = timezone.localtime(sale_date).date()
+        return sale_date + periods[self.payment_frequency]
+
+    def update_due_dates(self):
+        '''Recalculate the due date of the installments, when the sale date or the payment frequency change'''
+        now = timezone.now()
+        installments = list(self.saleinstallment_set.all())
+        for installment in installments:
+            installment.due_date = self.get_due_date(installment.installment)
+            # bulk_update doesn't set auto_now fields
+            installment.modification = now
+        SaleInstallment.objects.bulk_update(installments, ['due_date', 'modification'])
+
+    @classmethod
+    def update_balances(cls, sales=None):
+        '''
+        Recalculate paid_amount and pending_balance from the installments of the given sales
+        (a list of IDs or a queryset, all the sales if None) using a single UPDATE query.
+        Return the number of updated sales.
+        '''
+        paid = SaleInstallment.objects.\
+            filter(sale=OuterRef('pk')).\
+            values('sale').\
+            annotate(paid=Sum('paid_amount')).\
+            values('paid')
+        paid_amount = Coalesce(Subquery(paid), 0.0, output_field=models.FloatField())
+
+        queryset = cls.objects.all() if sales is None else cls.objects.filter(pk__in=sales)
+        return queryset.update(paid_amount=paid_amount, pending_balance=F('price') - paid_amount)
 
 
 class SaleProduct(models.Model):
@@ -100,6 +212,14 @@ class SaleProduct(models.Model):
         return f'{self.sale.pk} - {self.product.name} - {self.price}'
 
 
+class SaleInstallmentQuerySet(models.QuerySet):
+
+    def overdue(self, date=None):
+        '''Installments not paid yet whose due date is before "date" (today by default)'''
+        date = date or timezone.localdate()
+        return self.filter(status__in=[SaleInstallment.PENDING, SaleInstallment.PARTIAL], due_date__lt=date)
+
+
 class SaleInstallment(models.Model):
     PAID = 'PAID'
     PENDING = 'PENDING'
@@ -118,11 +238,18 @@ class SaleInstallment(models.Model):
     status = models.CharField(
         max_length=50, default=PENDING, choices=STATUS, db_index=True, verbose_name=_('Payment Status')
     )
+    due_date = models.DateField(blank=True, null=True, verbose_name=_('Due Date'))
+    modification = models.DateTimeField(auto_now=True, db_index=True, verbose_name=_('Modification Date'))
+
+    objects = SaleInstallmentQuerySet.as_manager()
 
     def __str__(self):
         return f'{self.sale.pk} - {self.installment}'
 
     class Meta:
+        indexes = [
+            models.Index(fields=['status', 'due_date'], name='app_saleinst_overdue_idx'),
+        ]
         constraints = [
             models.UniqueConstraint(
                 fields=['sale', 'installment'], name='unique_sale_installment'
@@ -134,6 +261,196 @@ class SaleInstallment(models.Model):
         ]
 
 
+class CustomerBalance(models.Model):
+    '''
+    Receivables of the customers with pending sales, read by the pending balance report: a row
+    for each customer with the totals of its pending sales (sale_collector is None), and a row
+    for each other collector assigned to some of its sales with the totals of those sales, so
+    the report is filtered by the collector of the customer or of the sales without grouping the
+    rows. City and collector are copied from the customer to filter the report without joins.
+    The rows are updated by the sale and collection write paths through update_balances
+    '''
+    customer = models.ForeignKey(Customer, on_delete=models.CASCADE, verbose_name=_('Customer'))
+    city = models.CharField(max_length=50, choices=Customer.CITY, db_index=True, verbose_name=_('City'))
+    collector = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, verbose_name=_('Collector'))
+    sale_collector = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.CASCADE, null=True, blank=True, related_name='+', verbose_name=_('Sale Collector')
+    )
+    sales = models.PositiveIntegerField(default=0, verbose_name=_('Sales'))
+    price = models.FloatField(default=0.0, verbose_name=_('Price'))
+    paid_amount = models.FloatField(default=0.0, verbose_name=_('Paid Amount'))
+    pending_balance = models.FloatField(default=0.0, verbose_name=_('Pending Balance'))
+
+    def __str__(self):
+        return f'{self.customer_id} - {self.sale_collector_id} - {self.pending_balance}'
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['customer'], condition=Q(sale_collector__isnull=True), name='unique_customer_balance'
+            ),
+            models.UniqueConstraint(
+                fields=['customer', 'sale_collector'], name='unique_customer_sale_collector_balance'
+            ),
+        ]
+        indexes = [
+            # Ordering of the pending balance report
+            models.Index(fields=['-pending_balance', 'customer'], name='app_customerbalance_idx'),
+        ]
+
+    @classmethod
+    def get_collector_filter(cls, collector=None):
+        '''
+        Return the filter of the rows of the report: the customer rows, or if a collector is given,
+        the rows of its customers and of the sales assigned to it. The rows of the sales of a
+        collector only exist for the customers of other collectors, so there is a row by customer
+        '''
+        if collector is None:
+            return Q(sale_collector__isnull=True)
+        return Q(sale_collector__isnull=True, collector=collector) | Q(sale_collector=collector)
+
+    @classmethod
+    def update_balances(cls, customers=None):
+        '''
+        Recalculate the receivables of the given customers (a list of IDs or a queryset, all the
+        customers if None) from their pending sales. Customers without pending sales are removed.
+        Return the number of customers with pending balance.
+        '''
+        customers_filter = Q() if customers is None else Q(customer__in=customers)
+        pending_sales = Sale.objects.\
+            filter(customers_filter, uncollectible=False).\
+            annotate(paid_installments=Count('saleinstallment__pk', filter=Q(saleinstallment__status=SaleInstallment.PAID))).\
+            exclude(installments__lte=F('paid_installments'))
+        rows = Sale.objects.\
+            filter(pk__in=Subquery(pending_sales.values('pk'))).\
+            values('customer', 'customer__city', 'customer__collector', 'collector').\
+            annotate(sales=Count('pk'), price=Sum('price'), paid_amount=Sum('paid_amount')).\
+            order_by()
+
+        balances = {}
+        for row in rows:
+            # Every sale is in the row of the customer, and in the row of its collector if it
+            # isn't the collector of the customer
+            sale_collectors = [None]
+            if row['collector'] not in (None, row['customer__collector']):
+                sale_collectors.append(row['collector'])
+            for sale_collector in sale_collectors:
+                balance = balances.get((row['customer'], sale_collector))
+                if balance is None:
+                    balance = balances[(row['customer'], sale_collector)] = cls(
+                        customer_id=row['customer'],
+                        city=row['customer__city'],
+                        collector_id=row['customer__collector'],
+                        sale_collector_id=sale_collector,
+                    )
+                balance.sales += row['sales']
+                balance.price += row['price']
+                balance.paid_amount += row['paid_amount']
+                balance.pending_balance = balance.price - balance.paid_amount
+
+        with transaction.atomic():
+            if customers is None:
+                cls.objects.all().delete()
+            else:
+                # Lock the customers, so concurrent updates of the same customer don't collide
+                list(Customer.objects.select_for_update().filter(pk__in=customers).values_list('pk'))
+                cls.objects.filter(customer__in=customers).delete()
+            cls.objects.bulk_create(balances.values(), batch_size=1000)
+        return len([balance for balance in balances.values() if balance.sale_collector_id is None])
+
+
+class SaleAging(models.Model):
+    '''
+    Aging of each pending sale, read by the defaulters report: the date the debt is counted
+    from (the last payment, or the sale date if it has no payments) and the bucket of days late
+    (qualification). The rows are updated by the sale and collection write paths through
+    update_sales, and the buckets are moved every night by update_buckets
+    '''
+    # Days late of each bucket, sales with more days than a bucket are in it
+    BUCKETS = (30, 15, 7)
+
+    sale = models.OneToOneField(Sale, primary_key=True, on_delete=models.CASCADE, verbose_name=_('Sale'))
+    customer = models.ForeignKey(Customer, on_delete=models.CASCADE, verbose_name=_('Customer'))
+    pending_installments = models.PositiveIntegerField(default=0, verbose_name=_('Pending Installments'))
+    last_payment_date = models.DateTimeField(blank=True, null=True, verbose_name=_('Last Payment Date'))
+    since = models.DateTimeField(verbose_name=_('Debt Date'))
+    qualification = models.PositiveSmallIntegerField(default=0, verbose_name=_('Qualification'))
+
+    def __str__(self):
+        return f'{self.sale_id} - {self.qualification}'
+
+    class Meta:
+        indexes = [
+            # Ordering of the defaulters report, also used to move the buckets
+            models.Index(fields=['-qualification', 'since', 'sale'], name='app_saleaging_bucket_idx'),
+        ]
+
+    @classmethod
+    def get_debt_days(cls, since, now):
+        return (now - since).days
+
+    @classmethod
+    def get_qualification(cls, since, now):
+        debt_days = cls.get_debt_days(since, now)
+        for bucket in cls.BUCKETS:
+            if debt_days > bucket:
+                return bucket
+        return 0
+
+    @classmethod
+    def update_sales(cls, sales=None):
+        '''
+        Recalculate the aging of the given sales (a list of IDs or a queryset, all the sales if
+        None). Paid and uncollectible sales are removed. Return the number of pending sales.
+        '''
+        sales_filter = Q() if sales is None else Q(pk__in=sales)
+        # Distinct counts, an installment can be paid in more than one collection
+        rows = Sale.objects.\
+            filter(sales_filter, uncollectible=False).\
+            values('id', 'customer', 'sale_date').\
+            annotate(paid_installments=Count('saleinstallment__pk', filter=Q(saleinstallment__status=SaleInstallment.PAID), distinct=True)).\
+            annotate(pending_installments=Count('saleinstallment__pk', filter=~Q(saleinstallment__status=SaleInstallment.PAID), distinct=True)).\
+            exclude(installments__lte=F('paid_installments')).\
+            annotate(last_payment_date=Max('saleinstallment__collectioninstallment__collection__date')).\
+            order_by()
+
+        now = timezone.now()
+        with transaction.atomic():
+            if sales is None:
+                cls.objects.all().delete()
+            else:
+                # Lock the sales, so concurrent updates of the same sale don't collide
+                list(Sale.objects.select_for_update().filter(pk__in=sales).values_list('pk'))
+                cls.objects.filter(sale__in=sales).delete()
+            agings = []
+            for row in rows:
+                since = row['last_payment_date'] or row['sale_date']
+                agings.append(cls(
+                    sale_id=row['id'],
+                    customer_id=row['customer'],
+                    pending_installments=row['pending_installments'],
+                    last_payment_date=row['last_payment_date'],
+                    since=since,
+                    qualification=cls.get_qualification(since, now),
+                ))
+            cls.objects.bulk_create(agings)
+        return len(agings)
+
+    @classmethod
+    def update_buckets(cls, now=None):
+        '''
+        Move the sales that passed the days of a bucket since the last update to that bucket,
+        without touching the other sales. Return the number of moved sales.
+        '''
+        now = now or timezone.now()
+        moved = 0
+        for bucket in cls.BUCKETS:
+            moved += cls.objects.\
+                filter(qualification__lt=bucket, since__lte=now - datetime.timedelta(days=bucket + 1)).\
+                update(qualification=bucket)
+        return moved
+
+
 class LoginLog(models.Model):
     user = models.ForeignKey(User, db_index=True, on_delete=models.CASCADE, verbose_name=_('User'))
     login_datetime = models.DateTimeField(auto_now_add=True, verbose_name=_('Login Date/Time'))
@@ -146,20 +463,14 @@ class LoginLog(models.Model):
 
 
 class KeyValueStore(models.Model):
-    key = models.CharField(max_length=50)
+    key = models.CharField(max_length=50, unique=True)
     value = models.CharField(max_length=250)
 
     @classmethod
     def set(self, key, value):
-        obj = None
+        # The key is unique, so concurrent first writes of a key update the same row
         val = {'value': value}
-        try:
-            obj = self.objects.get(key=key)
-        except:
-            obj = KeyValueStore(key=key)
-
-        obj.value = json.dumps(val)
-        obj.save()
+        self.objects.update_or_create(key=key, defaults={'value': json.dumps(val)})
 
     @classmethod
     def get(self, key):
@@ -169,5 +480,87 @@ class KeyValueStore(models.Model):
         except:
             return None
 
+    @classmethod
+    def sync_key(self, collector=None):
+        # Admins synchronize every customer, so the global key changes with every change, while
+        # the key of a collector only changes when its customers or sales change
+        if collector is None:
+            return 'sync'
+        return f'sync.{collector}'
+
+    @classmethod
+    def update_sync(self, collectors=()):
+        # Version of the data synchronized by the app. It's used as the ETag of the synchronization
+        # data, so it must change every time the data changes, even twice in the same second
+        version = time.time_ns() // 1000
+        self.set(self.sync_key(), version)
+        for collector in set(collectors) - {None}:
+            self.set(self.sync_key(collector), version)
+
+    @classmethod
+    def get_sync(self, user):
+        # Version of the data synchronized by the user. Until the data of a collector changes
+        # for the first time, the global version is used
+        keys = [self.sync_key()]
+        if not user.is_admin:
+            keys.insert(0, self.sync_key(user.pk))
+        values = dict(self.objects.filter(key__in=keys).values_list('key', 'value'))
+        for key in keys:
+            if key in values:
+                return json.loads(values[key])['value']
+        return None
+
     def __str__(self):
         return f'{self.key}'
+
+
+class SyncTombstone(models.Model):
+    '''
+    Customers that left the scope of a collector: the customer or one of its sales was assigned to
+    another collector, or a sale assigned to the collector was paid, marked as uncollectible or
+    deleted. The delta sync reads them to tell the app of the collector which customers to remove,
+    the customers still in the scope of the collector are sent again instead
+    '''
+    # Age of the oldest tombstones kept, a delta sync from an older cursor gets the whole data
+    RETENTION = datetime.timedelta(days=30)
+
+    collector = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, verbose_name=_('Collector'))
+    # Not a foreign key, deleted customers are also removed from the app
+    customer_id = models.PositiveIntegerField(verbose_name=_('Customer'))
+    date = models.DateTimeField(default=timezone.now, verbose_name=_('Date'))
+
+    def __str__(self):
+        return f'{self.collector_id} - {self.customer_id}'
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['collector', 'date'], name='app_synctombstone_idx'),
+        ]
+
+    @classmethod
+    def add(cls, customers):
+        '''Record that the customers left the scope of the collectors, "customers" is an iterable of (collector, customer) IDs'''
+        now = timezone.now()
+        return cls.objects.bulk_create([
+            cls(collector_id=collector, customer_id=customer, date=now)
+            for collector, customer in set(customers) if collector is not None
+        ])
+
+    @classmethod
+    def add_paid_sales(cls, sales):
+        '''
+        Record that the customers of the given sales (a list of IDs) that are paid left the scope
+        of the collectors of the sales, if they aren't the collectors of the customers
+        '''
+        paid_sales = Sale.objects.\
+            filter(pk__in=sales, pending_balance__lte=0).\
+            exclude(collector=F('customer__collector')).\
+            values_list('collector', 'customer')
+        return cls.add(paid_sales)
+
+    @classmethod
+    def prune(cls, now=None):
+        '''Delete the tombstones older than RETENTION. Return the number of deleted tombstones.'''
+        now = now or timezone.now()
+        deleted, _rows = cls.objects.filter(date__lt=now - cls.RETENTION).delete()
+        return deleted
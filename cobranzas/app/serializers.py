@@ -1,5 +1,8 @@
+from itertools import islice
+
+from django.utils.functional import cached_property
 from rest_framework import serializers
-from app.models import Sale, Customer, SaleInstallment
+from app.models import Sale, Customer, SaleInstallment, SaleProduct
 
 # Terminology for serializers
 # SBC = Sales By Customer
@@ -17,7 +20,7 @@ from app.models import Sale, Customer, SaleInstallment
 class SBCSaleInstallmentsSerializer(serializers.ModelSerializer):
     class Meta:
         model = SaleInstallment
-        fields = ['pk', 'installment', 'installment_amount', 'paid_amount', 'status']
+        fields = ['pk', 'installment', 'installment_amount', 'paid_amount', 'status', 'due_date']
 
 
 class SBCSaleSerializer(serializers.ModelSerializer):
@@ -40,9 +43,124 @@ class SalesByCustomerSerializer(serializers.ModelSerializer):
         fields = ['pk', 'sale_set']
 
 
+class SalesByCustomerValuesSerializer:
+    '''
+    Same data as SalesByCustomerSerializer(many=True), built from four flat values() queries
+    (customers, sales, installments and products) joined in dictionaries, instead of creating
+    model instances and running a products query for each sale.
+    "sales" and "installments" are querysets with the filters and order of the sales and
+    installments to include, they are filtered by the customers and sales found.
+    '''
+    sale_fields = ['pk', 'price', 'installments', 'date', 'remarks', 'paid_amount', 'pending_balance']
+    installment_fields = ['pk', 'installment', 'installment_amount', 'paid_amount', 'status', 'due_date']
+    date_field = serializers.DateTimeField()
+    due_date_field = serializers.DateField()
+
+    def __init__(self, customers, sales, installments):
+        self.customers = customers
+        self.sales = sales
+        self.installments = installments
+
+    @cached_property
+    def data(self):
+        return self.get_data(list(self.customers.values_list('pk', flat=True)))
+
+    def iterator(self, chunk_size=500):
+        '''
+        Yield the data of each customer, building it for chunk_size customers at a time, so the
+        memory used doesn't depend on the number of customers
+        '''
+        customers = self.customers.values_list('pk', flat=True).iterator(chunk_size=chunk_size)
+        while chunk := list(islice(customers, chunk_size)):
+            yield from self.get_data(chunk)
+
+    def get_data(self, customers):
+        sales = list(self.sales.filter(customer__in=customers).values('customer', *self.sale_fields))
+        sales_id = [sale['pk'] for sale in sales]
+
+        installments_by_sale = {pk: [] for pk in sales_id}
+        for installment in self.installments.filter(sale__in=sales_id).values('sale', *self.installment_fields):
+            sale = installment.pop('sale')
+            installment['due_date'] = self.due_date_field.to_representation(installment['due_date'])
+            installments_by_sale[sale].append(installment)
+
+        products_by_sale = {pk: [] for pk in sales_id}
+        for sale, product in SaleProduct.objects.filter(sale__in=sales_id).order_by('pk').values_list('sale', 'product__name'):
+            products_by_sale[sale].append(product)
+
+        sales_by_customer = {pk: [] for pk in customers}
+        for sale in sales:
+            sales_by_customer[sale['customer']].append({
+                'pk': sale['pk'],
+                'price': sale['price'],
+                'installments': sale['installments'],
+                'date': self.date_field.to_representation(sale['date']),
+                'remarks': sale['remarks'],
+                'products': products_by_sale[sale['pk']],
+                'paid_amount': sale['paid_amount'],
+                'pending_balance': sale['pending_balance'],
+                'saleinstallment_set': installments_by_sale[sale['pk']],
+            })
+
+        return [{'pk': pk, 'sale_set': sales_by_customer[pk]} for pk in customers]
+
+
 # CUSTOMER
 
 class CustomersSerializer(serializers.ModelSerializer):
     class Meta:
         model = Customer
         fields = ['pk', 'name', 'address', 'telephone', 'city']
+
+
+# COLUMNAR FORMAT
+
+class ColumnarDataSerializer:
+    '''
+    Columnar format of the synchronization data (sales, customers, last_update, cursor and
+    deleted), smaller than the nested format because field names are not repeated:
+    - "sales", "installments" and "customers" are objects with an array of values for each field.
+      Sales have the customer, and installments the sale, they belong to.
+    - "sales_customers" has the customers of the nested "sales" list, including those without sales.
+    - The status of the installments is the index of the status in "statuses".
+    '''
+    statuses = [SaleInstallment.PENDING, SaleInstallment.PARTIAL, SaleInstallment.PAID]
+    sale_fields = ['pk', 'price', 'installments', 'date', 'remarks', 'products', 'paid_amount', 'pending_balance']
+    installment_fields = SalesByCustomerValuesSerializer.installment_fields
+
+    def __init__(self, data):
+        self.source = data
+
+    @cached_property
+    def data(self):
+        status_index = {status: i for i, status in enumerate(self.statuses)}
+        sales = {field: [] for field in ['customer'] + self.sale_fields}
+        installments = {field: [] for field in ['sale'] + self.installment_fields}
+
+        for customer in self.source['sales']:
+            for sale in customer['sale_set']:
+                sales['customer'].append(customer['pk'])
+                for field in self.sale_fields:
+                    sales[field].append(sale[field])
+                for installment in sale['saleinstallment_set']:
+                    installments['sale'].append(sale['pk'])
+                    for field in self.installment_fields:
+                        installments[field].append(installment[field])
+        installments['status'] = [status_index[status] for status in installments['status']]
+
+        data = {
+            'format': 'columnar',
+            'statuses': self.statuses,
+            'sales_customers': [customer['pk'] for customer in self.source['sales']],
+            'sales': sales,
+            'installments': installments,
+            'customers': {
+                field: [customer[field] for customer in self.source['customers']]
+                for field in CustomersSerializer.Meta.fields
+            },
+        }
+        # last_update, cursor and deleted are the same in both formats
+        for key, value in self.source.items():
+            data.setdefault(key, value)
+
+        return data
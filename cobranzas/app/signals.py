@@ -1,73 +1,189 @@
-import math
-import time
 from django.contrib.auth.signals import user_logged_in
-from django.db.models.signals import pre_save, post_save
+from django.db.models.signals import pre_save, post_save, post_delete
 from django.dispatch import receiver
-from app.models import Sale, SaleInstallment, Customer, KeyValueStore, LoginLog
+from django.utils import timezone
+from app.installments import from_cents, get_plan, to_cents
+from app.models import Sale, SaleInstallment, Customer, CustomerBalance, SaleAging, KeyValueStore, LoginLog, SyncTombstone
 from collection.models import Collection
 
 
 @receiver(pre_save, sender=Sale, dispatch_uid='app.signals.preSave_Sale')
 def preSave_Sale(sender, instance, *args, **kwargs):
     if instance.id:
-        original = Sale.objects.get(pk=instance.id)
+        # The values of the sale when it was loaded, queried only if they are unknown
+        original = instance.get_original() or Sale.objects.get(pk=instance.id)
         instance.__original_object = original
 
 
 @receiver(post_save, sender=Sale, dispatch_uid='app.signals.postSave_Sale')
 def postSave_Sale(sender, instance, created, **kwargs):
     '''
-    THE SAME LOGIC IS USED IN create_sale TEMPLATE
-    When a new sale is created:
-    1. I check if the price/amount of installments is integer, in which case the amount
-       of installments is fixed (fixed_installment_amount). If not, last installment amount is
-       different.
-    2. If fixed_installment_amount > 0.6 I add a new installment to prevent the last installment to
-       be to much higher than the rest of the installments
+    Create the installments of a new sale, or update them if the price or the installments of the
+    sale changed. The amounts are calculated by app.installments, as in the sale forms
     '''
-    def create_installments():
-        price = instance.price
-        installment_amount = instance.installment_amount
-        installments = price / installment_amount
-        fixed_installment_amount = installments - math.trunc(installments)
-
-        if fixed_installment_amount == 0:
-            # Fixed amount is True
-            objs = [SaleInstallment(sale=instance, installment=x, installment_amount=instance.installment_amount) for x in range(1, instance.installments + 1)]
-            SaleInstallment.objects.bulk_create(objs)
-        else:
-            # Insallment amount change for the last installment
-            installments_quantity = math.trunc(installments)
-
-            # Calculate how many istallments the sale have
-            if fixed_installment_amount <= 0.6:
-                installments_quantity -= 1
-
-            last_installment_number = installments_quantity + 1
-            last_installment_amount = price - (installments_quantity * installment_amount)
-
-            # Fixed amount installments
-            objs = [SaleInstallment(sale=instance, installment=x, installment_amount=instance.installment_amount) for x in range(1, installments_quantity + 1)]
-            # Last installment
-            objs.append(SaleInstallment(sale=instance, installment=last_installment_number, installment_amount=last_installment_amount))
-            SaleInstallment.objects.bulk_create(objs)
+    def get_installments():
+        plan = get_plan(to_cents(instance.price), to_cents(instance.installment_amount))
+        if len(plan) != instance.installments:
+            # The installments of the sale are those of the plan of its price and installment amount
+            instance.installments = len(plan)
+            Sale.objects.filter(pk=instance.pk).update(installments=instance.installments)
+        return [
+            SaleInstallment(sale=instance, installment=x, installment_amount=from_cents(amount), due_date=instance.get_due_date(x))
+            for x, amount in enumerate(plan, start=1)
+        ]
+
+    def update_installments():
+        '''
+        Update the amount and due date of the existing installments in place, and only create or
+        delete the installments added or removed at the end
+        '''
+        installments = {i.installment: i for i in get_installments()}
+        existing = {i.installment: i for i in SaleInstallment.objects.filter(sale=instance)}
+
+        now = timezone.now()
+        changed = []
+        for number, installment in existing.items():
+            new_installment = installments.get(number, None)
+            if new_installment is None:
+                continue
+            if (installment.installment_amount, installment.due_date) != (new_installment.installment_amount, new_installment.due_date):
+                installment.installment_amount = new_installment.installment_amount
+                installment.due_date = new_installment.due_date
+                if installment.paid_amount == 0.0:
+                    installment.status = SaleInstallment.PENDING
+                elif installment.installment_amount > installment.paid_amount:
+                    installment.status = SaleInstallment.PARTIAL
+                else:
+                    installment.status = SaleInstallment.PAID
+                # bulk_update doesn't set auto_now fields
+                installment.modification = now
+                changed.append(installment)
+
+        removed = [number for number in existing if number not in installments]
+        if removed:
+            SaleInstallment.objects.filter(sale=instance, installment__in=removed).delete()
+        SaleInstallment.objects.bulk_update(changed, ['installment_amount', 'due_date', 'status', 'modification'])
+        SaleInstallment.objects.bulk_create([i for number, i in installments.items() if number not in existing])
 
     if created is True:
-        create_installments()
+        SaleInstallment.objects.bulk_create(get_installments())
     else:
-        original_price = instance.__original_object.price
-        original_installments = instance.__original_object.installments
-        if original_price != instance.price or original_installments != instance.installments:
-            SaleInstallment.objects.filter(sale=instance).delete()
-            create_installments()
+        original = instance.__original_object
+        if (original.price, original.installments, original.installment_amount) != (instance.price, instance.installments, instance.installment_amount):
+            update_installments()
+            Sale.update_balances([instance.pk])
+        elif original.get_due_date(1) != instance.get_due_date(1):
+            # The sale date or the payment frequency changed
+            instance.update_due_dates()
+
+
+def get_changed_fields(instance):
+    '''Tracked fields (Sale.TRACKED_FIELDS) changed by the last save of the sale, all of them if it's new'''
+    original = getattr(instance, '__original_object', None)
+    if original is None:
+        return set(Sale.TRACKED_FIELDS)
+    return {name for name in Sale.TRACKED_FIELDS if getattr(original, name) != getattr(instance, name)}
+
+
+@receiver(post_delete, sender=Sale, dispatch_uid='app.signals.postDelete_Sale')
+def postDelete_Sale(sender, instance, **kwargs):
+    # Deleted sales leave no trace to compare against the sync cursor, so the customer is marked
+    # as modified to have its sales sent again in the next delta sync
+    Customer.objects.filter(pk=instance.customer_id).update(modification=timezone.now())
+
+
+@receiver(pre_save, sender=Customer, dispatch_uid='app.signals.preSave_Customer')
+def preSave_Customer(sender, instance, *args, **kwargs):
+    # The previous collector also has to synchronize the customer, to remove it
+    if instance.id:
+        instance.__original_collector = Customer.objects.filter(pk=instance.id).values_list('collector', flat=True).first()
+
+
+def get_sync_collectors(instance):
+    '''Return the collectors whose synchronized data includes the saved or deleted instance'''
+    if isinstance(instance, Customer):
+        return {instance.collector_id, getattr(instance, '__original_collector', None)}
+
+    if isinstance(instance, Sale):
+        collectors = {instance.collector_id}
+        original = getattr(instance, '__original_object', None)
+        if original:
+            collectors.add(original.collector_id)
+        collectors.update(Customer.objects.filter(pk=instance.customer_id).values_list('collector', flat=True))
+        return collectors
+
+    collectors = set()
+    if isinstance(instance, SaleInstallment):
+        for row in Sale.objects.filter(pk=instance.sale_id).values_list('collector', 'customer__collector'):
+            collectors.update(row)
+
+    if isinstance(instance, Collection):
+        # Installments paid in a collection are updated in bulk, without signals
+        for row in Customer.objects.filter(pk=instance.customer_id).values_list('collector', 'sale__collector'):
+            collectors.update(row)
+
+    return collectors
 
 
 @receiver(post_save, sender=Sale, dispatch_uid='app.signals.update_sync_value.Sale')
 @receiver(post_save, sender=Customer, dispatch_uid='app.signals.update_sync_value.Customer')
 @receiver(post_save, sender=Collection, dispatch_uid='app.signals.update_sync_value.Collection')
-def update_sync_value(sender, instance, created, **kwargs):
-    epoc = int(time.time())
-    KeyValueStore.set('sync', epoc)
+@receiver(post_save, sender=SaleInstallment, dispatch_uid='app.signals.update_sync_value.SaleInstallment')
+@receiver(post_delete, sender=Sale, dispatch_uid='app.signals.update_sync_value.Sale.delete')
+@receiver(post_delete, sender=Customer, dispatch_uid='app.signals.update_sync_value.Customer.delete')
+def update_sync_value(sender, instance, **kwargs):
+    KeyValueStore.update_sync(get_sync_collectors(instance))
+
+
+@receiver(post_save, sender=Sale, dispatch_uid='app.signals.add_sync_tombstones.Sale')
+@receiver(post_save, sender=Customer, dispatch_uid='app.signals.add_sync_tombstones.Customer')
+@receiver(post_delete, sender=Sale, dispatch_uid='app.signals.add_sync_tombstones.Sale.delete')
+@receiver(post_delete, sender=Customer, dispatch_uid='app.signals.add_sync_tombstones.Customer.delete')
+def add_sync_tombstones(sender, instance, signal, **kwargs):
+    '''Record the customers that left the scope of a collector, to remove them from its app in the next delta sync'''
+    if signal is post_delete:
+        customer = instance.pk if isinstance(instance, Customer) else instance.customer_id
+        SyncTombstone.add([(instance.collector_id, customer)])
+    elif kwargs.get('created'):
+        return
+    elif isinstance(instance, Customer):
+        original_collector = getattr(instance, '__original_collector', None)
+        if original_collector != instance.collector_id:
+            SyncTombstone.add([(original_collector, instance.pk)])
+    else:
+        original = getattr(instance, '__original_object', None) or instance.get_original()
+        if original is None:
+            return
+        customers = []
+        if (original.collector_id, original.customer_id) != (instance.collector_id, instance.customer_id):
+            customers.append((original.collector_id, original.customer_id))
+        if instance.uncollectible and not original.uncollectible:
+            customers.append((instance.collector_id, instance.customer_id))
+        SyncTombstone.add(customers)
+
+
+@receiver(post_save, sender=Sale, dispatch_uid='app.signals.update_customer_balance.Sale')
+@receiver(post_save, sender=Customer, dispatch_uid='app.signals.update_customer_balance.Customer')
+@receiver(post_delete, sender=Sale, dispatch_uid='app.signals.update_customer_balance.Sale.delete')
+def update_customer_balance(sender, instance, **kwargs):
+    # Payments are applied in bulk, so the collection views update the balances themselves
+    # Sales saved without changes in the tracked fields (e.g. only the remarks) don't change the balances
+    if kwargs.get('created') is False and isinstance(instance, Sale) and not get_changed_fields(instance):
+        return
+    if isinstance(instance, Customer):
+        customers = {instance.pk}
+    else:
+        customers = {instance.customer_id}
+        original = getattr(instance, '__original_object', None)
+        if original:
+            customers.add(original.customer_id)
+    CustomerBalance.update_balances(customers)
+
+
+@receiver(post_save, sender=Sale, dispatch_uid='app.signals.update_sale_aging')
+def update_sale_aging(sender, instance, created, **kwargs):
+    if created or get_changed_fields(instance):
+        SaleAging.update_sales([instance.pk])
 
 
 @receiver(user_logged_in)
@@ -0,0 +1,39 @@
+from django.contrib.staticfiles.storage import StaticFilesStorage
+from django.core.files.base import ContentFile
+
+from app.compression import BROTLI, ENCODINGS, GZIP, compress
+
+
+class CompressedStaticFilesStorage(StaticFilesStorage):
+    '''
+    Write precompressed copies of each text file (name.js.gz and name.js.br) when running
+    collectstatic, so the web server can send them without compressing the files on each request.
+    Files keep their names: the JS files are ES modules that import each other by name, and
+    hashed names would load the same module twice (e.g. sync.js from base.html and from
+    create-collection.js).
+    '''
+    compressed_extensions = ('.js', '.css', '.html', '.json', '.svg', '.txt', '.map')
+    extensions = {GZIP: '.gz', BROTLI: '.br'}
+
+    def post_process(self, paths, dry_run=False, **options):
+        if dry_run:
+            return
+
+        for name in paths:
+            if not name.endswith(self.compressed_extensions):
+                continue
+
+            with self.open(name) as original:
+                content = original.read()
+
+            for encoding in ENCODINGS:
+                compressed_name = name + self.extensions[encoding]
+                # Overwrite the files compressed by a previous collectstatic
+                if self.exists(compressed_name):
+                    self.delete(compressed_name)
+                compressed_content = compress(content, encoding, best=True)
+                # Compressing very small files can make them bigger
+                if len(compressed_content) < len(content):
+                    self._save(compressed_name, ContentFile(compressed_content))
+
+            yield name, name, True
@@ -0,0 +1,39 @@
+import weakref
+
+from django.db.models.signals import pre_save, post_save, post_delete
+
+# The receivers are registered when app.signals is imported
+import app.signals  # noqa: F401
+
+
+SIGNALS = (pre_save, post_save, post_delete)
+# Receivers of the signals registered by the apps, before any test disconnects them
+RECEIVERS = {signal: list(signal.receivers) for signal in SIGNALS}
+
+
+def get_receiver(receiver):
+    # The receivers connected with weak references are stored as references
+    return receiver() if isinstance(receiver, weakref.ReferenceType) else receiver
+
+
+class ReceiversMixin:
+
+    def set_receivers(self, disconnected=()):
+        '''
+        Connect every registered receiver except the "disconnected" ones during the test, and
+        restore the previous receivers when it ends, so the results of the test don't depend on
+        the receivers connected or disconnected by the other tests
+        '''
+        saved = {signal: list(signal.receivers) for signal in SIGNALS}
+
+        def restore():
+            for signal, receivers in saved.items():
+                with signal.lock:
+                    signal.receivers = receivers
+                    signal.sender_receivers_cache.clear()
+
+        self.addCleanup(restore)
+        for signal, receivers in RECEIVERS.items():
+            with signal.lock:
+                signal.receivers = [r for r in receivers if get_receiver(r[1]) not in disconnected]
+                signal.sender_receivers_cache.clear()
@@ -0,0 +1,108 @@
+import io
+import math
+import random
+
+from django.core.management import call_command
+from django.test import SimpleTestCase
+
+from app.installments import from_cents, get_installment_amount, get_installments, get_plan, get_scheme, to_cents
+
+
+def get_float_plan(price, installment_amount):
+    '''The plan as it was calculated with floats, by the sale signal and create-sale.js'''
+    installments = price / installment_amount
+    fixed_installment_amount = installments - math.trunc(installments)
+    if fixed_installment_amount == 0:
+        return [installment_amount] * int(installments)
+    installments_quantity = math.trunc(installments)
+    if fixed_installment_amount <= 0.6:
+        installments_quantity -= 1
+    return [installment_amount] * installments_quantity + [price - installments_quantity * installment_amount]
+
+
+class TestInstallmentPlan(SimpleTestCase):
+
+    def test_exact_plan(self):
+        self.assertEqual(get_plan(300000, 100000), [100000, 100000, 100000])
+
+    def test_remainder(self):
+        # 1000 in installments of 300: the rest (100) is up to 60% of an installment, it's added to the last one
+        self.assertEqual(get_plan(100000, 30000), [30000, 30000, 40000])
+        # 1000 in installments of 350: the rest (300) is more than 60% of an installment, it's a new installment
+        self.assertEqual(get_plan(100000, 35000), [35000, 35000, 30000])
+        # Exactly 60%, it was a new installment with floats
+        self.assertEqual(get_plan(800, 500), [800])
+
+    def test_price_lower_than_installment_amount(self):
+        self.assertEqual(get_plan(50000, 100000), [50000])
+
+    def test_plan_with_installments(self):
+        self.assertEqual(get_plan(300000, 200000, 2), [200000, 100000])
+
+    def test_invalid_amounts(self):
+        with self.assertRaises(ValueError):
+            get_installments(100000, 0)
+        with self.assertRaises(ValueError):
+            get_installment_amount(100000, 0)
+
+    def test_cents(self):
+        self.assertEqual(to_cents(333.33), 33333)
+        self.assertEqual(to_cents(0.1 + 0.2), 30)
+        self.assertEqual(from_cents(33333), 333.33)
+
+    def test_scheme(self):
+        self.assertEqual(get_scheme([100, 100, 150]), [
+            {'installments': 2, 'installment_amount': 100},
+            {'installments': 1, 'installment_amount': 150},
+        ])
+        self.assertEqual(get_scheme([100, 100]), [{'installments': 2, 'installment_amount': 100}])
+
+
+class TestInstallmentPlanProperties(SimpleTestCase):
+    '''Properties of the plans of random prices and installments'''
+    samples = 2000
+
+    def setUp(self):
+        self.random = random.Random(2026)
+
+    def test_plan_pays_the_price(self):
+        for _ in range(self.samples):
+            price = self.random.randint(1, 10_000_000)
+            installment_amount = self.random.randint(1, price * 2)
+            plan = get_plan(price, installment_amount)
+            self.assertEqual(sum(plan), price)
+            self.assertEqual(len(plan), get_installments(price, installment_amount))
+            self.assertTrue(all(amount == installment_amount for amount in plan[:-1]))
+            if len(plan) > 1:
+                # The last installment is neither too small nor too big
+                self.assertGreater(plan[-1] * 100, installment_amount * 60)
+                self.assertLessEqual(plan[-1] * 100, installment_amount * 160)
+
+    def test_plan_of_installments_is_the_saved_plan(self):
+        # The plan previewed from the number of installments is the one created when the sale is saved
+        for _ in range(self.samples):
+            installments = self.random.randint(1, 60)
+            price = self.random.randint(installments * 2 * 100, 10_000_000)
+            installment_amount = get_installment_amount(price, installments)
+            plan = get_plan(price, installment_amount, installments)
+            self.assertEqual(sum(plan), price)
+            self.assertEqual(get_plan(price, installment_amount), plan)
+
+    def test_same_plan_as_floats(self):
+        # Prices and amounts without cents had no rounding errors with floats, but a rest of
+        # exactly 60% (e.g. 1.6 - 1 = 0.6000000000000001)
+        for _ in range(self.samples):
+            price = self.random.randint(1, 100_000)
+            installment_amount = self.random.randint(1, price)
+            if price % installment_amount * 100 == installment_amount * 60:
+                continue
+            plan = get_plan(to_cents(price), to_cents(installment_amount))
+            self.assertEqual([from_cents(amount) for amount in plan], get_float_plan(price, installment_amount))
+
+
+class TestBenchmarkCommand(SimpleTestCase):
+
+    def test_benchmark_installment_plans(self):
+        out = io.StringIO()
+        call_command('benchmark_installment_plans', '--sales', '100', '--repeat', '1', stdout=out)
+        self.assertIn('100 plans', out.getvalue())
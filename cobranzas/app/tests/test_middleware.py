@@ -0,0 +1,62 @@
+import gzip
+import json
+
+import brotli
+
+from django.http import HttpResponse, StreamingHttpResponse
+from django.test import TestCase, RequestFactory, override_settings
+
+from app.middleware import CompressionMiddleware
+
+
+@override_settings(COMPRESSION_MIN_SIZE=1024)
+class TestCompressionMiddleware(TestCase):
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.content = json.dumps([{'installment': i, 'status': 'PENDING'} for i in range(100)]).encode()
+
+    def get_response(self, response, accept_encoding='gzip, deflate'):
+        request = self.factory.get('/', HTTP_ACCEPT_ENCODING=accept_encoding)
+        return CompressionMiddleware(lambda request: response)(request)
+
+    def test_compress_json(self):
+        response = self.get_response(HttpResponse(self.content, content_type='application/json'))
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response['Vary'])
+        self.assertEqual(gzip.decompress(response.content), self.content)
+
+    def test_compress_brotli(self):
+        response = self.get_response(HttpResponse(self.content, content_type='application/json'), 'gzip, deflate, br')
+        self.assertEqual(response['Content-Encoding'], 'br')
+        self.assertEqual(brotli.decompress(response.content), self.content)
+
+    def test_weak_etag(self):
+        original = HttpResponse(self.content, content_type='application/json')
+        original['ETag'] = '"123"'
+        self.assertEqual(self.get_response(original)['ETag'], 'W/"123"')
+
+    def test_small_response(self):
+        response = self.get_response(HttpResponse(b'{}', content_type='application/json'))
+        self.assertFalse(response.has_header('Content-Encoding'))
+
+    def test_not_compressible(self):
+        response = self.get_response(HttpResponse(self.content, content_type='image/png'))
+        self.assertFalse(response.has_header('Content-Encoding'))
+
+    def test_not_accepted(self):
+        response = self.get_response(HttpResponse(self.content, content_type='text/html'), 'gzip;q=0, identity')
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(response.content, self.content)
+
+    def test_streaming_response(self):
+        chunks = [self.content[i:i + 100] for i in range(0, len(self.content), 100)]
+        response = self.get_response(StreamingHttpResponse(iter(chunks), content_type='application/json'))
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(b''.join(response.streaming_content)), self.content)
+
+    def test_streaming_response_brotli(self):
+        chunks = [self.content[i:i + 100] for i in range(0, len(self.content), 100)]
+        response = self.get_response(StreamingHttpResponse(iter(chunks), content_type='application/json'), 'br')
+        self.assertEqual(response['Content-Encoding'], 'br')
+        self.assertEqual(brotli.decompress(b''.join(response.streaming_content)), self.content)
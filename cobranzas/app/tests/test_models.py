@@ -1,16 +1,22 @@
 import datetime
+import io
 import time
 
 from mixer.backend.django import mixer
 
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.db import connection
 from django.db.models.signals import post_save
 from django.db.models.signals import pre_save
 from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 
 from app.models import User, Customer, Product, Sale, SaleInstallment, SaleProduct
-from app.models import SaleInstallment, LoginLog, KeyValueStore
+from app.models import SaleInstallment, CustomerBalance, SaleAging, LoginLog, KeyValueStore, SyncTombstone
 from app.signals import preSave_Sale, postSave_Sale, update_sync_value
+from app.tests.mixins import ReceiversMixin
 
 
 class UserModelTest(TestCase):
@@ -81,6 +87,9 @@ class SaleModelTest(TestCase):
         self.today = timezone.make_aware(datetime.datetime.today(), tz, True)
         self.sale = mixer.blend(Sale, id=1, date=self.today, customer=customer, price=10000.00, sale_date=self.today)
         sale_installment = mixer.blend(SaleInstallment, sale=self.sale, installment_amount=10000.00, paid_amount=2000.00)
+        # Paid amount and pending balance are updated by the collection write paths
+        Sale.update_balances([self.sale.pk])
+        self.sale.refresh_from_db()
 
     def test_sale_instance(self):
         self.assertTrue(isinstance(self.sale, Sale))
@@ -95,6 +104,164 @@ class SaleModelTest(TestCase):
     def test_sale_pending_balance(self):
         self.assertEqual(self.sale.pending_balance, 8000.00)
 
+    def test_sale_save_updates_pending_balance(self):
+        self.sale.price = 12000.00
+        self.sale.save()
+        self.sale.refresh_from_db()
+        self.assertEqual(self.sale.pending_balance, 10000.00)
+
+    def test_sale_save_keeps_stored_paid_amount(self):
+        # A payment applied after the sale was loaded
+        Sale.objects.filter(pk=self.sale.pk).update(paid_amount=3000.00, pending_balance=7000.00)
+        self.sale.remarks = 'Changed'
+        self.sale.save()
+        self.assertEqual((self.sale.paid_amount, self.sale.pending_balance), (3000.00, 7000.00))
+        self.sale.price = 12000.00
+        self.sale.save(update_fields=['price'])
+        self.sale.refresh_from_db()
+        self.assertEqual((self.sale.remarks, self.sale.paid_amount, self.sale.pending_balance), ('Changed', 3000.00, 9000.00))
+
+    def test_sale_update_balances(self):
+        SaleInstallment.objects.filter(sale=self.sale).update(paid_amount=5000.00)
+        self.assertEqual(Sale.update_balances([self.sale.pk]), 1)
+        self.sale.refresh_from_db()
+        self.assertEqual(self.sale.paid_amount, 5000.00)
+        self.assertEqual(self.sale.pending_balance, 5000.00)
+
+    def test_rebuild_sale_balances_command(self):
+        Sale.objects.filter(pk=self.sale.pk).update(paid_amount=0.0, pending_balance=0.0)
+        call_command('rebuild_sale_balances', stdout=io.StringIO())
+        self.sale.refresh_from_db()
+        self.assertEqual(self.sale.paid_amount, 2000.00)
+        self.assertEqual(self.sale.pending_balance, 8000.00)
+
+    def test_sale_update_balances_without_installments(self):
+        SaleInstallment.objects.filter(sale=self.sale).delete()
+        Sale.update_balances([self.sale.pk])
+        self.sale.refresh_from_db()
+        self.assertEqual(self.sale.paid_amount, 0.0)
+        self.assertEqual(self.sale.pending_balance, 10000.00)
+
+
+class SaleDueDateTest(ReceiversMixin, TestCase):
+
+    def setUp(self):
+        # Disconnect Signals, they are called by the tests
+        self.set_receivers(disconnected=[preSave_Sale, postSave_Sale])
+
+        sale_date = timezone.make_aware(datetime.datetime(2026, 1, 31, 10, 0))
+        self.sale = mixer.blend(Sale, price=3000, installment_amount=1000, installments=3, sale_date=sale_date, payment_frequency=Sale.MONTHLY)
+        postSave_Sale(Sale, self.sale, created=True)
+
+    def get_due_dates(self):
+        return list(SaleInstallment.objects.filter(sale=self.sale).order_by('installment').values_list('due_date', flat=True))
+
+    def test_installments_due_dates(self):
+        self.assertEqual(self.get_due_dates(), [datetime.date(2026, 2, 28), datetime.date(2026, 3, 31), datetime.date(2026, 4, 30)])
+
+    def test_get_due_date(self):
+        self.sale.payment_frequency = Sale.WEEKLY
+        self.assertEqual(self.sale.get_due_date(2), datetime.date(2026, 2, 14))
+        self.sale.payment_frequency = Sale.BIWEEKLY
+        self.assertEqual(self.sale.get_due_date(2), datetime.date(2026, 2, 28))
+        # The sale forms set a date
+        self.sale.sale_date = datetime.date(2026, 3, 1)
+        self.assertEqual(self.sale.get_due_date(1), datetime.date(2026, 3, 15))
+
+    def test_due_dates_follow_the_payment_frequency(self):
+        self.sale.payment_frequency = Sale.WEEKLY
+        preSave_Sale(Sale, self.sale)
+        self.sale.save()
+        postSave_Sale(Sale, self.sale, created=False)
+        self.assertEqual(self.get_due_dates(), [datetime.date(2026, 2, 7), datetime.date(2026, 2, 14), datetime.date(2026, 2, 21)])
+
+    def test_overdue(self):
+        SaleInstallment.objects.filter(sale=self.sale, installment=1).update(status=SaleInstallment.PAID)
+        overdue = SaleInstallment.objects.overdue(datetime.date(2026, 4, 1))
+        self.assertEqual([i.installment for i in overdue], [2])
+        self.assertEqual(SaleInstallment.objects.filter(sale=self.sale).overdue(datetime.date(2026, 2, 28)).count(), 0)
+
+
+class SaleChangesTest(ReceiversMixin, TestCase):
+
+    def setUp(self):
+        # Disconnect Signals, they are called by the tests
+        self.set_receivers(disconnected=[preSave_Sale, postSave_Sale])
+
+        sale_date = timezone.make_aware(datetime.datetime(2026, 1, 31, 10, 0))
+        sale = mixer.blend(Sale, price=3000, installment_amount=1000, installments=3, sale_date=sale_date, payment_frequency=Sale.MONTHLY)
+        postSave_Sale(Sale, sale, created=True)
+        self.sale = Sale.objects.get(pk=sale.pk)
+        self.installments = self.get_installments()
+
+    def get_installments(self):
+        return list(SaleInstallment.objects.filter(sale=self.sale).order_by('installment').values_list('pk', 'installment_amount'))
+
+    def save(self):
+        preSave_Sale(Sale, self.sale)
+        self.sale.save()
+        postSave_Sale(Sale, self.sale, created=False)
+
+    def test_original_values_are_tracked(self):
+        self.sale.price = 4000
+        self.sale.remarks = 'Changed'
+        with CaptureQueriesContext(connection) as context:
+            preSave_Sale(Sale, self.sale)
+        # Discard queries of the profiler, that explains the queries of the previous request
+        self.assertEqual(len([q for q in context.captured_queries if not q['sql'].startswith('EXPLAIN')]), 0)
+        self.assertEqual(getattr(self.sale, '__original_object').price, 3000)
+
+    def test_saved_values_are_tracked(self):
+        self.sale.price = 4000
+        self.sale.save()
+        self.assertEqual(self.sale.get_original().price, 4000)
+
+    def test_original_is_queried_if_not_loaded(self):
+        sale = Sale.objects.only('pk', 'remarks').get(pk=self.sale.pk)
+        self.assertIsNone(sale.get_original())
+        with CaptureQueriesContext(connection) as context:
+            preSave_Sale(Sale, sale)
+        # Discard queries of the profiler, that explains the queries of the previous request
+        self.assertEqual(len([q for q in context.captured_queries if not q['sql'].startswith('EXPLAIN')]), 1)
+
+    def test_added_installments(self):
+        self.sale.price = 5000
+        self.sale.installments = 5
+        self.save()
+        installments = self.get_installments()
+        # The existing installments are kept
+        self.assertEqual(installments[:3], self.installments)
+        self.assertEqual([amount for pk, amount in installments], [1000] * 5)
+
+    def test_removed_installments(self):
+        self.sale.price = 2500
+        self.sale.installments = 2
+        self.sale.installment_amount = 1250
+        self.save()
+        installments = self.get_installments()
+        self.assertEqual([pk for pk, amount in installments], [pk for pk, amount in self.installments[:2]])
+        self.assertEqual([amount for pk, amount in installments], [1250, 1250])
+
+    def test_installments_of_the_plan(self):
+        # The sale has the installments of the plan of its price and installment amount
+        self.sale.price = 4000
+        self.sale.installments = 3
+        self.save()
+        self.assertEqual(len(self.get_installments()), 4)
+        self.assertEqual(self.sale.installments, 4)
+        self.assertEqual(Sale.objects.get(pk=self.sale.pk).installments, 4)
+
+    def test_clean_max_installments(self):
+        self.sale.installment_amount = 1
+        with self.assertRaises(ValidationError):
+            self.sale.clean()
+
+    def test_unchanged_installments_are_not_updated(self):
+        self.sale.remarks = 'Changed'
+        with CaptureQueriesContext(connection) as context:
+            self.save()
+        self.assertFalse([q for q in context.captured_queries if 'app_saleinstallment' in q['sql']])
+
 
 class SaleProductModelTest(TestCase):
 
@@ -143,6 +310,124 @@ class SaleInstallmentModelTest(TestCase):
         self.assertEqual(str(self.sale_installment), '1 - 100')
 
 
+class CustomerBalanceModelTest(ReceiversMixin, TestCase):
+
+    def setUp(self):
+        # Disconnect Signals
+        self.set_receivers(disconnected=[preSave_Sale, postSave_Sale])
+
+        tz = timezone.get_current_timezone()
+        today = timezone.make_aware(datetime.datetime.today(), tz, True)
+        self.collector = mixer.blend(User, is_collector=True)
+        self.customer = mixer.blend(Customer, name='Luciano', city='ARR', collector=self.collector)
+        # Pending, uncollectible and paid sales
+        for price, paid_amount, uncollectible in [(1000, 200, False), (3000, 0, False), (500, 0, True), (800, 800, False)]:
+            sale = mixer.blend(Sale, customer=self.customer, price=price, installments=1, uncollectible=uncollectible, sale_date=today)
+            status = SaleInstallment.PAID if paid_amount == price else SaleInstallment.PENDING
+            mixer.blend(SaleInstallment, sale=sale, installment=1, installment_amount=price, paid_amount=paid_amount, status=status)
+        Sale.update_balances()
+        CustomerBalance.update_balances([self.customer.pk])
+        self.balance = CustomerBalance.objects.get(customer=self.customer)
+
+    def test_customerbalance_str(self):
+        self.assertEqual(str(self.balance), f'{self.customer.pk} - None - 3800.0')
+
+    def test_update_balances(self):
+        self.assertEqual(self.balance.sales, 2)
+        self.assertEqual(self.balance.price, 4000.00)
+        self.assertEqual(self.balance.paid_amount, 200.00)
+        self.assertEqual(self.balance.pending_balance, 3800.00)
+        self.assertEqual(self.balance.city, 'ARR')
+        self.assertEqual(self.balance.collector, self.collector)
+
+    def test_balance_for_each_sale_collector(self):
+        collector = mixer.blend(User, is_collector=True)
+        Sale.objects.filter(customer=self.customer, price=3000).update(collector=collector)
+        self.assertEqual(CustomerBalance.update_balances([self.customer.pk]), 1)
+        # The row of the customer has every sale, and the row of the other collector its sales
+        balances = CustomerBalance.objects.filter(customer=self.customer).order_by('pending_balance')
+        self.assertEqual([(b.sale_collector, b.collector, b.sales, b.pending_balance) for b in balances], [
+            (collector, self.collector, 1, 3000.00),
+            (None, self.collector, 2, 3800.00),
+        ])
+        # The sales of the collector of the customer are only in the row of the customer
+        Sale.objects.filter(customer=self.customer).update(collector=self.collector)
+        CustomerBalance.update_balances([self.customer.pk])
+        self.assertEqual(list(CustomerBalance.objects.filter(customer=self.customer).values_list('sale_collector', flat=True)), [None])
+
+    def test_customer_without_pending_sales_is_removed(self):
+        SaleInstallment.objects.filter(sale__customer=self.customer).update(status=SaleInstallment.PAID)
+        self.assertEqual(CustomerBalance.update_balances([self.customer.pk]), 0)
+        self.assertFalse(CustomerBalance.objects.filter(customer=self.customer).exists())
+
+    def test_customer_changes_are_copied(self):
+        collector = mixer.blend(User, is_collector=True)
+        self.customer.city = 'SAL'
+        self.customer.collector = collector
+        self.customer.save()
+        # The rows are created again
+        self.balance = CustomerBalance.objects.get(customer=self.customer)
+        self.assertEqual(self.balance.city, 'SAL')
+        self.assertEqual(self.balance.collector, collector)
+
+    def test_rebuild_customer_balances_command(self):
+        CustomerBalance.objects.all().delete()
+        call_command('rebuild_customer_balances', stdout=io.StringIO())
+        self.assertEqual(CustomerBalance.objects.get(customer=self.customer).pending_balance, 3800.00)
+
+
+class SaleAgingModelTest(ReceiversMixin, TestCase):
+
+    def setUp(self):
+        # Disconnect Signals
+        self.set_receivers(disconnected=[preSave_Sale, postSave_Sale])
+
+        self.now = timezone.now()
+        customer = mixer.blend(Customer, name='Luciano')
+        self.sales = []
+        # Pending sales of 3, 10, 20 and 40 days, a paid sale and an uncollectible sale
+        for days, status, uncollectible in [(3, 'PENDING', False), (10, 'PENDING', False), (20, 'PARTIAL', False), (40, 'PENDING', False), (40, 'PAID', False), (40, 'PENDING', True)]:
+            sale = mixer.blend(Sale, customer=customer, price=1000, installments=2, uncollectible=uncollectible, sale_date=self.now - datetime.timedelta(days=days))
+            mixer.blend(SaleInstallment, sale=sale, installment=1, installment_amount=500, paid_amount=500 if status == 'PAID' else 0, status=status)
+            mixer.blend(SaleInstallment, sale=sale, installment=2, installment_amount=500, paid_amount=500 if status == 'PAID' else 0, status=status)
+            self.sales.append(sale)
+        SaleAging.update_sales()
+
+    def get_qualifications(self):
+        return list(SaleAging.objects.order_by('since').values_list('qualification', flat=True))
+
+    def test_saleaging_str(self):
+        self.assertEqual(str(SaleAging.objects.get(sale=self.sales[0])), f'{self.sales[0].pk} - 0')
+
+    def test_update_sales(self):
+        self.assertEqual(self.get_qualifications(), [30, 15, 7, 0])
+        aging = SaleAging.objects.get(sale=self.sales[2])
+        self.assertEqual(aging.pending_installments, 2)
+        self.assertIsNone(aging.last_payment_date)
+        self.assertEqual(aging.since, self.sales[2].sale_date)
+
+    def test_get_qualification(self):
+        self.assertEqual(SaleAging.get_qualification(self.now - datetime.timedelta(days=7, hours=23), self.now), 0)
+        self.assertEqual(SaleAging.get_qualification(self.now - datetime.timedelta(days=8), self.now), 7)
+        self.assertEqual(SaleAging.get_qualification(self.now - datetime.timedelta(days=31), self.now), 30)
+
+    def test_paid_sale_is_removed(self):
+        SaleInstallment.objects.filter(sale=self.sales[0]).update(status=SaleInstallment.PAID)
+        SaleAging.update_sales([self.sales[0].pk])
+        self.assertFalse(SaleAging.objects.filter(sale=self.sales[0]).exists())
+
+    def test_update_buckets(self):
+        # Only the sales that reached a new bucket are moved
+        self.assertEqual(SaleAging.update_buckets(self.now + datetime.timedelta(days=6)), 2)
+        self.assertEqual(self.get_qualifications(), [30, 15, 15, 7])
+        self.assertEqual(SaleAging.update_buckets(self.now + datetime.timedelta(days=6)), 0)
+
+    def test_rebuild_sale_aging_command(self):
+        SaleAging.objects.all().delete()
+        call_command('rebuild_sale_aging', stdout=io.StringIO())
+        self.assertEqual(self.get_qualifications(), [30, 15, 7, 0])
+
+
 class LoginLogModelTest(TestCase):
 
     def setUp(self):
@@ -170,3 +455,42 @@ class KeyValueStoreModelTest(TestCase):
 
     def test_key_not_exists(self):
         self.assertIsNone(self.keyvalue_object.get('mykey'))
+
+    def test_set_updates_the_key(self):
+        KeyValueStore.set('sync', 1)
+        KeyValueStore.set('sync', 2)
+        self.assertEqual(KeyValueStore.objects.filter(key='sync').count(), 1)
+        self.assertEqual(KeyValueStore.get('sync'), 2)
+
+    def test_update_sync(self):
+        collector = User.objects.create_user(username='laura', email='test2@test.com', password='mypassword', is_collector=True)
+        other_collector = User.objects.create_user(username='jose', email='test3@test.com', password='mypassword', is_collector=True)
+        admin = User.objects.create_user(username='luciano', email='test@test.com', password='mypassword', is_staff=True)
+        # Until its data changes a collector uses the global version
+        self.assertEqual(KeyValueStore.get_sync(collector), self.time)
+
+        KeyValueStore.update_sync([collector.pk, None])
+        version = KeyValueStore.get('sync')
+        self.assertEqual(KeyValueStore.get(KeyValueStore.sync_key(collector.pk)), version)
+        self.assertEqual(KeyValueStore.get_sync(collector), version)
+        self.assertEqual(KeyValueStore.get_sync(admin), version)
+
+        KeyValueStore.update_sync([other_collector.pk])
+        self.assertEqual(KeyValueStore.get_sync(collector), version)
+        self.assertNotEqual(KeyValueStore.get_sync(admin), version)
+
+
+class SyncTombstoneModelTest(TestCase):
+
+    def setUp(self):
+        self.collector = User.objects.create_user(username='laura', email='test2@test.com', password='mypassword', is_collector=True)
+        now = timezone.now()
+        for days in [0, 29, 31]:
+            SyncTombstone.objects.create(collector=self.collector, customer_id=days, date=now - datetime.timedelta(days=days))
+
+    def test_synctombstone_str(self):
+        self.assertEqual(str(SyncTombstone.objects.get(customer_id=0)), f'{self.collector.pk} - 0')
+
+    def test_prune_sync_tombstones_command(self):
+        call_command('prune_sync_tombstones', stdout=io.StringIO())
+        self.assertEqual(sorted(SyncTombstone.objects.values_list('customer_id', flat=True)), [0, 29])
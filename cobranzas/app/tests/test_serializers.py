@@ -0,0 +1,81 @@
+from datetime import datetime
+
+from django.db import connection
+from django.db.models import Q, F, Count, Prefetch
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+
+from app.models import User, Customer, Product, Sale, SaleInstallment, SaleProduct
+from app.serializers import SalesByCustomerSerializer, SalesByCustomerValuesSerializer
+from app.signals import preSave_Sale, postSave_Sale
+from app.tests.mixins import ReceiversMixin
+
+
+class TestSalesByCustomerValuesSerializer(ReceiversMixin, TestCase):
+
+    def setUp(self):
+        # Disconnect Signals
+        self.set_receivers(disconnected=[preSave_Sale, postSave_Sale])
+
+        tz = timezone.get_current_timezone()
+        today = timezone.make_aware(datetime.today(), tz, True)
+        admin = User.objects.create_user(username='luciano', email='test@test.com', password='mypassword', is_staff=True)
+        collector = User.objects.create_user(username='laura', email='test2@test.com', password='mypassword', is_collector=True)
+        products = [
+            Product.objects.create(name='Heladera', brand='Gafa', price=1000),
+            Product.objects.create(name='Lavarropas', brand='Drean', price=800),
+        ]
+        customers = [
+            Customer.objects.create(name='Autoservicio Marcos', city='ARR', collector=collector),
+            Customer.objects.create(name='Jose Luis', city='SAL', collector=collector),
+            # Customer without sales
+            Customer.objects.create(name='Maria', city='DUG', collector=collector),
+        ]
+        for i, (customer, uncollectible) in enumerate([(customers[0], False), (customers[0], False), (customers[1], False), (customers[1], True)]):
+            sale = Sale.objects.create(
+                user=admin,
+                customer=customer,
+                price=1500,
+                installment_amount=500,
+                installments=3,
+                collector=collector,
+                sale_date=today,
+                remarks=f'Sale {i}',
+                uncollectible=uncollectible
+            )
+            for product in products[:i % 2 + 1]:
+                SaleProduct.objects.create(sale=sale, product=product, price=product.price)
+            SaleInstallment.objects.create(sale=sale, installment=1, installment_amount=500, paid_amount=500, status=SaleInstallment.PAID)
+            SaleInstallment.objects.create(sale=sale, installment=2, installment_amount=500, paid_amount=200, status=SaleInstallment.PARTIAL, due_date=today.date())
+            SaleInstallment.objects.create(sale=sale, installment=3, installment_amount=500)
+        # Paid sale
+        sale = Sale.objects.create(user=admin, customer=customers[1], price=500, installment_amount=500, installments=1, sale_date=today)
+        SaleInstallment.objects.create(sale=sale, installment=1, installment_amount=500, paid_amount=500, status=SaleInstallment.PAID)
+        Sale.update_balances()
+
+        self.customers = Customer.objects.order_by('pk')
+        self.sales = Sale.objects.\
+            filter(uncollectible=False).\
+            annotate(paid_installments=Count('saleinstallment__pk', filter=Q(saleinstallment__status='PAID'))).\
+            exclude(installments__lte=F('paid_installments')).\
+            order_by('-id')
+        self.installments = SaleInstallment.objects.filter(~Q(status='PAID')).order_by('installment')
+
+    def test_same_output_as_model_serializer(self):
+        customers = self.customers.prefetch_related(
+            Prefetch('sale_set', queryset=self.sales.prefetch_related(
+                Prefetch('saleinstallment_set', queryset=self.installments)
+            ))
+        )
+        expected = JSONRenderer().render(SalesByCustomerSerializer(customers, many=True).data)
+        data = SalesByCustomerValuesSerializer(self.customers, self.sales, self.installments).data
+        self.assertEqual(JSONRenderer().render(data), expected)
+
+    def test_queries_do_not_depend_on_sales(self):
+        with CaptureQueriesContext(connection) as context:
+            data = SalesByCustomerValuesSerializer(self.customers, self.sales, self.installments).data
+        # Discard queries of the profiler, that explains the queries of the previous request
+        self.assertEqual(len([q for q in context.captured_queries if not q['sql'].startswith('EXPLAIN')]), 4)
+        self.assertEqual(sum(len(customer['sale_set']) for customer in data), 3)
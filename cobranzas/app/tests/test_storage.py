@@ -0,0 +1,41 @@
+import gzip
+import tempfile
+
+import brotli
+
+from django.core.files.base import ContentFile
+from django.test import TestCase
+
+from app.storage import CompressedStaticFilesStorage
+
+
+class TestCompressedStaticFilesStorage(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.storage = CompressedStaticFilesStorage(location=self.directory.name)
+        self.content = b'const sync = () => {};\n' * 100
+        self.storage.save('js/sync.js', ContentFile(self.content))
+        self.storage.save('img/icon.png', ContentFile(b'PNG'))
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_post_process(self):
+        processed = list(self.storage.post_process({'js/sync.js': None, 'img/icon.png': None}))
+        self.assertEqual(processed, [('js/sync.js', 'js/sync.js', True)])
+        with self.storage.open('js/sync.js.gz') as compressed:
+            self.assertEqual(gzip.decompress(compressed.read()), self.content)
+        with self.storage.open('js/sync.js.br') as compressed:
+            self.assertEqual(brotli.decompress(compressed.read()), self.content)
+        self.assertFalse(self.storage.exists('img/icon.png.gz'))
+
+    def test_post_process_again(self):
+        list(self.storage.post_process({'js/sync.js': None}))
+        list(self.storage.post_process({'js/sync.js': None}))
+        self.assertEqual(sorted(self.storage.listdir('js')[1]), ['sync.js', 'sync.js.br', 'sync.js.gz'])
+
+    def test_dry_run(self):
+        self.assertEqual(list(self.storage.post_process({'js/sync.js': None}, dry_run=True)), [])
+        self.assertFalse(self.storage.exists('js/sync.js.gz'))
+        self.assertFalse(self.storage.exists('js/sync.js.br'))
@@ -1,4 +1,5 @@
-from datetime import datetime, time
+from datetime import datetime, time, timedelta
+from unittest import mock
 
 from mixer.backend.django import mixer
 
@@ -6,14 +7,17 @@ from django.conf import settings
 from django.core.exceptions import ValidationError, PermissionDenied
 from django.db.models import Q
 from django.forms.formsets import BaseFormSet
+from django.db import connection
 from django.test import TestCase, RequestFactory
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django.utils import timezone, dateformat
 
-from app.models import User, Customer, Product, Sale, SaleInstallment, SaleProduct
+from app.models import User, Customer, CustomerBalance, Product, Sale, SaleAging, SaleInstallment, SaleProduct
+from app.tests.mixins import ReceiversMixin
 from app.views import LoginView, UserCreationView, UserListView, CustomerCreationView, CustomerUpdateView, CustomerListView
 from app.views import ProductCreationView, ProductUpdateView, ProductListView, SaleCreationView, SaleUpdateView
-from app.views import SaleListView, FilterSetView
+from app.views import SaleListView, FilterSetView, PendingBalanceListView, DefaultersListView
 from app.forms import CustomAuthenticationForm, CustomUserCreationForm, CustomerCreationForm, CustomerFilterForm
 from app.forms import ProductCreationForm, ProductFilterForm, SaleCreationForm, SaleWithPaymentsUpdateForm, SaleFilterForm
 
@@ -66,6 +70,11 @@ class TestFilterSetView(RequestFactoryMixin, TestCase):
         filters = self.filterset.get_filters(request)
         self.assertEqual(filters, Q(date__gte=from_value, date__lte=to_value))
 
+    def test_get_totals(self):
+        self.filterset.totals = {'total': 'pending_balance', 'price': 'price'}
+        self.filterset.object_list = [{'pending_balance': 100, 'price': 300}, {'pending_balance': None, 'price': 200}]
+        self.assertEqual(self.filterset.get_totals(), {'total': 100, 'price': 500})
+
 
 class TestHomeView(TestCase):
 
@@ -624,6 +633,38 @@ class TestSaleCreationView(RequestFactoryMixin, TestCase):
         self.assertIsInstance(context['products'], BaseFormSet)
 
 
+class TestInstallmentPlanView(TestCase):
+
+    def setUp(self):
+        User.objects.create_user(username='luciano', email='test@test.com', password='mypassword', is_staff=True)
+        User.objects.create_user(username='laura', email='test2@test.com', password='mypassword', is_collector=True)
+        self.client.login(username='luciano', password='mypassword')
+
+    def test_admin_required(self):
+        self.client.login(username='laura', password='mypassword')
+        response = self.client.get(reverse('installment-plan') + '?price=1000&installments=3')
+        self.assertEqual(response.status_code, 403)
+
+    def test_plan_from_installments(self):
+        response = self.client.get(reverse('installment-plan') + '?price=1000&installments=3')
+        self.assertEqual(response.json(), {
+            'installments': 3,
+            'installment_amount': 333.33,
+            'scheme': [{'installments': 2, 'installment_amount': 333.33}, {'installments': 1, 'installment_amount': 333.34}],
+        })
+
+    def test_plan_from_installment_amount(self):
+        response = self.client.get(reverse('installment-plan') + '?price=1000&installment_amount=350')
+        self.assertEqual(response.json()['installments'], 3)
+        self.assertEqual(response.json()['scheme'][1], {'installments': 1, 'installment_amount': 300})
+
+    def test_invalid_plan(self):
+        for query in ['', '?price=1000', '?price=abc&installments=3', '?price=1000&installments=0', '?price=inf&installment_amount=10',
+                      '?price=-1000&installments=3', '?price=1000&installments=1000', '?price=1e12&installment_amount=1']:
+            response = self.client.get(reverse('installment-plan') + query)
+            self.assertEqual(response.status_code, 400)
+
+
 class TestSaleUpdateView(RequestFactoryMixin, TestCase):
 
     def setUp(self):
@@ -659,6 +700,8 @@ class TestSaleUpdateView(RequestFactoryMixin, TestCase):
             paid_amount=200,
             status=SaleInstallment.PARTIAL
         )
+        Sale.update_balances([self.sale_with_payments.pk])
+        self.sale_with_payments.refresh_from_db()
         self.sale_without_payments = mixer.blend(
             Sale,
             id=2,
@@ -890,3 +933,173 @@ class TestSaleListView(RequestFactoryMixin, TestCase):
         context = view.get_context_data()
         self.assertEqual(len(context['object_list']), 1)
         self.assertIn(self.sale_2, context['object_list'])
+
+    def test_sales_query_runs_once(self):
+        self.client.login(username='luciano', password='mypassword')
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(reverse('list-sales'))
+        queries = [q['sql'] for q in context.captured_queries if not q['sql'].startswith('EXPLAIN') and 'silk_' not in q['sql']]
+        self.assertEqual(len([q for q in queries if 'products_quantity' in q]), 1)
+        self.assertEqual(len(response.context['sales']), 2)
+
+
+class TestPendingBalanceListView(ReceiversMixin, TestCase):
+
+    def setUp(self):
+        self.set_receivers()
+
+        tz = timezone.get_current_timezone()
+        today = timezone.make_aware(datetime.today(), tz, True)
+        admin = User.objects.create_user(username='luciano', email='test@test.com', password='mypassword', is_staff=True)
+        for name, price, paid_amount in [('Autoservicio Marcos', 1000, 200), ('Jose Luis', 2000, 500)]:
+            sale = Sale.objects.create(
+                user=admin,
+                customer=mixer.blend(Customer, name=name, city='ARR'),
+                price=price,
+                installment_amount=price,
+                installments=1,
+                sale_date=today
+            )
+            SaleInstallment.objects.filter(sale=sale).delete()
+            SaleInstallment.objects.create(sale=sale, installment=1, installment_amount=price, paid_amount=paid_amount, status=SaleInstallment.PARTIAL)
+        Sale.update_balances()
+        CustomerBalance.update_balances()
+        self.client.login(username='luciano', password='mypassword')
+
+    def test_total(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(reverse('list-pending-balance'))
+        self.assertEqual(response.context['total'], {'total': 2300})
+        self.assertEqual([row['pending_balance'] for row in response.context['pending_balance']], [1500, 800])
+        # The query of the list runs once, for the list and the total
+        queries = [q['sql'] for q in context.captured_queries if not q['sql'].startswith('EXPLAIN') and 'silk_' not in q['sql']]
+        queries = [q for q in queries if '"pending_balance"' in q]
+        self.assertEqual(len(queries), 1)
+        # The rows are read from the table, without grouping them
+        self.assertNotIn('GROUP BY', queries[0])
+
+    def test_filters(self):
+        customer = Customer.objects.get(name='Jose Luis')
+        Customer.objects.filter(pk=customer.pk).update(city='SAL')
+        CustomerBalance.update_balances([customer.pk])
+        response = self.client.get(reverse('list-pending-balance') + '?city=SAL')
+        self.assertEqual([row['customer__name'] for row in response.context['pending_balance']], ['Jose Luis'])
+        response = self.client.get(reverse('list-pending-balance') + f'?collector={customer.collector_id}')
+        self.assertEqual([row['customer__id'] for row in response.context['pending_balance']], [customer.pk])
+
+    def test_collector_filter_includes_sales_of_the_collector(self):
+        # As the collector of the customer, or of the sales: only its sales are included
+        customer = Customer.objects.get(name='Jose Luis')
+        collector = Customer.objects.get(name='Autoservicio Marcos').collector
+        sale = Sale.objects.create(
+            user=collector,
+            customer=customer,
+            price=3000,
+            installment_amount=3000,
+            installments=1,
+            collector=collector,
+            sale_date=timezone.now()
+        )
+        Sale.update_balances([sale.pk])
+        CustomerBalance.update_balances([customer.pk])
+
+        response = self.client.get(reverse('list-pending-balance') + f'?collector={collector.pk}')
+        rows = {row['customer__name']: row['pending_balance'] for row in response.context['pending_balance']}
+        self.assertEqual(rows, {'Jose Luis': 3000, 'Autoservicio Marcos': 800})
+        self.assertEqual(response.context['total'], {'total': 3800})
+
+        response = self.client.get(reverse('list-pending-balance'))
+        rows = {row['customer__name']: row['pending_balance'] for row in response.context['pending_balance']}
+        self.assertEqual(rows, {'Jose Luis': 4500, 'Autoservicio Marcos': 800})
+
+
+class TestKeysetPagination(ReceiversMixin, TestCase):
+
+    def setUp(self):
+        self.set_receivers()
+
+        tz = timezone.get_current_timezone()
+        self.today = timezone.make_aware(datetime.today(), tz, True)
+        self.admin = User.objects.create_user(username='luciano', email='test@test.com', password='mypassword', is_staff=True)
+        self.customers = [
+            mixer.blend(Customer, name=name, city='ARR', collector=self.admin)
+            for name in ['Andrea', 'Laura', 'Jose', 'Maria', 'Laura']
+        ]
+        self.client.login(username='luciano', password='mypassword')
+
+    def get_pages(self, url_name, query=''):
+        pages = []
+        url = reverse(url_name) + query
+        while url:
+            with CaptureQueriesContext(connection) as context:
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            queries = [q['sql'] for q in context.captured_queries if not q['sql'].startswith('EXPLAIN') and 'silk_' not in q['sql']]
+            self.assertFalse([q for q in queries if 'OFFSET' in q])
+            pages.append(response)
+            page = response.context['page_obj']
+            url = reverse(url_name) + page.next_url if page.has_next else None
+        return pages
+
+    def create_sale(self, customer, price, days):
+        sale = Sale.objects.create(
+            user=self.admin,
+            customer=customer,
+            price=price,
+            installment_amount=price,
+            installments=1,
+            sale_date=self.today - timedelta(days=days)
+        )
+        SaleInstallment.objects.filter(sale=sale).delete()
+        SaleInstallment.objects.create(sale=sale, installment=1, installment_amount=price)
+        return sale
+
+    def test_pages(self):
+        with mock.patch.object(CustomerListView, 'paginate_by', 2):
+            pages = self.get_pages('list-customers')
+        self.assertEqual([[c.name for c in page.context['customers']] for page in pages], [['Andrea', 'Jose'], ['Laura', 'Laura'], ['Maria']])
+        self.assertEqual([page.context['page_obj'].has_previous for page in pages], [False, True, True])
+        self.assertContains(pages[0], 'href="?after=')
+
+    def test_pages_keep_filters(self):
+        with mock.patch.object(CustomerListView, 'paginate_by', 1):
+            pages = self.get_pages('list-customers', '?name=a')
+        self.assertEqual([page.context['customers'][0].name for page in pages], ['Andrea', 'Laura', 'Laura', 'Maria'])
+        self.assertIn('name=a', pages[1].context['page_obj'].next_url)
+
+    def test_not_paginated(self):
+        response = self.client.get(reverse('list-customers'))
+        self.assertFalse(response.context['is_paginated'])
+        self.assertEqual(len(response.context['customers']), 5)
+        self.assertNotContains(response, 'pagination')
+
+    def test_invalid_cursor(self):
+        response = self.client.get(reverse('list-customers') + '?after=abc')
+        self.assertEqual(response.status_code, 404)
+
+    def test_pages_of_aggregated_report(self):
+        for i, customer in enumerate(self.customers):
+            self.create_sale(customer, 1000 * (i % 3 + 1), 1)
+        Sale.update_balances()
+        CustomerBalance.update_balances()
+        with mock.patch.object(PendingBalanceListView, 'paginate_by', 2):
+            pages = self.get_pages('list-pending-balance')
+        rows = [row for page in pages for row in page.context['pending_balance']]
+        self.assertEqual([row['pending_balance'] for row in rows], [3000, 2000, 2000, 1000, 1000])
+        self.assertEqual(len({row['customer__id'] for row in rows}), 5)
+        # Totals include every page
+        self.assertEqual([page.context['total']['total'] for page in pages], [9000, 9000, 9000])
+
+    def test_pages_of_defaulters(self):
+        for customer, days in zip(self.customers, [10, 20, 40, 12, 20]):
+            self.create_sale(customer, 1000, days)
+        SaleAging.update_sales()
+        with mock.patch.object(DefaultersListView, 'paginate_by', 2):
+            pages = self.get_pages('list-defaulters')
+        rows = [row for page in pages for row in page.context['defaulters']]
+        # The oldest debts of each bucket first
+        self.assertEqual([(row['qualification'], row['customer__name']) for row in rows], [
+            (30, 'Jose'), (15, 'Laura'), (15, 'Laura'), (7, 'Maria'), (7, 'Andrea')
+        ])
+        self.assertEqual([row['debt_days'] for row in rows], [40, 20, 20, 12, 10])
+
@@ -1,15 +1,17 @@
 from dateutil.relativedelta import relativedelta
 
+import base64
+import json
 from datetime import datetime, time
 from django.contrib import messages
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib.auth.views import LoginView
+from django.core.cache import caches
 from django.core.exceptions import PermissionDenied, ValidationError
 from django.db import transaction
-from django.db.models import Q, Count, F, Sum, Subquery, OuterRef, Max
-from django.db.models import Case, Value, When
-from django.db.models.functions import Coalesce, ExtractDay
-from django.http import HttpResponseRedirect
+from django.db.models import Q, Count, F, Sum, Max, Exists, OuterRef
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpResponseBadRequest, HttpResponseRedirect, Http404, JsonResponse
 from django.urls import reverse, reverse_lazy
 from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
@@ -23,7 +25,8 @@ from app.forms import SaleProductCreationForm, SaleWithPaymentsProductUpdateForm
 from app.forms import CustomerFilterForm, ProductFilterForm, SaleFilterForm
 from app.forms import CustomAuthenticationForm, PendingBalanceFilterForm, UncollectibleSalesFilterForm
 from app.forms import create_saleproduct_formset
-from app.models import User, Customer, Sale, Product, SaleProduct, SaleInstallment
+from app.installments import MAX_INSTALLMENTS, from_cents, get_installment_amount, get_installments, get_plan, get_scheme, to_cents
+from app.models import User, Customer, CustomerBalance, Sale, SaleAging, Product, SaleProduct, SaleInstallment, KeyValueStore
 from collection.models import CollectionInstallment
 
 from app.permissions import AdminPermission
@@ -32,11 +35,32 @@ from silk.profiling.profiler import silk_profile
 
 
 class FilterSetView:
+    # Totals of the listed objects, a dictionary with the name of each total and the summed field
+    totals = {}
 
     def __init__(self):
         # Filter set is a list of tuples containing (url_param, field, lookup_expression)
         self.filterset = []
 
+    def get_listed_objects(self):
+        '''
+        Return the objects listed by the view (self.object_list, built by ListView once per
+        request). The queryset is evaluated here and the template iterates over the same
+        queryset, so the query runs only once.
+        '''
+        return list(self.object_list)
+
+    def get_totals(self):
+        '''
+        Return the totals of the listed objects, summed from the objects already loaded instead
+        of running the query of the list again
+        '''
+        totals = {}
+        for name, field in self.totals.items():
+            values = (obj[field] if isinstance(obj, dict) else getattr(obj, field) for obj in self.get_listed_objects())
+            totals[name] = sum(value for value in values if value is not None)
+        return totals
+
     def get_filters(self, request):
         q_lookup = Q()
         filterset = self.filterset
@@ -62,8 +86,136 @@ class FilterSetView:
         return q_lookup
 
 
+class KeysetPage:
+    '''A page of a KeysetPaginationMixin view, used as "page_obj" in the templates'''
+
+    def __init__(self, object_list, has_previous, next_url, first_url):
+        self.object_list = object_list
+        self.has_previous = has_previous
+        self.has_next = next_url is not None
+        self.next_url = next_url
+        self.first_url = first_url
+
+
+class KeysetPaginationMixin:
+    '''
+    Paginate a ListView by its ordering (keyset pagination) instead of by offset: the cursor of
+    the next page ("after" param) has the values of the ordering fields of the last listed row,
+    and the page is the first rows after them. Every page costs the same as the first one,
+    whatever the number of previous rows. The other query params (the FilterSetView filters)
+    are kept in the links to the pages.
+    '''
+    paginate_by = 100
+    # Fields of the ordering of the list, prefixed with "-" if descending. The last one must
+    # be unique, so the rows after the cursor are always the same
+    keyset = ['-pk']
+    cursor_param = 'after'
+
+    def encode_cursor(self, row):
+        values = [row[field] if isinstance(row, dict) else self.get_keyset_value(row, field) for field in self.get_keyset_fields()]
+        # DjangoJSONEncoder truncates the microseconds, and the rows with the same date would be skipped
+        values = [value.isoformat() if isinstance(value, datetime) else value for value in values]
+        return base64.urlsafe_b64encode(json.dumps(values, cls=DjangoJSONEncoder).encode()).decode()
+
+    def decode_cursor(self, cursor):
+        try:
+            values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        except (ValueError, TypeError):
+            raise Http404(_('Invalid page'))
+        if not isinstance(values, list) or len(values) != len(self.keyset):
+            raise Http404(_('Invalid page'))
+        return values
+
+    def get_keyset_fields(self):
+        return [field.lstrip('-') for field in self.keyset]
+
+    def get_keyset_value(self, obj, field):
+        for attr in field.split('__'):
+            obj = getattr(obj, attr)
+        return obj
+
+    def get_keyset_filter(self, values):
+        '''
+        Return the filter of the rows after the cursor values: (a > x) or (a = x and b > y) ...,
+        with < instead of > for the descending fields
+        '''
+        q_filter = Q()
+        equal = Q()
+        for field, value in zip(self.keyset, values):
+            lookup = 'lt' if field.startswith('-') else 'gt'
+            field = field.lstrip('-')
+            q_filter |= equal & Q(**{f'{field}__{lookup}': value})
+            equal &= Q(**{field: value})
+        return q_filter
+
+    def paginate_queryset(self, queryset, page_size):
+        cursor = self.request.GET.get(self.cursor_param, None)
+        queryset = queryset.order_by(*self.keyset)
+        if cursor:
+            queryset = queryset.filter(self.get_keyset_filter(self.decode_cursor(cursor)))
+
+        # One more row to know if there is a next page
+        rows = list(queryset[:page_size + 1])
+        next_url = None
+        params = self.request.GET.copy()
+        params.pop(self.cursor_param, None)
+        first_url = f'?{params.urlencode()}'
+        if len(rows) > page_size:
+            rows = rows[:page_size]
+            params[self.cursor_param] = self.encode_cursor(rows[-1])
+            next_url = f'?{params.urlencode()}'
+
+        self.page = KeysetPage(rows, bool(cursor), next_url, first_url)
+        return None, self.page, rows, self.page.has_previous or self.page.has_next
+
+    def get_listed_objects(self):
+        # Only the rows of the page are loaded
+        return self.page.object_list
+
+    def get_totals(self):
+        # The totals of a list with more than one page include the rows of every page
+        if self.page.has_previous or self.page.has_next:
+            return self.object_list.aggregate(**{name: Sum(field) for name, field in self.totals.items()})
+        return super().get_totals()
+
+
 class ReceivableSalesView:
 
+    def get_customers_scope(self, user):
+        '''
+        Return a filter of the customers of a collector: those assigned to the collector, and those
+        with a pending sale whose collector is the collector. The sales are checked with an EXISTS
+        subquery, so the query doesn't grow with the number of sales.
+        '''
+        pending_sales = self.get_pending_sales(Q(customer=OuterRef('pk'), collector=user), ['pk'])
+        return Q(collector=user) | Q(Exists(pending_sales))
+
+    def get_collector_scope(self, user):
+        '''
+        Return the ids of the customers and of the pending sales of a collector, as a dictionary
+        with "customers" and "sales" sets, so checking the access to a customer or sale doesn't
+        run any query.
+        The sets are cached for each collector and version of its synchronized data. The version
+        changes with every change of its customers and sales (collector, uncollectible, payments),
+        so the cache is invalidated by the same signals that invalidate the synchronized data.
+        '''
+        # The version is read before the scope, so the scope is never older than its version
+        version = KeyValueStore.get_sync(user)
+        cache_key = f'collector-scope.{user.pk}.{version}'
+        scope = caches['sync'].get(cache_key) if version is not None else None
+        if scope is None:
+            # Every sale of the customers assigned to the collector, and the sales assigned to it
+            sales = self.get_pending_sales(Q(collector=user) | Q(customer__collector=user), ['pk'])
+            scope = {
+                'customers': set(Customer.objects.filter(self.get_customers_scope(user)).values_list('pk', flat=True)),
+                'sales': {sale['pk'] for sale in sales}
+            }
+            # Without a version the changes can't be detected
+            if version is not None:
+                caches['sync'].set(cache_key, scope)
+
+        return scope
+
     def get_customers_filter(self, customer):
         user = self.request.user
         # If user is admin get all sales
@@ -73,23 +225,29 @@ class ReceivableSalesView:
             else:
                 q_filter = Q()
         else:
-            # If user is not an admin, and customer is not None
+            # If user is not an admin get the customers of the current user
+            q_filter = self.get_customers_scope(user)
             if customer:
-                customer_record = Customer.objects.get(id=customer)
-                # If customer's collector is the current user then get all customer sales
-                # If customer's collector is not the current user then get all customer sales whose collector
-                # is the current user
-                if customer_record.collector == user:
-                    q_filter = Q(id=customer)
-                else:
-                    q_filter = Q(id=customer, sale__collector=user)
-            else:
-                # If customer is None then get sales of customers whose collector is the current user
-                # and get those whose collector is the current user but the customer collector is not the current user
-                q_filter = Q(collector=user) | Q(~Q(collector=user), sale__collector=user)
+                q_filter &= Q(id=customer)
 
         return q_filter
 
+    def get_sales_filter(self, customer):
+        '''
+        Return the filter of the sales of the customers returned by get_customers_filter
+        '''
+        user = self.request.user
+        # If user is admin get all sales
+        if user.is_admin:
+            return Q()
+        # If customer's collector is the current user then get all customer sales
+        # If customer's collector is not the current user then get all customer sales whose collector
+        # is the current user
+        if customer:
+            return Q(collector=user) | Q(customer__collector=user)
+        # If customer is None then get the sales whose collector is the current user
+        return Q(collector=user)
+
     def get_pending_sales(self, filters, fields):
         return Sale.objects.\
             filter(filters, uncollectible=False).\
@@ -154,9 +312,10 @@ class CustomerDeleteView(LoginRequiredMixin, AdminPermission, DeleteView):
             return HttpResponseRedirect(reverse('update-customer', kwargs={"pk": self.object.pk}))
 
 
-class CustomerListView(LoginRequiredMixin, ListView, FilterSetView):
+class CustomerListView(LoginRequiredMixin, KeysetPaginationMixin, ListView, FilterSetView):
     template_name = 'list_customers.html'
     context_object_name = 'customers'
+    keyset = ['name', 'pk']
     filterset = []
 
     def get_queryset(self):
@@ -219,9 +378,10 @@ class ProductDeleteView(LoginRequiredMixin, AdminPermission, DeleteView):
             return HttpResponseRedirect(reverse('update-product', kwargs={"pk": self.object.pk}))
 
 
-class ProductListView(LoginRequiredMixin, AdminPermission, ListView, FilterSetView):
+class ProductListView(LoginRequiredMixin, AdminPermission, KeysetPaginationMixin, ListView, FilterSetView):
     template_name = 'list_products.html'
     context_object_name = 'products'
+    keyset = ['name', 'pk']
     filterset = [
         ('name', 'name', 'icontains'),
         ('brand', 'brand', 'iexact'),
@@ -305,26 +465,11 @@ class SaleUpdateView(LoginRequiredMixin, AdminPermission, UpdateView):
         context['products'] = create_saleproduct_formset(0, form=self.add_product_formset, data=self.request.POST or None, files=self.request.FILES or None, instance=self.object)
         context['add_product_button_disabled'] = self.add_product_button_disabled
 
-        calculated_price = self.object.installment_amount * self.object.installments
-        price = self.object.price
-        if calculated_price == price:
-            context['installments_scheme'] = [
-                {
-                    'installments': self.object.installments,
-                    'installment_amount': self.object.installment_amount
-                }
-            ]
-        else:
-            context['installments_scheme'] = [
-                {
-                    'installments': self.object.installments - 1,
-                    'installment_amount': self.object.installment_amount
-                },
-                {
-                    'installments': 1,
-                    'installment_amount': round(price - ((self.object.installments - 1) * self.object.installment_amount), 2)
-                }
-            ]
+        plan = get_plan(to_cents(self.object.price), to_cents(self.object.installment_amount), self.object.installments)
+        context['installments_scheme'] = [
+            {'installments': row['installments'], 'installment_amount': from_cents(row['installment_amount'])}
+            for row in get_scheme(plan)
+        ]
         return context
 
     def post(self, request, *args, **kwargs):
@@ -359,6 +504,39 @@ class SaleUpdateView(LoginRequiredMixin, AdminPermission, UpdateView):
         return super().form_valid(form)
 
 
+class InstallmentPlanView(LoginRequiredMixin, AdminPermission, View):
+    '''
+    Preview of the installments of a sale for the sale forms (create-sale.js), calculated from the
+    price and the number of installments, or from the price and the installment amount. They are
+    the same installments created when the sale is saved.
+    '''
+
+    def get(self, request, *args, **kwargs):
+        try:
+            price = to_cents(float(request.GET['price']))
+            if request.GET.get('installments'):
+                installments = int(request.GET['installments'])
+                installment_amount = get_installment_amount(price, installments)
+            else:
+                installment_amount = to_cents(float(request.GET['installment_amount']))
+                installments = get_installments(price, installment_amount)
+        except (KeyError, ValueError, OverflowError):
+            return HttpResponseBadRequest(_('Invalid installment plan'))
+        # The plan has a row for each installment
+        if installments > MAX_INSTALLMENTS:
+            return HttpResponseBadRequest(_('Invalid installment plan'))
+
+        plan = get_plan(price, installment_amount, installments)
+        return JsonResponse({
+            'installments': installments,
+            'installment_amount': from_cents(installment_amount),
+            'scheme': [
+                {'installments': row['installments'], 'installment_amount': from_cents(row['installment_amount'])}
+                for row in get_scheme(plan)
+            ],
+        })
+
+
 class SaleDeleteView(LoginRequiredMixin, AdminPermission, DeleteView):
     model = Sale
     success_url = reverse_lazy('list-sales')
@@ -374,9 +552,10 @@ class SaleDeleteView(LoginRequiredMixin, AdminPermission, DeleteView):
             return HttpResponseRedirect(reverse('update-sale', kwargs={"pk": self.object.pk}))
 
 
-class SaleListView(LoginRequiredMixin, AdminPermission, ListView, FilterSetView):
+class SaleListView(LoginRequiredMixin, AdminPermission, KeysetPaginationMixin, ListView, FilterSetView):
     template_name = 'list_sales.html'
     context_object_name = 'sales'
+    keyset = ['-pk']
     filterset = [
         ('id', 'pk', 'iexact'),
         ('customer', 'customer', 'exact'),
@@ -406,16 +585,19 @@ class SaleListView(LoginRequiredMixin, AdminPermission, ListView, FilterSetView)
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        queryset = self.get_queryset()
         context['filter_form'] = SaleFilterForm(self.request.GET)
 
-        # Get paid (totally or partially) installments ID
-        sale_installments = SaleInstallment.objects.\
-            filter(sale_id__in=Subquery(queryset.values('pk'))).\
-            filter(~Q(status='PENDING'))
+        # Get paid (totally or partially) installments ID, from the installments prefetched
+        # with the listed sales
+        sale_installments = [
+            installment.pk
+            for sale in self.get_listed_objects()
+            for installment in sale.saleinstallment_set.all()
+            if installment.status != SaleInstallment.PENDING
+        ]
         # Calculate last payment date for paid installments
         last_payment_list = CollectionInstallment.objects.\
-            filter(sale_installment__in=sale_installments.values('pk')).\
+            filter(sale_installment__in=sale_installments).\
             annotate(last_payment=Max('collection__date')).\
             values('sale_installment', 'last_payment')
         # Pass installment/payment_date to context as a dictionary
@@ -424,49 +606,43 @@ class SaleListView(LoginRequiredMixin, AdminPermission, ListView, FilterSetView)
         return context
 
 
-class PendingBalanceListView(LoginRequiredMixin, AdminPermission, ListView, FilterSetView, ReceivableSalesView):
+class PendingBalanceListView(LoginRequiredMixin, AdminPermission, KeysetPaginationMixin, ListView, FilterSetView):
     template_name = 'list_pending_balance.html'
     context_object_name = 'pending_balance'
+    keyset = ['-pending_balance', 'customer']
+    totals = {'total': 'pending_balance'}
     filterset = [
         ('customer', 'customer', 'exact'),
-        ('city', 'customer__city', 'exact')
+        ('city', 'city', 'exact'),
     ]
 
     def get_queryset(self):
         filters = self.get_filters(self.request)
 
+        # The receivables of a collector are those of its customers and of the sales assigned to it
         collector = self.request.GET.get('collector', None)
-        if collector:
-            filters = filters & (Q(customer__collector=collector) | Q(collector=collector))
+        filters = filters & CustomerBalance.get_collector_filter(collector or None)
 
-        sales_with_pending_balance = Sale.objects.\
+        # Receivables are kept up to date by the sale and collection write paths, with a row by
+        # customer for each filter, so the list is read in the order of the table index
+        queryset = CustomerBalance.objects.\
             filter(filters).\
-            filter(uncollectible=False).\
-            annotate(paid_installments=Count('saleinstallment__pk', filter=Q(saleinstallment__status='PAID'))).\
-            exclude(installments__lte=F('paid_installments'))
-        # OuterRef makes reference to a field from the parent subquuery
-        # OuterReg can be used only in a Subquery
-        paid_amount_sum = SaleInstallment.objects.filter(sale=OuterRef('pk')).values('sale').annotate(paid_amount_sum=Sum('paid_amount')).values('paid_amount_sum')
-        queryset = Sale.objects.\
-            filter(pk__in=Subquery(sales_with_pending_balance.values('pk'))).\
-            values('customer__id', 'customer__name', 'customer__city').\
-            annotate(price=Sum('price'), paid_amount=Sum(Subquery(paid_amount_sum))).\
-            annotate(pending_balance=F('price') - F('paid_amount')).\
-            order_by('-pending_balance')
+            values('customer', 'customer__id', 'customer__name', 'city', 'price', 'paid_amount', 'pending_balance').\
+            order_by('-pending_balance', 'customer')
 
         return queryset
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        queryset = self.get_queryset()
         context['filter_form'] = PendingBalanceFilterForm(self.request.GET)
-        context['total'] = queryset.aggregate(total=Sum('pending_balance'))
+        context['total'] = self.get_totals()
         return context
 
 
-class DefaultersListView(LoginRequiredMixin, AdminPermission, ListView, FilterSetView, ReceivableSalesView):
+class DefaultersListView(LoginRequiredMixin, AdminPermission, KeysetPaginationMixin, ListView, FilterSetView):
     template_name = 'list_defaulters.html'
     context_object_name = 'defaulters'
+    keyset = ['-qualification', 'since', 'sale_id']
     filterset = [
         ('customer', 'customer', 'exact'),
         ('city', 'customer__city', 'exact')
@@ -474,38 +650,43 @@ class DefaultersListView(LoginRequiredMixin, AdminPermission, ListView, FilterSe
 
     def get_queryset(self):
         filters = self.get_filters(self.request)
-        tz = timezone.get_current_timezone()
-        today_date = timezone.make_aware(datetime.today(), tz, True)
 
-        queryset = Sale.objects.\
+        # The aging of the sales is kept up to date by the sale and collection write paths, and
+        # the buckets (qualification) by the nightly update_aging_buckets command. The list is
+        # ordered by the columns of the table index: the oldest debts of each bucket first
+        queryset = SaleAging.objects.\
             filter(filters).\
-            filter(uncollectible=False).\
-            values('customer__id', 'customer__name', 'customer__city', 'id', 'sale_date', 'remarks').\
-            annotate(paid_installments=Count('saleinstallment__pk', filter=Q(saleinstallment__status='PAID'))).\
-            annotate(pending_installments=Count('saleinstallment__pk', filter=~Q(saleinstallment__status='PAID'))).\
-            exclude(installments__lte=F('paid_installments')).\
-            annotate(last_payment_date=Max('saleinstallment__collectioninstallment__collection__date')).\
-            annotate(debt_days=ExtractDay(today_date - Coalesce(F('last_payment_date'), F('sale_date')))).\
-            annotate(qualification=Case(
-                When(debt_days__lte=7, then=Value(0)),
-                When(debt_days__lte=15, then=Value(7)),
-                When(debt_days__lte=30, then=Value(15)),
-                default=Value(30)
-            )).\
-            exclude(qualification=0).\
-            order_by('-qualification', 'customer__name', '-debt_days')
+            filter(qualification__gt=0).\
+            values(
+                'customer__id', 'customer__name', 'customer__city', 'sale_id', 'sale__remarks',
+                'pending_installments', 'last_payment_date', 'since', 'qualification'
+            ).\
+            order_by('-qualification', 'since', 'sale_id')
 
         return queryset
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         context['filter_form'] = PendingBalanceFilterForm(self.request.GET)
+        sales = [sale['sale_id'] for sale in context['defaulters']]
+        overdue = SaleInstallment.objects.\
+            overdue().\
+            filter(sale__in=sales).\
+            values('sale').\
+            annotate(installments=Count('pk')).\
+            values_list('sale', 'installments')
+        overdue = dict(overdue)
+        now = timezone.now()
+        for sale in context['defaulters']:
+            sale['debt_days'] = SaleAging.get_debt_days(sale['since'], now)
+            sale['overdue_installments'] = overdue.get(sale['sale_id'], 0)
         return context
 
 
-class UncollectibleSalesListView(LoginRequiredMixin, AdminPermission, ListView, FilterSetView):
+class UncollectibleSalesListView(LoginRequiredMixin, AdminPermission, KeysetPaginationMixin, ListView, FilterSetView):
     template_name = 'list_uncollectible_sales.html'
     context_object_name = 'sales'
+    keyset = ['-pk']
     filterset = [
         ('customer', 'customer', 'exact'),
         ('date_from', 'date', 'gte'),
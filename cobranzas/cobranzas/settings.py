@@ -79,6 +79,7 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'app.middleware.CompressionMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -124,6 +125,22 @@ DATABASES = {
     }
 }
 
+# Cache
+# https://docs.djangoproject.com/en/4.0/topics/cache/
+# The "sync" cache stores the data synchronized by the app, already rendered, for each user and
+# version of its data. Use a shared backend (e.g. file based or Redis) when running several processes
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'sync': {
+        'BACKEND': os.getenv('SYNC_CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.getenv('SYNC_CACHE_LOCATION', 'sync'),
+        'TIMEOUT': int(os.getenv('SYNC_CACHE_TIMEOUT', 60 * 60 * 24)),
+    },
+}
+
 # Password validation
 # https://docs.djangoproject.com/en/4.0/ref/settings/#auth-password-validators
 
@@ -167,6 +184,11 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
 STATICFILES_DIRS = [
     (os.path.join(BASE_DIR, 'static')),
 ]
+# collectstatic writes gzip/brotli compressed copies of the text files
+STATICFILES_STORAGE = 'app.storage.CompressedStaticFilesStorage'
+
+# Responses smaller than this size (bytes) are not compressed
+COMPRESSION_MIN_SIZE = int(os.getenv('COMPRESSION_MIN_SIZE', 1024))
 
 MEDIA_URL = 'media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'mediafiles')
@@ -21,10 +21,11 @@ from app.views import HomeView, UserCreationView, UserListView, CustomerCreation
 from app.views import CustomerListView, SaleCreationView, SaleUpdateView, SaleListView
 from app.views import ProductCreationView, ProductUpdateView, ProductListView, LoginView, PendingBalanceListView
 from app.views import ProductDeleteView, CustomerDeleteView, SaleDeleteView, DefaultersListView
-from app.views import UncollectibleSalesListView
+from app.views import UncollectibleSalesListView, InstallmentPlanView
 from collection.views import CollectionCreationView, CollectionListView, CollectionPrintView
 from collection.views import CollectionDataView, PendingCollectionView, LocalCollectionPrintView
 from collection.views import CollectionUpdateView, CollectionDeliveryView, CollectionDeliveryListView
+from collection.views import CollectionBatchCreationView, CollectionDeliveryBatchView
 
 
 urlpatterns = [
@@ -46,7 +47,9 @@ urlpatterns = [
     path('sales/update/<pk>/', SaleUpdateView.as_view(), name='update-sale'),
     path('sales/delete/<pk>/', SaleDeleteView.as_view(), name='delete-sale'),
     path('sales/list/', SaleListView.as_view(), name='list-sales'),
+    path('sales/installment-plan/', InstallmentPlanView.as_view(), name='installment-plan'),
     path('collections/create/', CollectionCreationView.as_view(), name='create-collection'),
+    path('collections/create/batch/', CollectionBatchCreationView.as_view(), name='create-collection-batch'),
     path('collections/update/<pk>/', CollectionUpdateView.as_view(), name='update-collection'),
     path('collections/list/', CollectionListView.as_view(), name='list-collection'),
     path('collections/delivery/', CollectionDeliveryView.as_view(), name='collection-delivery'),
@@ -55,6 +58,7 @@ urlpatterns = [
     path('collections/data/', CollectionDataView.as_view(), name='collections-data'),
     path('collections/pending/', PendingCollectionView.as_view(), name='pending-collection'),
     path('reports/collections-delivery/', CollectionDeliveryListView.as_view(), name='list-collection-delivery'),
+    path('reports/collections-delivery/<int:pk>/', CollectionDeliveryBatchView.as_view(), name='detail-collection-delivery'),
     path('reports/pending-balance/', PendingBalanceListView.as_view(), name='list-pending-balance'),
     path('reports/defaulters/', DefaultersListView.as_view(), name='list-defaulters'),
     path('reports/uncollectible-sales', UncollectibleSalesListView.as_view(), name='list-uncollectible-sales'),
@@ -20,6 +20,13 @@ class CollectionForm(forms.Form):
         self.helper.form_show_labels = False
 
 
+class CollectionPaymentForm(forms.Form):
+    '''Installment paid in a collection sent by the offline batch upload'''
+    sale_id = forms.IntegerField()
+    installment = forms.IntegerField()
+    amount = forms.FloatField(min_value=0)
+
+
 CollectionFormset = formset_factory(
     CollectionForm,
     extra=1,
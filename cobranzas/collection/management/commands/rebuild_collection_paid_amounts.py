@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from collection.models import Collection
+
+
+class Command(BaseCommand):
+    help = 'Recalculate the paid amount stored in the collections from their installments'
+
+    def add_arguments(self, parser):
+        parser.add_argument('collections', nargs='*', type=int, help='IDs of the collections to rebuild (all the collections by default)')
+
+    def handle(self, *args, **options):
+        collections = options['collections'] or None
+        updated = Collection.update_paid_amounts(collections)
+        self.stdout.write(self.style.SUCCESS(f'{updated} collections updated'))
@@ -0,0 +1,18 @@
+# Generated by Django 4.0.5 on 2026-10-18 09:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('collection', '0007_collectiondelivery_unique_collection_delivery'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='collection',
+            name='idempotency_key',
+            field=models.CharField(blank=True, editable=False, max_length=64, null=True, unique=True, verbose_name='Idempotency Key'),
+        ),
+    ]
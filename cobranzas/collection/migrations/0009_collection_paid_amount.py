@@ -0,0 +1,28 @@
+# Generated by Django 4.0.5 on 2026-10-18 10:18
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+
+def calculate_paid_amounts(apps, schema_editor):
+    Collection = apps.get_model('collection', 'Collection')
+    CollectionInstallment = apps.get_model('collection', 'CollectionInstallment')
+    paid = CollectionInstallment.objects.filter(collection=OuterRef('pk')).values('collection').annotate(paid=Sum('amount')).values('paid')
+    Collection.objects.update(paid_amount=Coalesce(Subquery(paid), 0.0, output_field=models.FloatField()))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('collection', '0008_collection_idempotency_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='collection',
+            name='paid_amount',
+            field=models.FloatField(default=0.0, verbose_name='Paid Amount'),
+        ),
+        migrations.RunPython(calculate_paid_amounts, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,54 @@
+# Generated by Django 4.0.5 on 2026-10-18 10:25
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Sum
+import django.db.models.deletion
+
+
+def create_batches(apps, schema_editor):
+    # Deliveries saved together have the same collector and date
+    CollectionDelivery = apps.get_model('collection', 'CollectionDelivery')
+    CollectionDeliveryBatch = apps.get_model('collection', 'CollectionDeliveryBatch')
+    groups = CollectionDelivery.objects.\
+        values('collector', 'date').\
+        annotate(collections=Count('pk'), total=Sum('collection__paid_amount')).\
+        order_by('date')
+    for group in groups:
+        batch = CollectionDeliveryBatch.objects.create(
+            collector_id=group['collector'],
+            date=group['date'],
+            collections=group['collections'],
+            total=group['total'] or 0.0
+        )
+        CollectionDelivery.objects.filter(collector=group['collector'], date=group['date']).update(batch=batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('collection', '0009_collection_paid_amount'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CollectionDeliveryBatch',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateTimeField(db_index=True, verbose_name='Date')),
+                ('collections', models.PositiveIntegerField(default=0, verbose_name='Collections')),
+                ('total', models.FloatField(default=0.0, verbose_name='Total')),
+                ('collector', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL, verbose_name='Collector')),
+            ],
+            options={
+                'verbose_name': 'Collection Delivery Batch',
+            },
+        ),
+        migrations.AddField(
+            model_name='collectiondelivery',
+            name='batch',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='collection.collectiondeliverybatch', verbose_name='Delivery Batch'),
+        ),
+        migrations.RunPython(create_batches, migrations.RunPython.noop),
+    ]
@@ -1,9 +1,9 @@
 from django.conf import settings
-from django.contrib import admin
 from django.core.exceptions import ValidationError
 from django.db import models
-from django.db.models import Sum
-from django.utils.functional import cached_property
+from django.db.models import OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
 from app.models import Customer, SaleInstallment, User
@@ -15,15 +15,30 @@ class Collection(models.Model):
     date = models.DateTimeField(auto_now_add=True, db_index=True, verbose_name=_('Date'))
     modification = models.DateTimeField(auto_now=True, verbose_name=_('Modification Date'))
     delivered = models.BooleanField(default=False, verbose_name=_('Collection Delivered'))
+    # Generated by the app for each collection, to save it only once when the request is sent again
+    idempotency_key = models.CharField(max_length=64, null=True, blank=True, unique=True, editable=False, verbose_name=_('Idempotency Key'))
+    # Total of the installments paid in the collection, updated when the collection is saved
+    paid_amount = models.FloatField(default=0.0, verbose_name=_('Paid Amount'))
 
     def __str__(self):
         return f"{self.id}: {self.customer} - {self.date.strftime('%m/%d/%Y')}"
 
-    @cached_property
-    @admin.display(description=_("Paid Amount"))
-    def paid_amount(self):
-        paid = CollectionInstallment.objects.filter(collection=self.id).aggregate(paid=Sum('amount'))
-        return paid['paid']
+    @classmethod
+    def update_paid_amounts(cls, collections=None):
+        '''
+        Recalculate paid_amount from the installments of the given collections (a list of IDs or
+        a queryset, all the collections if None) using a single UPDATE query.
+        Return the number of updated collections.
+        '''
+        paid = CollectionInstallment.objects.\
+            filter(collection=OuterRef('pk')).\
+            values('collection').\
+            annotate(paid=Sum('amount')).\
+            values('paid')
+        paid_amount = Coalesce(Subquery(paid), 0.0, output_field=models.FloatField())
+
+        queryset = cls.objects.all() if collections is None else cls.objects.filter(pk__in=collections)
+        return queryset.update(paid_amount=paid_amount)
 
 
 class CollectionInstallment(models.Model):
@@ -60,14 +75,56 @@ class CollectorSyncLog(models.Model):
         verbose_name = _('Collector Synchronization Log')
 
 
+class CollectionDeliveryBatch(models.Model):
+    '''Collections delivered together by a collector, with their number and total'''
+    collector = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, verbose_name=_('Collector'))
+    date = models.DateTimeField(db_index=True, verbose_name=_('Date'))
+    collections = models.PositiveIntegerField(default=0, verbose_name=_('Collections'))
+    total = models.FloatField(default=0.0, verbose_name=_('Total'))
+
+    def __str__(self):
+        return f"{self.id}: {self.collector} - {self.date.strftime('%m/%d/%Y %I:%M %p')}"
+
+    @classmethod
+    def settle(cls, collector, collections, date):
+        '''
+        Deliver the collections (a list of IDs) of the collector: create the batch and the
+        deliveries, and mark the collections as delivered, with a number of queries that doesn't
+        depend on the number of collections. Raise ValidationError if a collection doesn't exist,
+        belongs to another collector or was already delivered. It must be called inside a
+        transaction, the collections are locked until it ends.
+        '''
+        collections = set(collections)
+        pending = Collection.objects.\
+            select_for_update().\
+            filter(pk__in=collections, collector=collector, delivered=False).\
+            order_by('pk').\
+            values_list('pk', 'paid_amount')
+        pending = dict(pending)
+        if len(pending) != len(collections):
+            raise ValidationError(_('The collections do not exist or were already delivered'))
+
+        batch = cls.objects.create(collector=collector, date=date, collections=len(pending), total=sum(pending.values()))
+        CollectionDelivery.objects.bulk_create([
+            CollectionDelivery(collection_id=pk, collector=collector, date=date, batch=batch) for pk in pending
+        ])
+        # update() doesn't set auto_now fields
+        Collection.objects.filter(pk__in=pending).update(delivered=True, modification=timezone.now())
+        return batch
+
+    class Meta:
+        verbose_name = _('Collection Delivery Batch')
+
+
 class CollectionDelivery(models.Model):
     collection = models.ForeignKey(Collection, on_delete=models.CASCADE, verbose_name=_('Collection'))
     collector = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, verbose_name=_('Collector'))
     date = models.DateTimeField(db_index=True, verbose_name=_('Date'))
+    batch = models.ForeignKey(CollectionDeliveryBatch, null=True, on_delete=models.CASCADE, verbose_name=_('Delivery Batch'))
 
     class Meta:
         constraints = [
             models.UniqueConstraint(
                 fields=['collection', 'collector'], name='unique_collection_delivery'
             ),
-        ]
\ No newline at end of file
+        ]
@@ -0,0 +1,98 @@
+import hashlib
+import json
+from functools import lru_cache
+
+from django.contrib.staticfiles import finders
+from django.template import Context
+from django.template.loader import get_template
+from django.template.loader_tags import ExtendsNode, IncludeNode
+from django.templatetags.static import static
+from django.urls import resolve, reverse
+
+
+# Pages cached by the service worker to work offline (URL names)
+PAGES = [
+    'offline',
+    'manifest',
+    'home',
+    'create-collection',
+    'pending-collection',
+    'print-local-collection',
+]
+
+# Static files cached by the service worker to work offline
+STATIC_FILES = [
+    'css/styles.css',
+    'css/receipt.css',
+    'js/utils.js',
+    'js/sync.js',
+    'js/create-collection.js',
+    'js/unsynchronized-collection.js',
+    'js/print-unsynchronized-collection.js',
+    'js/IndexedDB.js',
+    'js/Collection.js',
+    'js/CollectionView.js',
+    'img/icon/icon-92x92.png',
+    'img/icon/icon-192x192.png',
+    'img/icon/icon-256x256.png',
+    'img/icon/icon-384x384.png',
+    'img/icon/icon-512x512.png',
+    'library/dselect/dselect.css',
+    'library/dselect/dselect.js',
+]
+
+# External files are versioned in their URL, so they never change
+EXTERNAL_URLS = [
+    'https://cdn.jsdelivr.net/npm/bootstrap@5.2.0-beta1/dist/css/bootstrap.min.css',
+    'https://cdn.jsdelivr.net/npm/bootstrap-icons@1.8.3/font/bootstrap-icons.css',
+    'https://cdn.jsdelivr.net/npm/bootstrap@5.2.0-beta1/dist/js/bootstrap.bundle.min.js',
+    'https://cdnjs.cloudflare.com/ajax/libs/dayjs/1.11.8/dayjs.min.js',
+]
+
+
+def get_hash(content):
+    return hashlib.md5(content).hexdigest()[:12]
+
+
+def get_template_sources(name, sources=None):
+    '''Return the source of the template and of the templates it extends or includes'''
+    sources = {} if sources is None else sources
+    template = get_template(name).template
+    sources[name] = template.source
+    for node in template.nodelist.get_nodes_by_type((ExtendsNode, IncludeNode)):
+        expression = node.parent_name if isinstance(node, ExtendsNode) else node.template
+        parent = expression.resolve(Context())
+        # Templates whose name is a variable can't be known in advance
+        if isinstance(parent, str) and parent not in sources:
+            get_template_sources(parent, sources)
+    return sources
+
+
+@lru_cache(maxsize=None)
+def get_assets():
+    '''
+    Return a dictionary with the URL of each asset cached by the service worker and the hash of its
+    content (the templates of the page, or the static file). It's calculated only once, files
+    don't change while the app is running.
+    '''
+    assets = {}
+    for name in PAGES:
+        url = reverse(name)
+        sources = get_template_sources(resolve(url).func.view_class.template_name)
+        assets[url] = get_hash(''.join(sources[key] for key in sorted(sources)).encode())
+
+    for path in STATIC_FILES:
+        with open(finders.find(path), 'rb') as static_file:
+            assets[static(path)] = get_hash(static_file.read())
+
+    for url in EXTERNAL_URLS:
+        assets[url] = get_hash(url.encode())
+
+    return assets
+
+
+@lru_cache(maxsize=None)
+def get_version():
+    '''Version of the service worker, it changes when the service worker or an asset changes'''
+    content = json.dumps(get_assets(), sort_keys=True) + get_template('sw.js').template.source
+    return get_hash(content.encode())
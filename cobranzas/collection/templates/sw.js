@@ -3,36 +3,12 @@
 // VARIABLES
 
 const VERSION = '{{ version }}';
-const CACHE_NAME = 'collection-{{ version }}';
-const URLS_TO_CACHE = [
-  "{% url 'offline' %}",
-  "{% url 'manifest' %}",
-  "{% url 'home' %}",
-  "{% url 'create-collection' %}",
-  "{% url 'pending-collection' %}",
-  "{% url 'print-local-collection' %}",
-  "{% static 'css/styles.css' %}",
-  "{% static 'css/receipt.css' %}",
-  "{% static 'js/utils.js' %}",
-  "{% static 'js/sync.js' %}",
-  "{% static 'js/create-collection.js' %}",
-  "{% static 'js/unsynchronized-collection.js' %}",
-  "{% static 'js/print-unsynchronized-collection.js' %}",
-  "{% static 'js/IndexedDB.js' %}",
-  "{% static 'js/Collection.js' %}",
-  "{% static 'js/CollectionView.js' %}",
-  'https://cdn.jsdelivr.net/npm/bootstrap@5.2.0-beta1/dist/css/bootstrap.min.css',
-  'https://cdn.jsdelivr.net/npm/bootstrap-icons@1.8.3/font/bootstrap-icons.css',
-  'https://cdn.jsdelivr.net/npm/bootstrap@5.2.0-beta1/dist/js/bootstrap.bundle.min.js',
-  'https://cdnjs.cloudflare.com/ajax/libs/dayjs/1.11.8/dayjs.min.js',
-  "{% static 'img/icon/icon-92x92.png' %}",
-  "{% static 'img/icon/icon-192x192.png' %}",
-  "{% static 'img/icon/icon-256x256.png' %}",
-  "{% static 'img/icon/icon-384x384.png' %}",
-  "{% static 'img/icon/icon-512x512.png' %}",
-  "{% static 'library/dselect/dselect.css' %}",
-  "{% static 'library/dselect/dselect.js' %}",
-];
+// Each version has its own cache, so the previous version keeps serving its cache until the new one is activated
+const CACHE_NAME = `collection-assets-${VERSION}`;
+// URL of every asset cached to work offline, and the hash of its content
+const ASSETS = {{ assets|safe }};
+// The hashes of the cached assets are stored in the cache with this URL
+const ASSETS_KEY = '/sw-assets/';
 
 // UTILS
 
@@ -136,6 +112,7 @@ const manageCreateCollection = async (postRequest) => {
     collectionRecord.onsuccess = e => {
       const collections = e.target.result;
       const installment = {
+        'key': formDataObject['idempotency_key'],
         'installments': installments,
         'request': blob,
         'date': Date.now()
@@ -173,32 +150,59 @@ const manageCreateCollection = async (postRequest) => {
 
 // EVENT LISTENERS
 
+// Cache the assets needed offline in the cache of this version
+// The assets whose hash hasn't changed are copied from the caches of previous versions, and only
+// the new and changed ones are downloaded. The hashes are stored last, so a cache with them is complete
+const cacheAssets = async () => {
+  const cache = await caches.open(CACHE_NAME);
+  try {
+    const pendingAssets = new Set(Object.keys(ASSETS));
+    const cacheNames = await caches.keys();
+    for (const name of cacheNames.filter(name => name.startsWith('collection-') && name != CACHE_NAME)) {
+      const oldCache = await caches.open(name);
+      const storedAssets = await oldCache.match(ASSETS_KEY);
+      if (!storedAssets) {
+        continue;
+      }
+      const cachedAssets = await storedAssets.json();
+      for (const url of [...pendingAssets].filter(url => cachedAssets[url] === ASSETS[url])) {
+        const response = await oldCache.match(url);
+        if (response) {
+          await cache.put(url, response);
+          pendingAssets.delete(url);
+        }
+      }
+    }
+    await cache.addAll([...pendingAssets]);
+
+    await cache.put(ASSETS_KEY, new Response(JSON.stringify(ASSETS), {
+      headers: { 'Content-Type': 'application/json' }
+    }));
+  } catch (error) {
+    // The install failed, the next one starts from the caches of the previous versions again
+    await caches.delete(CACHE_NAME);
+    throw error;
+  }
+}
+
+// Delete the caches of previous versions
+const clearCache = async () => {
+  const cacheNames = await caches.keys();
+  await Promise.all(
+    cacheNames
+      .filter(name => name.startsWith('collection-') && name != CACHE_NAME)
+      .map(name => caches.delete(name))
+  );
+}
+
 // install files needed offline
 self.addEventListener('install', event => {
-  event.waitUntil(
-    caches.open(CACHE_NAME)
-      .then(cache => {
-        console.log('Opened cache');
-        return cache.addAll(URLS_TO_CACHE);
-      })
-  );
+  event.waitUntil(cacheAssets());
 });
 
 // Clear cache on activate
 self.addEventListener('activate', event => {
-  event.waitUntil(
-    caches.keys().then(cache => {
-      return Promise.all(
-        cache
-          .filter(cache => (cache.startsWith(CACHE_NAME)))
-          .map(cache => {
-            if (cache != 'collection-{{ version }}') {
-              caches.delete(cache);
-            }
-          })
-      );
-    })
-  );
+  event.waitUntil(clearCache());
 });
 
 self.addEventListener('fetch', event => {
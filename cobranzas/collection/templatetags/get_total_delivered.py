@@ -5,4 +5,5 @@ register = template.Library()
 
 @register.simple_tag
 def get_total_delivered(obj):
-    return sum(item.collection.paid_amount for item in obj)
\ No newline at end of file
+    # Total of a list of delivery batches
+    return sum(item.total for item in obj)
@@ -1,8 +1,10 @@
 import datetime
+import io
 
 from mixer.backend.django import mixer
 
 from django.core.exceptions import ValidationError
+from django.core.management import call_command
 from django.db.models.signals import post_save
 from django.db.models.signals import pre_save
 from django.test import TestCase
@@ -10,8 +12,10 @@ from django.utils import timezone
 
 from app.models import User, Customer, Sale, SaleInstallment
 from collection.models import Collection, CollectionInstallment, CollectorSyncLog
+from collection.models import CollectionDelivery, CollectionDeliveryBatch
 
 from app.signals import preSave_Sale, postSave_Sale, update_sync_value
+from app.tests.mixins import ReceiversMixin
 
 
 class CollectionModelTest(TestCase):
@@ -51,7 +55,7 @@ class CollectionInstallmentModelTest(TestCase):
         post_save.disconnect(receiver=postSave_Sale, sender=Sale, dispatch_uid='app.signals.postSave_Sale')
         post_save.disconnect(receiver=update_sync_value, sender=Sale, dispatch_uid='app.signals.update_sync_value.Sale')
 
-        collection = mixer.blend(Collection, id=1)
+        self.collection = collection = mixer.blend(Collection, id=1)
         sale = mixer.blend(Sale, id=5, sale_date=timezone.make_aware(datetime.datetime.today(), timezone.get_current_timezone(), True))
         sale_installment = mixer.blend(SaleInstallment, sale=sale, installment=12, installment_amount=10000.00, paid_amount=2000.00)
         self.collection_installment = mixer.blend(CollectionInstallment, id=3, collection=collection, sale_installment=sale_installment, amount=2000.00)
@@ -66,6 +70,24 @@ class CollectionInstallmentModelTest(TestCase):
         self.collection_installment.amount = 20000.00
         self.assertRaises(ValidationError, self.collection_installment.clean)
 
+    def test_collection_update_paid_amounts(self):
+        Collection.objects.update(paid_amount=0.0)
+        self.assertEqual(Collection.update_paid_amounts([self.collection.pk]), 1)
+        self.collection.refresh_from_db()
+        self.assertEqual(self.collection.paid_amount, 2000.00)
+
+    def test_collection_update_paid_amounts_without_installments(self):
+        CollectionInstallment.objects.all().delete()
+        Collection.update_paid_amounts([self.collection.pk])
+        self.collection.refresh_from_db()
+        self.assertEqual(self.collection.paid_amount, 0.0)
+
+    def test_rebuild_collection_paid_amounts_command(self):
+        Collection.objects.update(paid_amount=0.0)
+        call_command('rebuild_collection_paid_amounts', stdout=io.StringIO())
+        self.collection.refresh_from_db()
+        self.assertEqual(self.collection.paid_amount, 2000.00)
+
 
 class CollectorSyncLogModelTest(TestCase):
 
@@ -80,3 +102,34 @@ class CollectorSyncLogModelTest(TestCase):
         # Convert today to UTC because SQLite store date as UTC
         utc_today = self.today.astimezone(timezone.utc)
         self.assertEqual(str(self.collector_sync_log), utc_today.strftime('%m/%d/%Y %I:%M %p'))
+
+
+class CollectionDeliveryBatchModelTest(ReceiversMixin, TestCase):
+
+    def setUp(self):
+        # Disconnect Signals
+        self.set_receivers(disconnected=[update_sync_value])
+
+        self.collector = User.objects.create_user(username='luciano', email='test@test.com', password='mypassword', is_collector=True, first_name='Luciano', last_name='Muñoz')
+        customer = mixer.blend(Customer, collector=self.collector)
+        self.collections = [
+            mixer.blend(Collection, collector=self.collector, customer=customer, paid_amount=amount, delivered=False)
+            for amount in [500.00, 200.00]
+        ]
+        self.date = timezone.now()
+
+    def test_settle(self):
+        batch = CollectionDeliveryBatch.settle(self.collector, [c.pk for c in self.collections], self.date)
+        self.assertEqual((batch.collections, batch.total), (2, 700.00))
+        self.assertEqual(CollectionDelivery.objects.filter(batch=batch, collector=self.collector).count(), 2)
+        self.assertEqual(Collection.objects.filter(delivered=True).count(), 2)
+
+    def test_settle_delivered_collection(self):
+        CollectionDeliveryBatch.settle(self.collector, [self.collections[0].pk], self.date)
+        with self.assertRaises(ValidationError):
+            CollectionDeliveryBatch.settle(self.collector, [c.pk for c in self.collections], self.date)
+        self.assertEqual(CollectionDeliveryBatch.objects.count(), 1)
+
+    def test_batch_str(self):
+        batch = CollectionDeliveryBatch.settle(self.collector, [self.collections[0].pk], self.date)
+        self.assertEqual(str(batch), f"{batch.pk}: Luciano Muñoz - {self.date.strftime('%m/%d/%Y %I:%M %p')}")
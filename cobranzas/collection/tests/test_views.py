@@ -0,0 +1,861 @@
+import gzip
+import hashlib
+import json
+from datetime import datetime, timedelta
+from unittest import mock
+
+from django.contrib.staticfiles import finders
+from django.core.cache import caches
+from django.core.exceptions import PermissionDenied, ValidationError
+from django.db import connection, transaction
+from django.http import Http404
+from django.test import TestCase, RequestFactory, override_settings
+from django.templatetags.static import static
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from app.models import User, Customer, CustomerBalance, Sale, SaleAging, SaleInstallment, KeyValueStore, SyncTombstone
+from app.signals import preSave_Sale, postSave_Sale
+from app.tests.mixins import ReceiversMixin
+from collection.models import Collection, CollectionInstallment, CollectionDelivery, CollectionDeliveryBatch
+from collection import service_worker
+from collection.views import CollectionDataView
+
+
+class TestCollectionDataView(ReceiversMixin, TestCase):
+
+    def setUp(self):
+        # Disconnect Signals
+        self.set_receivers(disconnected=[preSave_Sale, postSave_Sale])
+
+        tz = timezone.get_current_timezone()
+        self.today = timezone.make_aware(datetime.today(), tz, True)
+        self.admin = User.objects.create_user(username='luciano', email='test@test.com', password='mypassword', is_staff=True)
+        self.user = User.objects.create_user(username='laura', email='test2@test.com', password='mypassword', is_collector=True)
+        self.other_user = User.objects.create_user(username='jose', email='test3@test.com', password='mypassword', is_collector=True)
+        self.customer_1 = Customer.objects.create(name='Autoservicio Marcos', city='ARR', collector=self.user)
+        self.customer_2 = Customer.objects.create(name='Jose Luis', city='SAL', collector=self.user)
+        self.sale_1 = Sale.objects.create(
+            user=self.admin,
+            customer=self.customer_1,
+            price=1000,
+            installment_amount=500,
+            installments=2,
+            collector=self.user,
+            sale_date=self.today
+        )
+        self.sale_2 = Sale.objects.create(
+            user=self.admin,
+            customer=self.customer_2,
+            price=2000,
+            installment_amount=1000,
+            installments=2,
+            collector=self.user,
+            sale_date=self.today
+        )
+        for sale in [self.sale_1, self.sale_2]:
+            for i in range(1, sale.installments + 1):
+                SaleInstallment.objects.create(sale=sale, installment=i, installment_amount=sale.installment_amount)
+        self.client.login(username='laura', password='mypassword')
+        caches['sync'].clear()
+        # Without margin the changes made before a sync are not sent again in the next one
+        patcher = mock.patch.object(CollectionDataView, 'cursor_margin', timedelta(0))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get_data(self, since=None):
+        url = reverse('collections-data')
+        if since:
+            url += f'?since={since}'
+        return json.loads(self.client.get(url).content)
+
+    def test_full_sync_returns_cursor(self):
+        data = self.get_data()
+        self.assertIn('cursor', data)
+        self.assertNotIn('deleted', data)
+        self.assertEqual({s['pk'] for s in data['sales']}, {self.customer_1.pk, self.customer_2.pk})
+
+    def test_delta_sync_without_changes(self):
+        cursor = self.get_data()['cursor']
+        data = self.get_data(cursor)
+        self.assertEqual(data['sales'], [])
+        self.assertEqual(data['customers'], [])
+        self.assertEqual(data['deleted'], {'sales': [], 'customers': []})
+
+    def test_delta_sync_returns_changed_customers(self):
+        cursor = self.get_data()['cursor']
+        installment = SaleInstallment.objects.get(sale=self.sale_1, installment=1)
+        installment.paid_amount = 200
+        installment.status = SaleInstallment.PARTIAL
+        installment.save()
+
+        data = self.get_data(cursor)
+        self.assertEqual([s['pk'] for s in data['sales']], [self.customer_1.pk])
+        self.assertEqual(data['sales'][0]['sale_set'][0]['saleinstallment_set'][0]['paid_amount'], 200)
+        self.assertEqual(data['deleted'], {'sales': [], 'customers': []})
+
+    def test_delta_sync_returns_tombstones(self):
+        cursor = self.get_data()['cursor']
+        self.customer_2.collector = self.other_user
+        self.customer_2.save()
+        self.sale_2.collector = self.other_user
+        self.sale_2.save()
+
+        data = self.get_data(cursor)
+        self.assertEqual(data['sales'], [])
+        self.assertEqual(data['deleted'], {'sales': [self.customer_2.pk], 'customers': [self.customer_2.pk]})
+
+    def test_delta_sync_only_returns_customers_of_the_user(self):
+        cursor = self.get_data()['cursor']
+        other_customer = Customer.objects.create(name='Maria', city='DUG', collector=self.other_user)
+        Sale.objects.create(
+            user=self.admin,
+            customer=other_customer,
+            price=1000,
+            installment_amount=500,
+            installments=2,
+            collector=self.other_user,
+            sale_date=self.today
+        )
+
+        data = self.get_data(cursor)
+        self.assertEqual(data['sales'], [])
+        self.assertEqual(data['customers'], [])
+        self.assertEqual(data['deleted'], {'sales': [], 'customers': []})
+
+    def test_delta_sync_after_paying_a_sale_of_another_collector(self):
+        # The customer is only in the scope of the user through the sale
+        self.customer_2.collector = self.other_user
+        self.customer_2.save()
+        cursor = self.get_data()['cursor']
+        installments = [{'sale_id': self.sale_2.pk, 'installment': i, 'amount': 1000} for i in [1, 2]]
+        with transaction.atomic():
+            CollectionDataView().save_collection(self.customer_2, self.user, installments)
+
+        data = self.get_data(cursor)
+        self.assertEqual(data['deleted'], {'sales': [self.customer_2.pk], 'customers': [self.customer_2.pk]})
+
+    def test_delta_sync_after_updating_a_collection_of_another_collector(self):
+        self.customer_2.collector = self.other_user
+        self.customer_2.save()
+        installments = [{'sale_id': self.sale_2.pk, 'installment': i, 'amount': 500} for i in [1, 2]]
+        with transaction.atomic():
+            collection = CollectionDataView().save_collection(self.customer_2, self.user, installments)
+        cursor = self.get_data()['cursor']
+
+        # An admin completes the payment of the sale
+        self.client.login(username='luciano', password='mypassword')
+        self.client.post(reverse('update-collection', args=[collection.pk]), {
+            'collection-installment': [f'{self.sale_2.pk}-1', f'{self.sale_2.pk}-2'],
+            f'amount-{self.sale_2.pk}-1': 1000,
+            f'amount-{self.sale_2.pk}-2': 1000,
+        })
+        self.client.login(username='laura', password='mypassword')
+        data = self.get_data(cursor)
+        self.assertEqual(data['deleted'], {'sales': [self.customer_2.pk], 'customers': [self.customer_2.pk]})
+
+    def test_delta_sync_from_an_expired_cursor(self):
+        # The tombstones older than the cursor may be deleted, so the whole data is returned
+        cursor = f'{(timezone.now() - SyncTombstone.RETENTION - timedelta(days=1)).timestamp():.6f}'
+        data = self.get_data(cursor)
+        self.assertNotIn('deleted', data)
+        self.assertEqual({s['pk'] for s in data['sales']}, {self.customer_1.pk, self.customer_2.pk})
+
+    def test_delta_sync_returns_changes_committed_after_the_cursor(self):
+        # A change saved before the cursor, in a transaction committed after the data was read
+        with mock.patch.object(CollectionDataView, 'cursor_margin', timedelta(minutes=5)):
+            cursor = self.get_data()['cursor']
+            SaleInstallment.objects.filter(sale=self.sale_1, installment=1).update(
+                paid_amount=200, status=SaleInstallment.PARTIAL, modification=timezone.now() - timedelta(minutes=1)
+            )
+            data = self.get_data(cursor)
+        sale = next(s for s in data['sales'] if s['pk'] == self.customer_1.pk)['sale_set'][0]
+        self.assertEqual(sale['saleinstallment_set'][0]['paid_amount'], 200)
+
+    def test_delta_sync_after_sale_deletion(self):
+        cursor = self.get_data()['cursor']
+        self.sale_1.delete()
+
+        data = self.get_data(cursor)
+        self.assertEqual(data['sales'], [{'pk': self.customer_1.pk, 'sale_set': []}])
+
+    def test_admin_data_is_streamed(self):
+        self.client.login(username='luciano', password='mypassword')
+        Customer.objects.create(name='Maria', city='DUG', collector=self.other_user)
+        with mock.patch.object(CollectionDataView, 'stream_buffer_size', 100):
+            response = self.client.get(reverse('collections-data'))
+            self.assertTrue(response.streaming)
+            chunks = list(response.streaming_content)
+        self.assertGreater(len(chunks), 1)
+        data = json.loads(b''.join(chunks))
+
+        view = CollectionDataView()
+        view.request = RequestFactory().get(reverse('collections-data'))
+        view.request.user = self.admin
+        expected = json.loads(view.get_data())
+        self.assertEqual(data['sales'], expected['sales'])
+        self.assertEqual(data['customers'], expected['customers'])
+        self.assertEqual(data['last_update'], expected['last_update'])
+        self.assertEqual(len(data['customers']), 3)
+
+    def test_admin_data_etag_does_not_depend_on_format(self):
+        # The whole data of an admin is always streamed in the nested format
+        self.client.login(username='luciano', password='mypassword')
+        accept = 'application/vnd.cobranzas.columnar+json, application/json;q=0.9'
+        response = self.client.get(reverse('collections-data'), HTTP_ACCEPT=accept)
+        self.assertEqual(response['Content-Type'], 'application/json')
+        self.assertEqual(response['ETag'], self.client.get(reverse('collections-data'))['ETag'])
+        etag = response['ETag']
+        response = self.client.get(reverse('collections-data'), HTTP_ACCEPT=accept, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+    def decode_columnar(self, data):
+        def rows(columns):
+            return [dict(zip(columns, values)) for values in zip(*columns.values())]
+
+        installments = {}
+        for installment in rows(data['installments']):
+            installment['status'] = data['statuses'][installment['status']]
+            installments.setdefault(installment.pop('sale'), []).append(installment)
+        sales = {}
+        for sale in rows(data['sales']):
+            sale['saleinstallment_set'] = installments.get(sale['pk'], [])
+            sales.setdefault(sale.pop('customer'), []).append(sale)
+        return {
+            'sales': [{'pk': pk, 'sale_set': sales.get(pk, [])} for pk in data['sales_customers']],
+            'customers': rows(data['customers']),
+        }
+
+    def test_columnar_format(self):
+        Customer.objects.create(name='Maria', city='DUG', collector=self.user)
+        accept = 'application/vnd.cobranzas.columnar+json, application/json;q=0.9'
+        response = self.client.get(reverse('collections-data'), HTTP_ACCEPT=accept)
+        self.assertEqual(response['Content-Type'], 'application/vnd.cobranzas.columnar+json')
+        self.assertIn('Accept', response['Vary'])
+        data = json.loads(response.content)
+        self.assertEqual(data['format'], 'columnar')
+
+        expected = self.get_data()
+        decoded = self.decode_columnar(data)
+        self.assertEqual(decoded['sales'], expected['sales'])
+        self.assertEqual(decoded['customers'], expected['customers'])
+        self.assertLess(len(response.content), len(json.dumps(expected)))
+        self.assertNotEqual(response['ETag'], self.client.get(reverse('collections-data'))['ETag'])
+
+    def test_default_format(self):
+        response = self.client.get(reverse('collections-data'), HTTP_ACCEPT='*/*')
+        self.assertEqual(response['Content-Type'], 'application/json')
+
+    @override_settings(COMPRESSION_MIN_SIZE=100)
+    def test_gzip(self):
+        response = self.client.get(reverse('collections-data'), HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(json.loads(gzip.decompress(response.content))['sales'], self.get_data()['sales'])
+
+    def test_invalid_cursor(self):
+        response = self.client.get(reverse('collections-data') + '?since=yesterday')
+        self.assertEqual(response.status_code, 400)
+
+    def test_not_modified(self):
+        etag = self.client.get(reverse('collections-data'))['ETag']
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(reverse('collections-data'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        self.assertFalse([q for q in context.captured_queries if 'app_sale' in q['sql']])
+
+    def test_modified_after_a_change(self):
+        etag = self.client.get(reverse('collections-data'))['ETag']
+        installment = SaleInstallment.objects.get(sale=self.sale_1, installment=1)
+        installment.paid_amount = 200
+        installment.save()
+
+        response = self.client.get(reverse('collections-data'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_etag_only_changes_for_affected_collectors(self):
+        other_customer = Customer.objects.create(name='Maria', city='ARR', collector=self.other_user)
+        etag = self.client.get(reverse('collections-data'))['ETag']
+
+        other_customer.address = 'San Martin 100'
+        other_customer.save()
+        self.assertEqual(self.client.get(reverse('collections-data'))['ETag'], etag)
+
+        # The customer is moved to the user, so its data changes
+        other_customer.collector = self.user
+        other_customer.save()
+        self.assertNotEqual(self.client.get(reverse('collections-data'))['ETag'], etag)
+
+        # The customer is moved back, the user has to remove it
+        etag = self.client.get(reverse('collections-data'))['ETag']
+        other_customer.collector = self.other_user
+        other_customer.save()
+        self.assertNotEqual(self.client.get(reverse('collections-data'))['ETag'], etag)
+
+    def test_cached_data(self):
+        KeyValueStore.update_sync([self.user.pk])
+        content = self.client.get(reverse('collections-data')).content
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(self.client.get(reverse('collections-data')).content, content)
+        self.assertFalse([q for q in context.captured_queries if 'app_sale' in q['sql']])
+
+        # A change updates the version of the user's data, so the cached data is not used
+        installment = SaleInstallment.objects.get(sale=self.sale_1, installment=1)
+        installment.paid_amount = 200
+        installment.save()
+        sale = next(s for s in self.get_data()['sales'] if s['pk'] == self.customer_1.pk)['sale_set'][0]
+        self.assertEqual(sale['saleinstallment_set'][0]['paid_amount'], 200)
+
+    def test_etag_depends_on_user_and_query(self):
+        etag = self.client.get(reverse('collections-data'))['ETag']
+        delta_etag = self.client.get(reverse('collections-data') + '?since=1')['ETag']
+        self.client.login(username='jose', password='mypassword')
+        other_etag = self.client.get(reverse('collections-data'))['ETag']
+        self.assertEqual(len({etag, delta_etag, other_etag}), 3)
+
+
+class TestCollectionDataScope(ReceiversMixin, TestCase):
+
+    def setUp(self):
+        # Disconnect Signals
+        self.set_receivers(disconnected=[preSave_Sale, postSave_Sale])
+
+        tz = timezone.get_current_timezone()
+        self.today = timezone.make_aware(datetime.today(), tz, True)
+        self.admin = User.objects.create_user(username='luciano', email='test@test.com', password='mypassword', is_staff=True)
+        self.user = User.objects.create_user(username='laura', email='test2@test.com', password='mypassword', is_collector=True)
+        self.other_user = User.objects.create_user(username='jose', email='test3@test.com', password='mypassword', is_collector=True)
+        # Assigned customer without sales
+        self.customer_1 = Customer.objects.create(name='Autoservicio Marcos', city='ARR', collector=self.user)
+        # Customer of another collector with a pending sale assigned to the user
+        self.customer_2 = Customer.objects.create(name='Jose Luis', city='SAL', collector=self.other_user)
+        # Customer of another collector with a paid sale assigned to the user
+        self.customer_3 = Customer.objects.create(name='Maria', city='DUG', collector=self.other_user)
+        self.create_sale(self.customer_2, self.user)
+        self.create_sale(self.customer_3, self.user, paid=True)
+        self.view = CollectionDataView()
+        # The scope is cached by version of the synchronized data
+        caches['sync'].clear()
+
+    def create_sale(self, customer, collector, paid=False):
+        sale = Sale.objects.create(
+            user=self.admin,
+            customer=customer,
+            price=1000,
+            installment_amount=500,
+            installments=2,
+            collector=collector,
+            sale_date=self.today
+        )
+        status = SaleInstallment.PAID if paid else SaleInstallment.PENDING
+        for i in range(1, sale.installments + 1):
+            SaleInstallment.objects.create(sale=sale, installment=i, installment_amount=500, status=status)
+
+    def count_queries(self, function):
+        with CaptureQueriesContext(connection) as context:
+            function()
+        # Discard queries of the profiler, that explains the queries of the previous request
+        return [q['sql'] for q in context.captured_queries if not q['sql'].startswith('EXPLAIN') and 'silk_' not in q['sql']]
+
+    def test_customers(self):
+        customers = [c['name'] for c in self.view.get_customers(self.user)]
+        self.assertEqual(customers, ['Autoservicio Marcos', 'Jose Luis'])
+
+    def test_customers_without_sales(self):
+        # A collector without customers nor sales must not get every customer
+        collector = User.objects.create_user(username='pedro', email='test4@test.com', password='mypassword', is_collector=True)
+        self.assertEqual(list(self.view.get_customers(collector)), [])
+
+    def test_customers_query_does_not_depend_on_sales(self):
+        queries = self.count_queries(lambda: list(self.view.get_customers(self.user)))
+        for i in range(5):
+            self.create_sale(Customer.objects.create(name=f'Customer {i}', city='ARR', collector=self.other_user), self.user)
+        self.assertEqual(len(self.count_queries(lambda: list(self.view.get_customers(self.user)))), len(queries))
+        self.assertEqual(len(self.view.get_customers(self.user)), 7)
+
+    def test_collector_validation(self):
+        self.assertTrue(self.view.collector_validation(self.customer_1.pk, self.user))
+        self.assertTrue(self.view.collector_validation(self.customer_2.pk, self.user))
+        with self.assertRaises(PermissionDenied):
+            self.view.collector_validation(self.customer_3.pk, self.user)
+        with self.assertRaises(Http404):
+            self.view.collector_validation(0, self.user)
+        self.assertTrue(self.view.collector_validation(self.customer_3.pk, self.admin))
+        with self.assertRaises(Http404):
+            self.view.collector_validation(0, self.admin)
+
+    def test_collector_validation_queries(self):
+        # Version, customers and sales of the collector
+        queries = self.count_queries(lambda: self.view.collector_validation(self.customer_2.pk, self.user))
+        self.assertEqual(len(queries), 3)
+        # Then only the version
+        queries = self.count_queries(lambda: self.view.collector_validation(self.customer_2.pk, self.user))
+        self.assertEqual(len(queries), 1)
+
+    def test_scope(self):
+        scope = self.view.get_collector_scope(self.user)
+        self.assertEqual(scope['customers'], {self.customer_1.pk, self.customer_2.pk})
+        self.assertEqual(scope['sales'], set(Sale.objects.filter(customer=self.customer_2).values_list('pk', flat=True)))
+
+    def test_scope_changes_with_customer_collector(self):
+        self.view.get_collector_scope(self.user)
+        self.customer_3.collector = self.user
+        self.customer_3.save()
+        self.assertTrue(self.view.collector_validation(self.customer_3.pk, self.user))
+        self.customer_3.collector = self.other_user
+        self.customer_3.save()
+        with self.assertRaises(PermissionDenied):
+            self.view.collector_validation(self.customer_3.pk, self.user)
+
+    def test_scope_changes_with_sale(self):
+        self.view.get_collector_scope(self.user)
+        sale = Sale.objects.get(customer=self.customer_2)
+        sale.uncollectible = True
+        sale.save()
+        with self.assertRaises(PermissionDenied):
+            self.view.collector_validation(self.customer_2.pk, self.user)
+        sale.uncollectible = False
+        sale.collector = self.other_user
+        sale.save()
+        self.assertEqual(self.view.get_collector_scope(self.user)['customers'], {self.customer_1.pk})
+        self.assertEqual(self.view.get_collector_scope(self.other_user)['sales'], {sale.pk})
+
+
+class TestCollectionCreationView(ReceiversMixin, TestCase):
+
+    def setUp(self):
+        # Disconnect Signals
+        self.set_receivers(disconnected=[preSave_Sale, postSave_Sale])
+
+        tz = timezone.get_current_timezone()
+        self.today = timezone.make_aware(datetime.today(), tz, True)
+        self.admin = User.objects.create_user(username='luciano', email='test@test.com', password='mypassword', is_staff=True)
+        self.user = User.objects.create_user(username='laura', email='test2@test.com', password='mypassword', is_collector=True)
+        self.customer = Customer.objects.create(name='Autoservicio Marcos', city='ARR', collector=self.user)
+        self.sale = Sale.objects.create(
+            user=self.admin,
+            customer=self.customer,
+            price=1000,
+            installment_amount=500,
+            installments=2,
+            collector=self.user,
+            sale_date=self.today
+        )
+        for i in range(1, self.sale.installments + 1):
+            SaleInstallment.objects.create(sale=self.sale, installment=i, installment_amount=self.sale.installment_amount)
+        self.client.login(username='laura', password='mypassword')
+
+    def count_queries(self, installments):
+        # The scope of the collector is loaded again in every request
+        caches['sync'].clear()
+        with CaptureQueriesContext(connection) as context:
+            self.client.post(reverse('create-collection'), self.get_post_data(installments))
+        # Discard queries of the profiler, that randomly cleans old requests
+        return len([q for q in context.captured_queries if 'silk_' not in q['sql']])
+
+    def get_post_data(self, installments):
+        data = {
+            'customer': self.customer.pk,
+            'collection-TOTAL_FORMS': len(installments),
+            'collection-INITIAL_FORMS': 0,
+            'collection-MIN_NUM_FORMS': 0,
+            'collection-MAX_NUM_FORMS': 1500,
+        }
+        for i, (installment, amount) in enumerate(installments):
+            data.update({
+                f'collection-{i}-checked': 'on',
+                f'collection-{i}-installment': installment,
+                f'collection-{i}-installment_amount': 500,
+                f'collection-{i}-paid_amount': 0,
+                f'collection-{i}-amount': amount,
+                f'collection-{i}-sale_id': self.sale.pk,
+            })
+        return data
+
+    def test_create_collection(self):
+        response = self.client.post(reverse('create-collection'), self.get_post_data([(1, 500), (2, 200)]))
+        self.assertEqual(response.status_code, 200)
+        collection = Collection.objects.get(pk=json.loads(response.content)['collection_id'])
+        self.assertEqual(CollectionInstallment.objects.filter(collection=collection).count(), 2)
+        installments = SaleInstallment.objects.filter(sale=self.sale).order_by('installment')
+        self.assertEqual([(i.paid_amount, i.status) for i in installments], [(500, SaleInstallment.PAID), (200, SaleInstallment.PARTIAL)])
+        self.assertEqual(collection.paid_amount, 700)
+
+    def test_update_collection_updates_paid_amount(self):
+        response = self.client.post(reverse('create-collection'), self.get_post_data([(1, 500), (2, 200)]))
+        collection = Collection.objects.get(pk=json.loads(response.content)['collection_id'])
+        self.client.login(username='luciano', password='mypassword')
+        self.client.post(reverse('update-collection', args=[collection.pk]), {
+            'collection-installment': [f'{self.sale.pk}-1', f'{self.sale.pk}-2'],
+            f'amount-{self.sale.pk}-1': 500,
+            f'amount-{self.sale.pk}-2': 300,
+        })
+        collection.refresh_from_db()
+        self.assertEqual(collection.paid_amount, 800)
+
+    def test_create_collection_updates_sale_balance(self):
+        self.client.post(reverse('create-collection'), self.get_post_data([(1, 500), (2, 200)]))
+        self.sale.refresh_from_db()
+        self.assertEqual(self.sale.paid_amount, 700)
+        self.assertEqual(self.sale.pending_balance, 300)
+
+    def test_collections_update_customer_balance(self):
+        response = self.client.post(reverse('create-collection'), self.get_post_data([(1, 500), (2, 200)]))
+        balance = CustomerBalance.objects.get(customer=self.customer)
+        self.assertEqual((balance.sales, balance.paid_amount, balance.pending_balance), (1, 700, 300))
+
+        collection = Collection.objects.get(pk=json.loads(response.content)['collection_id'])
+        self.client.login(username='luciano', password='mypassword')
+        self.client.post(reverse('update-collection', args=[collection.pk]), {
+            'collection-installment': [f'{self.sale.pk}-1', f'{self.sale.pk}-2'],
+            f'amount-{self.sale.pk}-1': 500,
+            f'amount-{self.sale.pk}-2': 500,
+        })
+        # The sale is paid, so the customer has no pending balance
+        self.assertFalse(CustomerBalance.objects.filter(customer=self.customer).exists())
+
+    def test_create_collection_updates_sale_aging(self):
+        response = self.client.post(reverse('create-collection'), self.get_post_data([(1, 500)]))
+        collection = Collection.objects.get(pk=json.loads(response.content)['collection_id'])
+        aging = SaleAging.objects.get(sale=self.sale)
+        self.assertEqual((aging.pending_installments, aging.last_payment_date, aging.since), (1, collection.date, collection.date))
+        self.assertEqual(aging.qualification, 0)
+
+    def test_create_collection_queries_do_not_depend_on_installments(self):
+        self.sale.installments = 6
+        self.sale.save()
+        for i in range(3, 7):
+            SaleInstallment.objects.create(sale=self.sale, installment=i, installment_amount=self.sale.installment_amount)
+
+        one_installment = self.count_queries([(1, 100)])
+        five_installments = self.count_queries([(2, 100), (3, 100), (4, 100), (5, 100), (6, 100)])
+        self.assertEqual(one_installment, five_installments)
+
+    def test_create_collection_of_a_sale_of_another_collector(self):
+        # The customer is in the scope of the user because of its first sale
+        other_user = User.objects.create_user(username='jose', email='test3@test.com', password='mypassword', is_collector=True)
+        self.customer.collector = other_user
+        self.customer.save()
+        sale = Sale.objects.create(
+            user=self.admin,
+            customer=self.customer,
+            price=500,
+            installment_amount=500,
+            installments=1,
+            collector=other_user,
+            sale_date=self.today
+        )
+        SaleInstallment.objects.create(sale=sale, installment=1, installment_amount=500)
+        data = self.get_post_data([(1, 500)])
+        data['collection-0-sale_id'] = sale.pk
+        response = self.client.post(reverse('create-collection'), data)
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(Collection.objects.exists())
+
+    def test_create_collection_with_invalid_form(self):
+        # Installments with errors are not paid
+        data = self.get_post_data([(1, 500), (2, 200)])
+        data['collection-0-amount'] = 'abc'
+        response = self.client.post(reverse('create-collection'), data)
+        self.assertEqual(response.status_code, 200)
+        installments = SaleInstallment.objects.filter(sale=self.sale).order_by('installment')
+        self.assertEqual([i.paid_amount for i in installments], [0, 200])
+
+    def test_create_collection_with_repeated_installment(self):
+        response = self.client.post(reverse('create-collection'), self.get_post_data([(1, 200), (1, 100)]))
+        self.assertEqual(response.status_code, 200)
+        collection = Collection.objects.get(pk=json.loads(response.content)['collection_id'])
+        self.assertEqual([i.amount for i in CollectionInstallment.objects.filter(collection=collection)], [300])
+        self.assertEqual(SaleInstallment.objects.get(sale=self.sale, installment=1).paid_amount, 300)
+        self.assertEqual(collection.paid_amount, 300)
+
+    def test_create_collection_replay(self):
+        data = self.get_post_data([(1, 500)])
+        data['idempotency_key'] = 'f1b0d7a6-6f5e-4bbf-9b0c-2f0e3c7c1d10'
+        first = json.loads(self.client.post(reverse('create-collection'), data).content)
+        second = json.loads(self.client.post(reverse('create-collection'), data).content)
+        self.assertEqual(first, second)
+        self.assertEqual(Collection.objects.count(), 1)
+        self.sale.refresh_from_db()
+        self.assertEqual(self.sale.paid_amount, 500)
+
+    def test_create_collection_with_total_zero(self):
+        with self.assertRaises(ValidationError):
+            self.client.post(reverse('create-collection'), self.get_post_data([(1, 0)]))
+        self.assertFalse(Collection.objects.exists())
+
+    def test_create_collection_with_key_of_another_collector(self):
+        other_user = User.objects.create_user(username='jose', email='test3@test.com', password='mypassword', is_collector=True)
+        Collection.objects.create(collector=other_user, customer=self.customer, idempotency_key='abc')
+        data = self.get_post_data([(1, 500)])
+        data['idempotency_key'] = 'abc'
+        response = self.client.post(reverse('create-collection'), data)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(Collection.objects.count(), 1)
+        self.assertEqual(SaleInstallment.objects.get(sale=self.sale, installment=1).paid_amount, 0)
+
+
+class TestCollectionBatchCreationView(ReceiversMixin, TestCase):
+
+    def setUp(self):
+        # Disconnect Signals
+        self.set_receivers(disconnected=[preSave_Sale, postSave_Sale])
+
+        tz = timezone.get_current_timezone()
+        self.today = timezone.make_aware(datetime.today(), tz, True)
+        self.admin = User.objects.create_user(username='luciano', email='test@test.com', password='mypassword', is_staff=True)
+        self.user = User.objects.create_user(username='laura', email='test2@test.com', password='mypassword', is_collector=True)
+        self.other_user = User.objects.create_user(username='jose', email='test3@test.com', password='mypassword', is_collector=True)
+        self.customer = Customer.objects.create(name='Autoservicio Marcos', city='ARR', collector=self.user)
+        self.other_customer = Customer.objects.create(name='Jose Luis', city='SAL', collector=self.other_user)
+        self.sale = Sale.objects.create(
+            user=self.admin,
+            customer=self.customer,
+            price=1000,
+            installment_amount=500,
+            installments=2,
+            collector=self.user,
+            sale_date=self.today
+        )
+        self.other_sale = Sale.objects.create(
+            user=self.admin,
+            customer=self.other_customer,
+            price=1000,
+            installment_amount=500,
+            installments=2,
+            collector=self.other_user,
+            sale_date=self.today
+        )
+        for sale in [self.sale, self.other_sale]:
+            for i in range(1, sale.installments + 1):
+                SaleInstallment.objects.create(sale=sale, installment=i, installment_amount=sale.installment_amount)
+        self.client.login(username='laura', password='mypassword')
+
+    def post_batch(self, collections):
+        response = self.client.post(
+            reverse('create-collection-batch'),
+            json.dumps({'collections': collections}),
+            content_type='application/json'
+        )
+        return response
+
+    def get_item(self, customer, sale, installments):
+        return {
+            'customer': customer.pk,
+            'installments': [{'sale_id': sale.pk, 'installment': i, 'amount': amount} for i, amount in installments]
+        }
+
+    def test_create_collections(self):
+        response = self.post_batch([
+            self.get_item(self.customer, self.sale, [(1, 500)]),
+            self.get_item(self.customer, self.sale, [(2, 200)]),
+        ])
+        self.assertEqual(response.status_code, 200)
+        results = json.loads(response.content)['results']
+        self.assertEqual([r['status'] for r in results], ['ok', 'ok'])
+        self.assertEqual(Collection.objects.filter(pk__in=[r['collection_id'] for r in results]).count(), 2)
+        self.sale.refresh_from_db()
+        self.assertEqual(self.sale.paid_amount, 700)
+
+    def test_failed_items_do_not_affect_the_others(self):
+        response = self.post_batch([
+            self.get_item(self.other_customer, self.other_sale, [(1, 500)]),
+            self.get_item(self.customer, self.sale, [(1, 500)]),
+            self.get_item(self.customer, self.sale, [(3, 500)]),
+            {'customer': 0, 'installments': []},
+            self.get_item(self.customer, self.sale, [(2, 'abc')]),
+        ])
+        results = json.loads(response.content)['results']
+        self.assertEqual([r['status'] for r in results], ['forbidden', 'ok', 'invalid', 'not_found', 'invalid'])
+        self.assertEqual(Collection.objects.count(), 1)
+        self.assertEqual(CollectionInstallment.objects.count(), 1)
+
+    def test_sale_of_another_customer(self):
+        self.other_sale.collector = self.user
+        self.other_sale.save()
+        response = self.post_batch([self.get_item(self.customer, self.other_sale, [(1, 500)])])
+        self.assertEqual(json.loads(response.content)['results'], [{'status': 'forbidden'}])
+        self.assertFalse(Collection.objects.exists())
+
+    def test_replayed_collections_are_saved_once(self):
+        item = self.get_item(self.customer, self.sale, [(1, 200)])
+        item['key'] = 'f1b0d7a6-6f5e-4bbf-9b0c-2f0e3c7c1d10'
+        first = json.loads(self.post_batch([item]).content)['results']
+        second = json.loads(self.post_batch([item, item]).content)['results']
+        self.assertEqual(second, first * 2)
+        self.assertEqual(Collection.objects.count(), 1)
+        self.assertEqual(SaleInstallment.objects.get(sale=self.sale, installment=1).paid_amount, 200)
+
+    def test_key_of_another_collector(self):
+        Collection.objects.create(collector=self.other_user, customer=self.other_customer, idempotency_key='abc')
+        item = self.get_item(self.customer, self.sale, [(1, 200)])
+        item['key'] = 'abc'
+        results = json.loads(self.post_batch([item]).content)['results']
+        self.assertEqual(results, [{'status': 'invalid'}])
+        self.assertEqual(SaleInstallment.objects.get(sale=self.sale, installment=1).paid_amount, 0)
+
+    def test_invalid_body(self):
+        response = self.client.post(reverse('create-collection-batch'), 'collections', content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_invalid_customers_do_not_affect_the_others(self):
+        response = self.post_batch([
+            {'installments': []},
+            {'customer': 'abc', 'installments': []},
+            'collection',
+            self.get_item(self.customer, self.sale, [(1, 500)]),
+        ])
+        self.assertEqual(response.status_code, 200)
+        results = json.loads(response.content)['results']
+        self.assertEqual([r['status'] for r in results], ['invalid', 'invalid', 'invalid', 'ok'])
+        self.assertEqual(Collection.objects.count(), 1)
+
+
+class TestCollectionDeliveryView(ReceiversMixin, TestCase):
+
+    def setUp(self):
+        self.set_receivers()
+
+        self.admin = User.objects.create_user(username='luciano', email='test@test.com', password='mypassword', is_staff=True)
+        self.user = User.objects.create_user(username='laura', email='test2@test.com', password='mypassword', is_collector=True)
+        self.other_user = User.objects.create_user(username='jose', email='test3@test.com', password='mypassword', is_collector=True)
+        self.customer = Customer.objects.create(name='Autoservicio Marcos', city='ARR', collector=self.user)
+        self.client.login(username='luciano', password='mypassword')
+
+    def create_collections(self, amounts, collector=None):
+        return [
+            Collection.objects.create(collector=collector or self.user, customer=self.customer, paid_amount=amount)
+            for amount in amounts
+        ]
+
+    def deliver(self, collections, collector=None):
+        return self.client.post(reverse('collection-delivery'), {
+            'selected-collector': (collector or self.user).pk,
+            'collection': [f'collection-{c.pk}' for c in collections],
+        })
+
+    def count_queries(self, collections):
+        with CaptureQueriesContext(connection) as context:
+            self.deliver(collections)
+        # Discard queries of the profiler, that randomly cleans old requests
+        return len([q for q in context.captured_queries if 'silk_' not in q['sql']])
+
+    def test_deliver_collections(self):
+        collections = self.create_collections([500, 200])
+        response = self.deliver(collections)
+        self.assertRedirects(response, reverse('collection-delivery'))
+        self.assertEqual(Collection.objects.filter(delivered=True).count(), 2)
+        self.assertEqual(set(CollectionDelivery.objects.values_list('collection', 'collector')), {(c.pk, self.user.pk) for c in collections})
+        batch = CollectionDeliveryBatch.objects.get()
+        self.assertEqual((batch.collector, batch.collections, batch.total), (self.user, 2, 700))
+        self.assertEqual(CollectionDelivery.objects.filter(batch=batch).count(), 2)
+
+    def test_deliver_collections_updates_sync_value(self):
+        KeyValueStore.update_sync([self.user.pk])
+        version = KeyValueStore.get_sync(self.user)
+        self.deliver(self.create_collections([500]))
+        self.assertNotEqual(KeyValueStore.get_sync(self.user), version)
+
+    def test_queries_do_not_depend_on_collections(self):
+        one_collection = self.count_queries(self.create_collections([500]))
+        five_collections = self.count_queries(self.create_collections([100, 200, 300, 400, 500]))
+        self.assertEqual(one_collection, five_collections)
+
+    def test_deliver_invalid_collections(self):
+        collections = self.create_collections([500])
+        delivered = self.create_collections([200])
+        self.deliver(delivered)
+        for invalid in [self.create_collections([300], self.other_user), delivered]:
+            response = self.deliver(collections + invalid)
+            self.assertEqual(response.status_code, 400)
+        self.assertFalse(Collection.objects.get(pk=collections[0].pk).delivered)
+        self.assertEqual(CollectionDelivery.objects.count(), 1)
+
+
+class TestCollectionDeliveryListView(ReceiversMixin, TestCase):
+
+    def setUp(self):
+        self.set_receivers()
+
+        self.admin = User.objects.create_user(username='luciano', email='test@test.com', password='mypassword', is_staff=True)
+        self.user = User.objects.create_user(username='laura', email='test2@test.com', password='mypassword', is_collector=True)
+        self.customer = Customer.objects.create(name='Autoservicio Marcos', city='ARR', collector=self.user)
+        self.client.login(username='luciano', password='mypassword')
+
+    def deliver(self, amounts):
+        collections = [Collection.objects.create(collector=self.user, customer=self.customer, paid_amount=amount) for amount in amounts]
+        return CollectionDeliveryBatch.settle(self.user, [c.pk for c in collections], timezone.now())
+
+    def count_queries(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(reverse('list-collection-delivery'))
+        # Discard queries of the profiler, that randomly cleans old requests
+        return response, len([q for q in context.captured_queries if 'silk_' not in q['sql']])
+
+    def test_total(self):
+        self.deliver([500, 200])
+        response, _ = self.count_queries()
+        self.assertEqual(response.context['total']['total'], 700)
+        self.assertContains(response, '700')
+
+    def test_queries_do_not_depend_on_deliveries(self):
+        self.deliver([500])
+        _, one_delivery = self.count_queries()
+        for amount in [100, 200, 300, 400]:
+            self.deliver([amount, amount])
+        _, five_deliveries = self.count_queries()
+        self.assertEqual(one_delivery, five_deliveries)
+
+    def get_batch_detail(self, batch):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(reverse('detail-collection-delivery', args=[batch.pk]))
+        # Discard queries of the profiler, that randomly cleans old requests
+        return response, len([q for q in context.captured_queries if 'silk_' not in q['sql']])
+
+    def test_batch_detail(self):
+        response, one_delivery = self.get_batch_detail(self.deliver([500]))
+        self.assertEqual(response.status_code, 200)
+        response, five_deliveries = self.get_batch_detail(self.deliver([500, 200, 100, 100, 100]))
+        self.assertEqual([d.collection.paid_amount for d in response.context['deliveries']], [500, 200, 100, 100, 100])
+        self.assertContains(response, 'Autoservicio Marcos', count=5)
+        self.assertEqual(one_delivery, five_deliveries)
+
+    def test_batch_detail_of_collector(self):
+        batch = self.deliver([500])
+        self.client.login(username='laura', password='mypassword')
+        response = self.client.get(reverse('detail-collection-delivery', args=[batch.pk]))
+        self.assertEqual(response.status_code, 403)
+
+
+class TestServiceWorkerView(ReceiversMixin, TestCase):
+
+    def setUp(self):
+        self.set_receivers()
+
+        service_worker.get_assets.cache_clear()
+        service_worker.get_version.cache_clear()
+
+    def test_assets(self):
+        assets = service_worker.get_assets()
+        with open(finders.find('js/sync.js'), 'rb') as f:
+            self.assertEqual(assets[static('js/sync.js')], hashlib.md5(f.read()).hexdigest()[:12])
+        self.assertIn(reverse('create-collection'), assets)
+        self.assertEqual(len(assets), len(service_worker.PAGES) + len(service_worker.STATIC_FILES) + len(service_worker.EXTERNAL_URLS))
+
+    def test_page_hash_includes_parent_templates(self):
+        sources = service_worker.get_template_sources('create_collection.html')
+        self.assertIn('base.html', sources)
+
+    def test_service_worker(self):
+        response = self.client.get(reverse('serviceworker'))
+        content = response.content.decode()
+        self.assertIn(f"const VERSION = '{service_worker.get_version()}';", content)
+        self.assertIn(f'"{static("js/sync.js")}": "{service_worker.get_assets()[static("js/sync.js")]}"', content)
+
+    def test_version_depends_on_assets(self):
+        version = service_worker.get_version()
+        service_worker.get_version.cache_clear()
+        with mock.patch.object(service_worker, 'get_assets', return_value={'/static/js/sync.js': 'changed'}):
+            self.assertNotEqual(service_worker.get_version(), version)
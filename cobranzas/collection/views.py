@@ -1,31 +1,35 @@
-from datetime import datetime, time
+import hashlib
+import json
+from datetime import datetime, time, timedelta
+from itertools import chain
 
 from django.contrib.auth.mixins import LoginRequiredMixin
+from django.core.cache import caches
 from django.core.exceptions import PermissionDenied, ValidationError
-from django.db import transaction
+from django.db import IntegrityError, transaction
 from django.db.models import Q, Sum, F, Count, Prefetch
-from django.db.models.signals import post_save
-from django.http import JsonResponse, Http404, HttpResponse
+from django.http import JsonResponse, Http404, HttpResponse, HttpResponseBadRequest, StreamingHttpResponse
 from django.shortcuts import redirect
 from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
 from django.utils.translation import gettext_lazy as _
 from django.views import View
-from django.views.generic import TemplateView, ListView
+from django.views.generic import TemplateView, ListView, DetailView
 from django.views.generic.base import ContextMixin, TemplateResponseMixin
 
-from app.models import Customer, Sale, SaleInstallment, SaleProduct, User
-from app.models import KeyValueStore
-from app.views import FilterSetView, ReceivableSalesView
+from app.models import Customer, CustomerBalance, Sale, SaleAging, SaleInstallment, SaleProduct, User
+from app.models import KeyValueStore, SyncTombstone
+from app.views import FilterSetView, KeysetPaginationMixin, ReceivableSalesView
 from collection.models import Collection, CollectionInstallment, CollectorSyncLog
-from collection.models import CollectionDelivery
+from collection.models import CollectionDelivery, CollectionDeliveryBatch
 
 from collection.forms import CollectionFormset, CollectionFilterForm, CollectionDeliveryFilterForm
+from collection.forms import CollectionPaymentForm
+from collection import service_worker
 
 from app.permissions import AdminPermission
 
-from app.serializers import SalesByCustomerSerializer, CustomersSerializer
-
-from app.signals import update_sync_value
+from app.serializers import SalesByCustomerValuesSerializer, CustomersSerializer, ColumnarDataSerializer
 
 from silk.profiling.profiler import silk_profile
 from rest_framework.renderers import JSONRenderer
@@ -33,107 +37,330 @@ from rest_framework.renderers import JSONRenderer
 
 class CollectionData(ReceivableSalesView):
 
-    def __get_data_sales_detail(self, filters):
-
-        def get_sale_collector_filter(item):
-            if isinstance(item, tuple) and item[0] == 'sale__collector':
-                return item[1]
-
-            if hasattr(item, 'children'):
-                for child in item.children:
-                    value = get_sale_collector_filter(child)
-                    if value:
-                        return value
-
-            return False
-
-        # Get value of collector filter from filters variable
-        # Because I need to apply this filter to sale_set prefetch
-        # instead of the main queryset, to get just sales where the
-        # collector is the current user
-        collector_filter = Q()
-        if 'sale__collector' in str(filters):
-            collector_value = get_sale_collector_filter(filters)
-            collector_filter = Q(collector=collector_value)
-
-        # Prefetch() executes a filter on the Sale records to filter already paid sales
-        # Prefetch() executes a filter on SaleInstallment to filter PAID installments
-        result = Customer.objects.\
-            prefetch_related(
-                Prefetch('sale_set', queryset=Sale.objects.filter(collector_filter).filter(uncollectible=False).annotate(paid_installments=Count('saleinstallment__pk', filter=Q(saleinstallment__status='PAID'))).exclude(installments__lte=F('paid_installments')).prefetch_related(
-                    Prefetch('saleinstallment_set', queryset=SaleInstallment.objects.filter(~Q(status='PAID')).order_by('installment'))
-                ).order_by('-id'))
-            ).\
-            filter(filters).distinct()
-
-        serializer = SalesByCustomerSerializer(result, many=True)
+    # Number of customers whose data is built at a time, and size of the chunks sent, when the
+    # data is streamed
+    stream_chunk_size = 500
+    stream_buffer_size = 64 * 1024
+    # The modification dates are set when the rows are saved, not when the transaction commits,
+    # so the cursor is moved back by more than the longest write transaction, and changes saved
+    # before the cursor but committed after the data was read are sent in the next sync
+    cursor_margin = timedelta(minutes=5)
+
+    def __get_data_sales_detail(self, filters, sales_filter):
+        return self.__get_sales_serializer(filters, sales_filter).data
+
+    def __get_sales_serializer(self, filters, sales_filter):
+        # "filters" selects the customers and "sales_filter" their sales
+        # Sales are filtered to exclude already paid sales
+        # and installments to exclude PAID installments
+        customers = Customer.objects.filter(filters).distinct()
+        sales = Sale.objects.\
+            filter(sales_filter).\
+            filter(uncollectible=False).\
+            annotate(paid_installments=Count('saleinstallment__pk', filter=Q(saleinstallment__status='PAID'))).\
+            exclude(installments__lte=F('paid_installments')).\
+            order_by('-id')
+        installments = SaleInstallment.objects.filter(~Q(status='PAID')).order_by('installment')
+
+        # Same data as SalesByCustomerSerializer, with a fixed number of queries
+        return SalesByCustomerValuesSerializer(customers, sales, installments)
+
+    def __get_data_customers_detail(self, customer, changed=None):
+        serializer = CustomersSerializer(self.__get_customers_detail(customer, changed), many=True)
         return serializer.data
 
-    def __get_data_customers_detail(self, customer):
+    def __get_customers_detail(self, customer, changed=None):
         if customer:
             filters = Q(id=customer)
         else:
             filters = Q()
 
+        # In delta mode only customers changed since the cursor are returned
+        if changed is not None:
+            filters &= Q(id__in=changed)
+
         # If the user is not an admin then filter collections by loggued user
         if self.request.user.is_admin:
             result = Customer.objects.filter(filters).order_by('name')
         else:
             result = Customer.objects.filter(filters).filter(collector=self.request.user).order_by('name')
 
-        serializer = CustomersSerializer(result, many=True)
-        return serializer.data
+        return result
+
+    def __get_changed_customers(self, since, filters):
+        '''
+        Return the ids of the customers in the user's scope ("filters") whose own record, one of
+        its sales or one of the installments of its sales have been modified after the cursor,
+        and of the customers that left the user's scope after the cursor (SyncTombstone)
+        '''
+        sales = Sale.objects.filter(modification__gt=since).values('customer')
+        installments = SaleInstallment.objects.filter(modification__gt=since).values('sale__customer')
+        changed = Customer.objects.\
+            filter(filters).\
+            filter(Q(modification__gt=since) | Q(pk__in=sales) | Q(pk__in=installments)).\
+            values_list('pk', flat=True)
+
+        # Admins synchronize every customer, so they also remove the customers that left the
+        # scope of any collector, if they were deleted
+        tombstones = SyncTombstone.objects.filter(date__gt=since)
+        if not self.request.user.is_admin:
+            tombstones = tombstones.filter(collector=self.request.user)
+        return set(changed.union(tombstones.values_list('customer_id', flat=True)))
+
+    def get_next_cursor(self):
+        '''Return the cursor of the data built now, to be sent back as "since" in the next sync'''
+        return f'{(timezone.now() - self.cursor_margin).timestamp():.6f}'
+
+    def get_cursor(self, value):
+        '''
+        Convert the "since" param (a timestamp returned as "cursor" in a previous sync)
+        to an aware datetime. Raise ValueError if the value is not a valid cursor.
+        '''
+        return datetime.fromtimestamp(float(value), tz=timezone.utc)
+
+    def get_data(self, customer=None, since=None, columnar=False):
+        '''
+        Return sales/installments and customers data for the current user.
+        If "since" is provided (delta mode) only customers changed after that datetime are
+        returned, and "deleted" lists the customers that left the user's scope after it, so the
+        client can remove them from its local database.
+        If "columnar" is True the data is returned in the format of ColumnarDataSerializer.
+        '''
+        # Version of the user's data, it only changes when the data of the user changes.
+        # It's read before the data, so the data is never older than its version
+        last_update = KeyValueStore.get_sync(self.request.user)
+
+        # The whole data is cached for each user and version, so it's invalidated by the signals
+        # that update the version. Delta syncs are not cached, they are different for each cursor
+        cache_key = None
+        if since is None and last_update is not None:
+            cache_key = self.get_data_cache_key(last_update, customer, columnar)
+            res = caches['sync'].get(cache_key)
+            if res is not None:
+                return res
+
+        # Take the cursor before running any query, moved back by cursor_margin, so changes not
+        # committed yet when the data is read are sent again in the next sync instead of being lost
+        cursor = self.get_next_cursor()
 
-    def get_data(self, customer=None):
         filters = self.get_customers_filter(customer)
-        sales = self.__get_data_sales_detail(filters)
-        customers = self.__get_data_customers_detail(customer)
-        last_update = KeyValueStore.get('sync')
+        changed = None
+        if since is not None:
+            # Only the changed customers in the user's scope, and the ones that left it
+            changed = self.__get_changed_customers(since, filters)
+            filters &= Q(id__in=changed)
+
+        sales = self.__get_data_sales_detail(filters, self.get_sales_filter(customer))
+        customers = self.__get_data_customers_detail(customer, changed)
 
         data = {
             'sales': sales,
             'customers': customers,
-            'last_update': last_update
+            'last_update': last_update,
+            'cursor': cursor
         }
 
+        if changed is not None:
+            data['deleted'] = {
+                'sales': sorted(changed - {s['pk'] for s in sales}),
+                'customers': sorted(changed - {c['pk'] for c in customers})
+            }
+
+        if columnar:
+            data = ColumnarDataSerializer(data).data
+
         res = JSONRenderer().render(data)
+        if cache_key:
+            caches['sync'].set(cache_key, res)
 
         return res
 
+    def stream_data(self):
+        '''
+        Return a generator of the whole data of the current user, the same JSON returned by
+        get_data(), built and sent in chunks. It's used for admins, whose data includes every
+        customer, so the memory used doesn't depend on the number of customers.
+        '''
+        # Like in get_data, version and cursor are taken before running any query
+        last_update = KeyValueStore.get_sync(self.request.user)
+        cursor = self.get_next_cursor()
+        sales = self.__get_sales_serializer(self.get_customers_filter(None), self.get_sales_filter(None))
+        customers = self.__get_customers_detail(None)
+        return self.__render_stream(sales, customers, last_update, cursor)
+
+    def __render_stream(self, sales, customers, last_update, cursor):
+
+        def render_list(items):
+            for i, item in enumerate(items):
+                if i:
+                    yield b','
+                yield renderer.render(item)
+
+        renderer = JSONRenderer()
+        customers = customers.iterator(chunk_size=self.stream_chunk_size)
+        parts = chain(
+            [b'{"sales":['],
+            render_list(sales.iterator(self.stream_chunk_size)),
+            [b'],"customers":['],
+            render_list(CustomersSerializer(customer).data for customer in customers),
+            [f'],"last_update":{json.dumps(last_update)},"cursor":{json.dumps(cursor)}}}'.encode()],
+        )
+
+        # Send chunks of stream_buffer_size instead of a chunk for each customer
+        buffer = bytearray()
+        for part in parts:
+            buffer += part
+            if len(buffer) >= self.stream_buffer_size:
+                yield bytes(buffer)
+                buffer.clear()
+        yield bytes(buffer)
+
+    def get_data_cache_key(self, version, customer=None, columnar=False):
+        # Every admin gets the same data
+        user = self.request.user
+        scope = 'admin' if user.is_admin else user.pk
+        data_format = 'columnar' if columnar else 'json'
+        return f'collection-data.{scope}.{customer or "all"}.{data_format}.{version}'
+
     def get_customers(self, user):
         # If the user is not an admin then filter collections by loggued user
         if not user.is_admin:
-            # Customers assigned to the current user
-            collector_customers = Customer.objects.filter(collector=user)
-            # Sales whose collection is assigned to the current collector
-            sales_id = self.get_pending_sales(Q(collector=user), ['customer'])
-
-            filters = Q()
-            for id in sales_id:
-                filters |= Q(id=id['customer'])
-            sales_customers = Customer.objects.filter(filters)
-            # Join customer querysets and discard repeated
-            customers = collector_customers.union(sales_customers).order_by('name').values('pk', 'name')
+            # Customers assigned to the current user, or with sales assigned to the current user
+            customers = Customer.objects.filter(id__in=self.get_collector_scope(user)['customers']).order_by('name').values('pk', 'name')
         else:
             customers = Customer.objects.order_by('name').values('pk', 'name')
 
         return customers
 
     def collector_validation(self, customer, user):
-        # Valid customer validation
-        customer_record = Customer.objects.get(id=customer)
-        if not customer_record:
-            raise Http404
-
         # If the current collector is not an admin
         # Raise a 403 error if the selected customer is not assigned to the collector
         if not user.is_admin:
-            if customer_record.collector != user:
-                sales_whose_collector_is_user = self.get_pending_sales(Q(customer=customer, collector=user), ['pk'])
-                if sales_whose_collector_is_user.count() == 0:
-                    raise PermissionDenied
+            if customer in self.get_collector_scope(user)['customers']:
+                return True
+            if Customer.objects.filter(id=customer).exists():
+                raise PermissionDenied
+
+        # Valid customer validation
+        elif Customer.objects.filter(id=customer).exists():
+            return True
+
+        raise Http404
+
+    def get_saved_collection(self, collector, idempotency_key):
+        '''Return the collection already saved by the collector with the idempotency key, if any'''
+        if not idempotency_key:
+            return None
+        return Collection.objects.filter(idempotency_key=idempotency_key, collector=collector).first()
+
+    def create_collection(self, customer, collector, payments, idempotency_key=None):
+        '''
+        Save the collection in its own transaction. If a collection was already saved with the
+        same idempotency key, the request is a replay and the stored collection is returned
+        without paying the installments again.
+        '''
+        if idempotency_key and len(idempotency_key) > Collection._meta.get_field('idempotency_key').max_length:
+            raise ValidationError(_('Invalid idempotency key'))
+
+        collection = self.get_saved_collection(collector, idempotency_key)
+        if collection is not None:
+            return collection
+
+        # Collectors can only pay the sales they can see
+        if not collector.is_admin:
+            sales = self.get_collector_scope(collector)['sales']
+            if any(payment['sale_id'] not in sales for payment in payments):
+                raise PermissionDenied
+
+        try:
+            with transaction.atomic():
+                return self.save_collection(customer, collector, payments, idempotency_key)
+        except IntegrityError:
+            # A concurrent request with the same idempotency key was saved first
+            collection = self.get_saved_collection(collector, idempotency_key)
+            if collection is None:
+                raise
+            return collection
+
+    def save_collection(self, customer, collector, payments, idempotency_key=None):
+        '''
+        Create a collection for the customer paying the installments in "payments", a list of
+        dictionaries with sale_id, installment and amount keys. It must be called inside a
+        transaction, the paid sales and installments are locked until it ends.
+        The number of queries doesn't depend on the number of paid installments.
+        '''
+        # An installment sent more than once is paid once, with the sum of the amounts
+        merged = {}
+        for payment in payments:
+            key = (payment['sale_id'], payment['installment'])
+            if key in merged:
+                merged[key] = {**merged[key], 'amount': merged[key]['amount'] + payment['amount']}
+            else:
+                merged[key] = payment
+        payments = list(merged.values())
+
+        # To sum the total paid amount and prevent saving empty collections
+        check_total = sum(payment['amount'] for payment in payments)
+        if check_total == 0:
+            raise ValidationError(_('The total paid must be greater than zero'))
+
+        # Get and lock every paid installment, and its sale, in a single query
+        sales_id = {payment['sale_id'] for payment in payments}
+        installments_filter = Q()
+        for payment in payments:
+            installments_filter |= Q(sale=payment['sale_id'], installment=payment['installment'])
+        sale_installments = {
+            (i.sale_id, i.installment): i
+            for i in SaleInstallment.objects.select_for_update().select_related('sale').filter(installments_filter)
+        }
+
+        # Check that the sales correspond to the selected customer
+        for sale_installment in sale_installments.values():
+            sale = sale_installment.sale
+            if sale.customer_id != customer.pk or sale.uncollectible is True:
+                raise PermissionDenied
+
+        collection = Collection(
+            collector=collector,
+            customer=customer,
+            idempotency_key=idempotency_key or None,
+            paid_amount=check_total
+        )
+        collection.save()
+
+        now = timezone.now()
+        collection_installments = []
+        for payment in payments:
+            sale_installment = sale_installments.get((payment['sale_id'], payment['installment']), None)
+            if sale_installment is None:
+                raise ValidationError(_('The installment does not exist'))
+
+            collection_installments.append(CollectionInstallment(
+                collection=collection,
+                sale_installment=sale_installment,
+                amount=payment['amount']
+            ))
+
+            # Update the paid amount and the status from the sale installment record
+            sale_installment.paid_amount += payment['amount']
+            if sale_installment.installment_amount > sale_installment.paid_amount:
+                sale_installment.status = SaleInstallment.PARTIAL
+            else:
+                sale_installment.status = SaleInstallment.PAID
+            # bulk_update doesn't set auto_now fields
+            sale_installment.modification = now
 
-        return True
+        CollectionInstallment.objects.bulk_create(collection_installments)
+        SaleInstallment.objects.bulk_update(sale_installments.values(), ['paid_amount', 'status', 'modification'])
+
+        # Update paid amount and pending balance of the paid sales, the customer receivables and the aging
+        Sale.update_balances(sales_id)
+        # Customers with sales assigned to another collector leave its scope when the sales are paid
+        SyncTombstone.add_paid_sales(sales_id)
+        CustomerBalance.update_balances([collection.customer_id])
+        SaleAging.update_sales(sales_id)
+
+        return collection
 
 
 class ServiceWorkerView(TemplateView):
@@ -142,7 +369,10 @@ class ServiceWorkerView(TemplateView):
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context['version'] = '1.72'
+        # Version and assets are calculated from the content of the files, so the service worker
+        # is updated, and only the changed assets are downloaded again, when a file changes
+        context['version'] = service_worker.get_version()
+        context['assets'] = json.dumps(service_worker.get_assets(), indent=2)
         return context
 
 
@@ -187,79 +417,37 @@ class CollectionCreationView(LoginRequiredMixin, ContextMixin, TemplateResponseM
 
     @silk_profile(name='Collection Post')
     def post(self, request, *args, **kwargs):
-        context = self.get_context_data(**kwargs)
+        self.collector = request.user
         selected_customer = request.POST.get('customer', None)
         customer = Customer.objects.get(id=selected_customer)
         if customer:
             # If the current collector is not an admin and collector is not assigned to a sale 
             # or the whole customer, raise a 403 error
-            if not self.collector_validation(selected_customer, self.collector):
+            if not self.collector_validation(customer.pk, self.collector):
                 raise PermissionDenied
 
             collection_formset = CollectionFormset(
                 self.request.POST,
                 prefix='collection'
             )
+            # Validate every paid installment before writing anything
+            payments = []
+            for f_form in collection_formset:
+                # If form has changed the field "checked" then it is being paid
+                if 'checked' in f_form.changed_data:
+                    # Forms with errors are not paid
+                    if f_form.is_valid():
+                        payments.append(f_form.cleaned_data)
+
             # If there is an exception commits are rolled back
-            with transaction.atomic():
-                collection = None
-                # In this list I will save already checked sales
-                sales_check_collection = []
-                # To sum the total paid amount and prevent saving empty collections
-                check_total = 0
-
-                for f_form in collection_formset:
-                    # If form has changed the field "checked" then it is being paid
-                    if 'checked' in f_form.changed_data:
-                        # Check if form is valid or not
-                        if f_form.is_valid():
-                            data = f_form.cleaned_data
-
-                            check_total += data['amount']
-
-                            # Check that the sale corresponds to the selected customer
-                            if not data['sale_id'] in sales_check_collection:
-                                sale = Sale.objects.get(id=data['sale_id'])
-                                if sale.customer != customer or sale.uncollectible is True:
-                                    raise PermissionDenied
-                                # Add the sale to the list to prevent check it again if there are
-                                # more than one paid installment
-                                sales_check_collection.append(data['sale_id'])
-
-                            # If collection record has not being created
-                            if not collection:
-                                collection = Collection(
-                                    collector=request.user,
-                                    customer=customer
-                                )
-                                collection.save()
-
-                            # Create collection installment record
-                            sale_installment = SaleInstallment.objects.get(
-                                sale=data['sale_id'],
-                                installment=data['installment']
-                            )
-                            collection_installment = CollectionInstallment(
-                                collection=collection,
-                                sale_installment=sale_installment,
-                                amount=data['amount']
-                            )
-                            collection_installment.save()
-
-                            # Update the paid amount and the status from the sale installment record
-                            installment_amount = sale_installment.installment_amount
-                            paid_amount = sale_installment.paid_amount
-                            if installment_amount > paid_amount + data['amount']:
-                                sale_installment.status = SaleInstallment.PARTIAL
-                            else:
-                                sale_installment.status = SaleInstallment.PAID
-                            sale_installment.paid_amount = F('paid_amount') + data['amount']
-                            sale_installment.save()
-                        else:
-                            # If form has errors
-                            print(f_form.errors)
-                if check_total == 0:
-                    raise ValidationError(_('The total paid must be greater than zero'))
+            idempotency_key = request.POST.get('idempotency_key', None)
+            try:
+                collection = self.create_collection(customer, request.user, payments, idempotency_key)
+            except IntegrityError:
+                # The key was already used by a collection of another collector
+                if idempotency_key and Collection.objects.filter(idempotency_key=idempotency_key).exists():
+                    return HttpResponse(_('The idempotency key belongs to another collection'), status=409)
+                raise
 
         response_data = {}
         response_data['collection_id'] = collection.pk
@@ -267,6 +455,84 @@ class CollectionCreationView(LoginRequiredMixin, ContextMixin, TemplateResponseM
         return JsonResponse(response_data)
 
 
+class CollectionBatchCreationView(LoginRequiredMixin, CollectionData, View):
+    '''
+    Save every collection stored offline by the app in a single request. The body is a JSON:
+    {"collections": [{"customer": 1, "key": "...", "installments": [{"sale_id": 1, "installment": 2, "amount": 100}]}]}
+    Each collection is saved in its own transaction, and the response has a result for each one,
+    in the same order: {"results": [{"status": "ok", "collection_id": 10}, {"status": "forbidden"}]}
+    A collection sent again with the same key returns the collection saved the first time.
+    '''
+    OK = 'ok'
+    INVALID = 'invalid'
+    FORBIDDEN = 'forbidden'
+    NOT_FOUND = 'not_found'
+
+    def get_payments(self, installments):
+        if not isinstance(installments, list) or not all(isinstance(i, dict) for i in installments):
+            raise ValidationError(_('Invalid collections data'))
+
+        payments = []
+        for installment in installments:
+            form = CollectionPaymentForm(installment)
+            if not form.is_valid():
+                raise ValidationError(form.errors)
+            payments.append(form.cleaned_data)
+        return payments
+
+    def save_batch_item(self, item, customers, allowed_customers):
+        try:
+            customer = customers.get(int(item['customer']), None)
+            installments = item['installments']
+            idempotency_key = item.get('key', None)
+        except (KeyError, TypeError, ValueError, AttributeError):
+            return {'status': self.INVALID}
+
+        if customer is None:
+            return {'status': self.NOT_FOUND}
+        # Same rule as collector_validation, using the customers loaded for the whole batch
+        if allowed_customers is not None and customer.pk not in allowed_customers:
+            return {'status': self.FORBIDDEN}
+
+        try:
+            if idempotency_key is not None and not isinstance(idempotency_key, str):
+                raise ValidationError(_('Invalid idempotency key'))
+            payments = self.get_payments(installments)
+            collection = self.create_collection(customer, self.request.user, payments, idempotency_key)
+        except PermissionDenied:
+            return {'status': self.FORBIDDEN}
+        except (ValidationError, IntegrityError):
+            return {'status': self.INVALID}
+
+        return {'status': self.OK, 'collection_id': collection.pk}
+
+    @silk_profile(name='Collection Batch Post')
+    def post(self, request, *args, **kwargs):
+        try:
+            collections = json.loads(request.body)['collections']
+        except (KeyError, TypeError, ValueError):
+            return HttpResponseBadRequest(_('Invalid collections data'))
+        if not isinstance(collections, list):
+            return HttpResponseBadRequest(_('Invalid collections data'))
+
+        # Lookups shared by every collection in the batch. The invalid collections are reported
+        # in their own result by save_batch_item
+        customers_id = set()
+        for item in collections:
+            try:
+                customers_id.add(int(item['customer']))
+            except (KeyError, TypeError, ValueError):
+                continue
+        customers = Customer.objects.in_bulk(customers_id)
+        allowed_customers = None
+        if not request.user.is_admin:
+            allowed_customers = self.get_collector_scope(request.user)['customers']
+
+        results = [self.save_batch_item(item, customers, allowed_customers) for item in collections]
+
+        return JsonResponse({'results': results})
+
+
 class CollectionUpdateView(LoginRequiredMixin, AdminPermission, TemplateView):
     template_name = 'update_collection.html'
 
@@ -286,19 +552,26 @@ class CollectionUpdateView(LoginRequiredMixin, AdminPermission, TemplateView):
             order_by('sale_installment__sale', 'sale_installment__installment')
         sales_id = {installment['sale_installment__sale'] for installment in collection_installment}
 
-        for id in sales_id:
+        sales = Sale.objects.\
+            filter(pk__in=sales_id).\
+            values('pk', 'installments', 'date', 'price', 'paid_amount', 'pending_balance')
+        products = SaleProduct.objects.\
+            filter(sale__in=sales_id).\
+            values('sale', 'product__name').\
+            order_by('pk')
+
+        for sale_object in sales:
             sale = dict()
 
-            sale_object = Sale.objects.get(pk=id)
-            products = SaleProduct.objects.filter(sale=id).values('product__name')
+            id = sale_object['pk']
             sale_data = {
-                'id': sale_object.pk,
-                'installments': sale_object.installments,
-                'date': sale_object.date,
-                'price': sale_object.price,
-                'paid_amount': sale_object.paid_amount,
-                'pending_balance': sale_object.pending_balance,
-                'products': [p['product__name'] for p in products]
+                'id': id,
+                'installments': sale_object['installments'],
+                'date': sale_object['date'],
+                'price': sale_object['price'],
+                'paid_amount': sale_object['paid_amount'],
+                'pending_balance': sale_object['pending_balance'],
+                'products': [p['product__name'] for p in products if p['sale'] == id]
             }
 
             sale['sale'] = sale_data
@@ -319,6 +592,8 @@ class CollectionUpdateView(LoginRequiredMixin, AdminPermission, TemplateView):
         context = self.get_context_data(**kwargs)
         installments_list = request.POST.getlist('collection-installment')
         collection = Collection.objects.get(pk=context['collection_id'])
+        # Sales whose paid amount has changed
+        sales = set()
         for i in installments_list:
             sale_id, installment_id = i.split('-')
             new_paid_amount = float(request.POST.get(f'amount-{i}'))
@@ -353,13 +628,22 @@ class CollectionUpdateView(LoginRequiredMixin, AdminPermission, TemplateView):
                     sale_installment.save()
                 except:
                     raise ValidationError(_('Collection could not be saved'))
+                sales.add(sale_installment.sale_id)
+
+        Sale.update_balances(sales)
+        # Customers with sales assigned to another collector leave its scope when the sales are paid
+        SyncTombstone.add_paid_sales(sales)
+        Collection.update_paid_amounts([collection.pk])
+        CustomerBalance.update_balances([collection.customer_id])
+        SaleAging.update_sales(sales)
 
         return redirect('list-collection')
 
 
-class CollectionListView(LoginRequiredMixin, ListView, FilterSetView):
+class CollectionListView(LoginRequiredMixin, KeysetPaginationMixin, ListView, FilterSetView):
     template_name = 'list_collection.html'
     context_object_name = 'collections'
+    keyset = ['-pk']
     filterset = [
         ('collector', 'collector', 'exact'),
         ('customer', 'customer', 'exact'),
@@ -380,7 +664,6 @@ class CollectionListView(LoginRequiredMixin, ListView, FilterSetView):
                     ))
                 ).\
                 select_related('customer').\
-                annotate(paid_amount=Sum('collectioninstallment__amount')).\
                 order_by('-pk').\
                 all()
         else:
@@ -399,7 +682,6 @@ class CollectionListView(LoginRequiredMixin, ListView, FilterSetView):
                     ))
                 ).\
                 select_related('customer').\
-                annotate(paid_amount=Sum('collectioninstallment__amount')).\
                 order_by('-pk').\
                 all()
 
@@ -433,7 +715,6 @@ class CollectionDeliveryView(LoginRequiredMixin, AdminPermission, TemplateView):
             context['selected_collector'] = selected_collector
             context['collections'] = Collection.objects.\
                 filter(collector=selected_collector, delivered=False).\
-                annotate(amount=Sum('collectioninstallment__amount')).\
                 prefetch_related('customer').\
                 order_by('date')
         return self.render_to_response(context)
@@ -441,36 +722,34 @@ class CollectionDeliveryView(LoginRequiredMixin, AdminPermission, TemplateView):
     def post(self, request, *args, **kwargs):
         context = self.get_context_data(**kwargs)
 
-        # Disable signal to avoid updating Sync value repeteadly
-        post_save.disconnect(receiver=update_sync_value, sender=Collection, dispatch_uid='app.signals.update_sync_value.Collection')
-
         selected_collector = request.POST.get('selected-collector', None)
         if selected_collector:
-            collection_list = request.POST.getlist('collection')
-            date = datetime.now()
+            try:
+                collections_id = [int(c.split('-')[1]) for c in request.POST.getlist('collection')]
+            except (IndexError, ValueError):
+                raise ValidationError(_('Invalid collections data'))
             collector = User.objects.get(id=selected_collector)
-            # TODO: Create CollectionDelivery using bulk_create and validate data using full_clean
-            with transaction.atomic():
-                for c in collection_list:
-                    collection_id = int(c.split('-')[1])
-                    collection = Collection.objects.get(pk=collection_id)
-                    collection_delivery = CollectionDelivery(
-                        collection=collection,
-                        collector=collector,
-                        date=date
-                    )
-                    collection_delivery.save()
-                    collection.delivered = True
-                    collection.save()
+
+            if collections_id:
+                try:
+                    with transaction.atomic():
+                        CollectionDeliveryBatch.settle(collector, collections_id, timezone.now())
+                except ValidationError as e:
+                    # Collections of another collector, or already delivered in another request
+                    return HttpResponseBadRequest(' '.join(e.messages))
+                # Update the Sync value once for the whole delivery
+                KeyValueStore.update_sync([collector.pk])
         else:
             raise ValidationError(_('The Collector has not been specified'))
 
         return redirect('collection-delivery')
 
 
-class CollectionDeliveryListView(LoginRequiredMixin, AdminPermission, ListView, FilterSetView):
+class CollectionDeliveryListView(LoginRequiredMixin, AdminPermission, KeysetPaginationMixin, ListView, FilterSetView):
     template_name = 'list_collection_delivery.html'
-    context_object_name = 'collections_delivery'
+    context_object_name = 'delivery_batches'
+    keyset = ['collector_id', '-pk']
+    totals = {'total': 'total'}
     filterset = [
         ('collector', 'collector', 'exact'),
         ('date_from', 'date', 'gte'),
@@ -481,9 +760,9 @@ class CollectionDeliveryListView(LoginRequiredMixin, AdminPermission, ListView,
 
         filters = self.get_filters(self.request)
         if filters:
-            queryset = CollectionDelivery.objects.\
+            queryset = CollectionDeliveryBatch.objects.\
                 filter(filters).\
-                select_related('collection', 'collection__customer', 'collector').\
+                select_related('collector').\
                 order_by('collector', '-pk').\
                 all()
         else:
@@ -493,9 +772,9 @@ class CollectionDeliveryListView(LoginRequiredMixin, AdminPermission, ListView,
             date_start = datetime.combine(today, time.min)
             value = timezone.make_aware(date_start, tz, False)
 
-            queryset = CollectionDelivery.objects.\
+            queryset = CollectionDeliveryBatch.objects.\
                 filter(date__gte=value).\
-                select_related('collection', 'collection__customer', 'collector').\
+                select_related('collector').\
                 order_by('collector', '-pk').\
                 all()
 
@@ -503,9 +782,22 @@ class CollectionDeliveryListView(LoginRequiredMixin, AdminPermission, ListView,
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        queryset = self.get_queryset()
         context['filter_form'] = CollectionDeliveryFilterForm(self.request.GET)
-        context['total'] = queryset.aggregate(total=Sum('collection__collectioninstallment__amount'))
+        context['total'] = self.get_totals()
+        return context
+
+
+class CollectionDeliveryBatchView(LoginRequiredMixin, AdminPermission, DetailView):
+    template_name = 'detail_collection_delivery.html'
+    context_object_name = 'batch'
+    queryset = CollectionDeliveryBatch.objects.select_related('collector')
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['deliveries'] = CollectionDelivery.objects.\
+            filter(batch=self.object).\
+            select_related('collection', 'collection__customer').\
+            order_by('collection')
         return context
 
 
@@ -532,9 +824,7 @@ class CollectionPrintView(LoginRequiredMixin, TemplateView):
                 filter(collection=collection_id).\
                 prefetch_related('sale_installment').\
                 prefetch_related('sale_installment__sale')
-            total = CollectionInstallment.objects.\
-                filter(collection=collection_id).\
-                aggregate(total=Sum('amount'))
+            total = {'total': collection.paid_amount}
 
             context['collection'] = collection
             context['collection_installment'] = collection_installment
@@ -547,14 +837,80 @@ class LocalCollectionPrintView(LoginRequiredMixin, TemplateView):
 
 
 class CollectionDataView(LoginRequiredMixin, ContextMixin, CollectionData, View):
+    # Media type of the columnar format (ColumnarDataSerializer), returned if the request
+    # explicitly accepts it
+    columnar_content_type = 'application/vnd.cobranzas.columnar+json'
+
+    def accepts_columnar(self, request):
+        accept = request.META.get('HTTP_ACCEPT', '')
+        return self.columnar_content_type in [t.split(';')[0].strip() for t in accept.split(',')]
+
+    def get_since(self, request):
+        '''
+        Return the cursor of a delta sync ("since" param) as a datetime, None for a full sync.
+        A cursor older than the tombstones (SyncTombstone.RETENTION) gets a full sync, since the
+        customers that left the user's scope before the oldest tombstone are unknown.
+        Raise ValueError if the param is not a valid cursor.
+        '''
+        since_param = request.GET.get('since', None)
+        if not since_param:
+            return None
+        since = self.get_cursor(since_param)
+        if since < timezone.now() - SyncTombstone.RETENTION:
+            return None
+        return since
+
+    def is_streamed(self, request):
+        # The whole data of an admin includes every customer, so it's streamed instead of being
+        # built in memory. It's only available in the nested format
+        try:
+            return request.user.is_admin and self.get_since(request) is None
+        except (ValueError, OverflowError):
+            return False
+
+    def get_etag(self, request):
+        '''
+        The data only changes when the sync version of the user changes, but it's different for each
+        user, for each query (full or delta sync) and for each format, so all of them are part of the ETag
+        '''
+        user = request.user
+        query = hashlib.md5(request.META.get('QUERY_STRING', '').encode()).hexdigest()
+        data_format = 'columnar' if self.accepts_columnar(request) and not self.is_streamed(request) else 'json'
+        return f'"{KeyValueStore.get_sync(user)}-{user.pk}-{int(user.is_admin)}-{query}-{data_format}"'
 
     @silk_profile(name='CollectionData get')
     def get(self, request, *args, **kwargs):
-        # get_data return sales and installments data
-        data = self.get_data()
+        # If the app already has the current data answer with a 304 before building it
+        etag = self.get_etag(request)
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            response = self.get_data_response(request)
+        # The browser must always check with the server if its cached copy is still valid
+        response.headers['ETag'] = etag
+        patch_cache_control(response, private=True, no_cache=True)
+        patch_vary_headers(response, ['Accept'])
 
         CollectorSyncLog.objects.create(user=request.user)
 
+        return response
+
+    def get_data_response(self, request):
+        # If "since" is present only changes after that cursor are returned (delta sync)
+        try:
+            since = self.get_since(request)
+        except (ValueError, OverflowError):
+            return HttpResponseBadRequest(_('Invalid synchronization cursor'))
+
+        if self.is_streamed(request):
+            return StreamingHttpResponse(self.stream_data(), content_type="application/json")
+
+        # get_data return sales and installments data
+        if self.accepts_columnar(request):
+            data = self.get_data(since=since, columnar=True)
+            return HttpResponse(data, content_type=self.columnar_content_type)
+
+        data = self.get_data(since=since)
+
         return HttpResponse(data, content_type="application/json")
 
 
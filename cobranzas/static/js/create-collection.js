@@ -19,6 +19,8 @@ const filterCustomerForm = document.getElementById('filter-customer');
 const selectCustomer = filterCustomerForm.querySelector('#select-customer');
 // Hidden input to store the selected customer
 const selectedCustomerInput = document.querySelector('.create-collection input.selected-customer');
+// Hidden input to identify the collection, so it's saved only once if it's sent again
+const idempotencyKeyInput = document.querySelector('.create-collection input.idempotency-key');
 // Create collection form
 const createCollectionForm = document.getElementById('create-collection');
 const collectionContainer = document.querySelector(".collection-container");
@@ -155,6 +157,9 @@ createCollectionForm.addEventListener('submit', async event => {
     oldStoredCollections = values;
   });
 
+  // New key for this collection, stored with it if the app is offline
+  idempotencyKeyInput.setAttribute('value', crypto.randomUUID());
+
   // Send the request by hand to check the server response and 
   // update the local database if the request was successful
   fetch(event.target.action, {
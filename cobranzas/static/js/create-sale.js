@@ -24,6 +24,8 @@ const priceInput = document.getElementById("id_price");
 const installmentsInput = document.getElementById("id_installments");
 // Installment amount input
 const installmentAmountInput = document.getElementById("id_installment_amount");
+// Payment detail section, with the URL of the installment plan preview
+const paymentScheme = document.getElementById("payment-scheme");
 // Payment detail rows
 const paymentSchemeRow1 = document.getElementById("payment-scheme-row-1");
 const paymentSchemeRow2 = document.getElementById("payment-scheme-row-2");
@@ -177,6 +179,35 @@ function updatePaymentSchemeRow(row, installments, installmentAmount) {
   });
 }
 
+// Get the installment plan from the server, calculated as the installments created when the sale is saved
+async function getInstallmentPlan(params) {
+  const response = await fetch(`${paymentScheme.dataset.planUrl}?${new URLSearchParams(params)}`);
+  if (!response.ok) {
+    return null;
+  }
+  return response.json();
+}
+
+// Update the installments inputs and the payment details section with the installment plan
+function showInstallmentPlan(plan) {
+  if (plan === null) {
+    blankPaymentSchemeCalculation();
+    return;
+  }
+  installmentsInput.value = plan.installments;
+  installmentAmountInput.value = plan.installment_amount.toFixed(2);
+
+  // The plan has one or two rows: the installments of the same amount, and the last installment
+  updatePaymentSchemeRow(paymentSchemeRow1, plan.scheme[0].installments, plan.scheme[0].installment_amount);
+  togglePaymentSchemeRow(paymentSchemeRow1, "visible");
+  if (plan.scheme.length > 1) {
+    updatePaymentSchemeRow(paymentSchemeRow2, plan.scheme[1].installments, plan.scheme[1].installment_amount);
+    togglePaymentSchemeRow(paymentSchemeRow2, "visible");
+  } else {
+    togglePaymentSchemeRow(paymentSchemeRow2, "hidden");
+  }
+}
+
 
 //// EVENTS ////
 
@@ -252,44 +283,13 @@ addFormButton.addEventListener("click", (e) => {
 });
 
 // Update payment scheme on installments input value change
-installmentsInput.addEventListener("change", (e) => {
-  const price = parseFloat(priceInput.value);
-  const installments = parseInt(installmentsInput.value);
-  const installmentAmount = price / installments;
-  // Update installment amount value
-  installmentAmountInput.value = installmentAmount.toFixed(2);
-
-  //Update payment scheme row 1, and hide row 2
-  updatePaymentSchemeRow(paymentSchemeRow1, installments, installmentAmount);
-  togglePaymentSchemeRow(paymentSchemeRow1, "visible");
-  togglePaymentSchemeRow(paymentSchemeRow2, "hidden");
+installmentsInput.addEventListener("change", async (e) => {
+  const plan = await getInstallmentPlan({ price: priceInput.value, installments: installmentsInput.value });
+  showInstallmentPlan(plan);
 });
 
 // Update payment scheme on installemnt amount input value change
-installmentAmountInput.addEventListener("change", (e) => {
-  const price = parseFloat(priceInput.value);
-  const installmentAmount = parseFloat(installmentAmountInput.value);
-  const installments = price / installmentAmount;
-
-  // Show payment scheme row 1
-  togglePaymentSchemeRow(paymentSchemeRow1, "visible");
-  if (Number.isInteger(installments)) {
-    // If installments is integer, update payment scheme row 1 and hide row 2
-    installmentsInput.value = installments;
-    updatePaymentSchemeRow(paymentSchemeRow1, installments, installmentAmount);
-    togglePaymentSchemeRow(paymentSchemeRow2, "hidden");
-  } else {
-    // If installments is not integer calculate the amount of the last installment
-    rest = installments - Math.trunc(installments);
-    newQuantity = Math.trunc(installments);
-    if (rest <= 0.6) {
-      newQuantity--;
-    }
-    installmentsInput.value = newQuantity + 1;
-    lastInstallmentAmount = price - newQuantity * installmentAmount;
-    // Update payment scheme rows 1 and 2, and show row 2
-    updatePaymentSchemeRow(paymentSchemeRow1, newQuantity, installmentAmount);
-    updatePaymentSchemeRow(paymentSchemeRow2, 1, lastInstallmentAmount);
-    togglePaymentSchemeRow(paymentSchemeRow2, "visible");
-  }
+installmentAmountInput.addEventListener("change", async (e) => {
+  const plan = await getInstallmentPlan({ price: priceInput.value, installment_amount: installmentAmountInput.value });
+  showInstallmentPlan(plan);
 });
@@ -9,6 +9,9 @@ import { IndexedDB, IndexedDBNotSupportedError } from './IndexedDB.js'
 //// CONSTANTS & HELPERS ////
 
 const URL = `/collections/data/`;
+const BATCH_URL = `/collections/create/batch/`;
+// Compact format of the synchronization data, see decodeColumnar()
+const COLUMNAR_TYPE = 'application/vnd.cobranzas.columnar+json';
 const COLLECTIONS_STORE_NAME = 'collections';
 // Database connection (IDBDatabase)
 let db;
@@ -63,7 +66,7 @@ const showPendingRequestsBadge = async () => {
   }
 }
 
-// Send pending POST requests to the server
+// Send pending collections to the server in a single request
 const sendPendingRequests = async () => {
   syncContainer.classList.add('in-progress');
 
@@ -75,96 +78,197 @@ const sendPendingRequests = async () => {
     // New csrf token
     const csrftoken = getCookie('csrftoken');
 
-    await storedRequests.map(async requestsByCustomer => {
-      // Stores failed requests to update indexedDB record
-      let failedRequests = [];
-      // Iterate over each request
+    // Every stored collection, in the same order as they are stored by customer
+    const collections = [];
+    for (const requestsByCustomer of storedRequests) {
       for (const request of requestsByCustomer.data) {
-        // Convert blob request to text
-        const reqText = await new Response(request.request).text();
-        // Convert text to Params
-        const params = new URLSearchParams(reqText);
-        // Update old csrf token with new csrf token
-        params.set('csrfmiddlewaretoken', csrftoken);
-
-        const response = await fetch('/collections/create/', {
-          method: 'POST',
-          // Convert params to text again
-          body: params.toString(),
-          // Send form content type and csrf token headers
-          headers: {
-            'Content-Type': 'application/x-www-form-urlencoded',
-            'X-CSRFToken': csrftoken,
-          },
-          mode: 'same-origin',
+        collections.push({
+          customer: requestsByCustomer.customer,
+          key: request.key,
+          installments: Object.values(request.installments).map(item => ({
+            sale_id: item.sale,
+            installment: item.installment,
+            amount: item.amount
+          }))
         });
-
-        if (!response || response.status !== 200) {
-          console.error('Request error!', request);
-          failedRequests.push(request);
-        }
       }
+    }
 
-      // If there are failed requests update indexedDB record
-      // If requests were successful then delete indexedDB record
-      if (failedRequests.length > 0) {
-        let collectionData = {
-          customer: requestsByCustomer.customer,
-          data: failedRequests
+    const response = await fetch(BATCH_URL, {
+      method: 'POST',
+      body: JSON.stringify({ collections: collections }),
+      headers: {
+        'Content-Type': 'application/json',
+        'X-CSRFToken': csrftoken,
+      },
+      mode: 'same-origin',
+    }).catch(err => {
+      console.error('Request error!', err);
+    });
+
+    if (response && response.ok) {
+      // Results are returned in the same order as the collections were sent
+      const { results } = await response.json();
+      let index = 0;
+      for (const requestsByCustomer of storedRequests) {
+        // Stores failed requests to update indexedDB record
+        const failedRequests = requestsByCustomer.data.filter(request => {
+          const result = results[index++];
+          if (result.status !== 'ok') {
+            console.error('Request error!', result.status, request);
+            return true;
+          }
+          return false;
+        });
+
+        // If there are failed requests update indexedDB record
+        // If requests were successful then delete indexedDB record
+        if (failedRequests.length > 0) {
+          let collectionData = {
+            customer: requestsByCustomer.customer,
+            data: failedRequests
+          }
+          await db.replace(requestsByCustomer.customer, collectionData, COLLECTIONS_STORE_NAME);
+        } else {
+          await db.remove(requestsByCustomer.customer, COLLECTIONS_STORE_NAME);
         }
-        db.replace(requestsByCustomer.customer, collectionData, COLLECTIONS_STORE_NAME);
-      } else {
-        db.remove(requestsByCustomer.customer, COLLECTIONS_STORE_NAME);
       }
-    });
+    }
   }
 
   syncContainer.classList.remove('in-progress');
 }
 
+// Store the sales of each customer in the local database
+const storeSales = async (sales, replace = false) => {
+  for (const s of sales) {
+    const data = {
+      'customer': s.pk,
+      'sales': s.sale_set
+    }
+    if (replace) {
+      await db.replace(s.pk, data, 'sales');
+    } else {
+      db.add(data, 'sales');
+    }
+  }
+}
+
+// Decode the columnar format of the synchronization data (an array of values for each field,
+// and installments status as an index of statuses) to the nested format stored in indexedDB
+const decodeColumnar = data => {
+  // Convert an object of arrays to an array of objects
+  const rows = columns => {
+    const fields = Object.keys(columns);
+    const length = fields.length > 0 ? columns[fields[0]].length : 0;
+    return Array.from({ length: length }, (_, i) => Object.fromEntries(fields.map(field => [field, columns[field][i]])));
+  };
+
+  const installmentsBySale = {};
+  for (const { sale, ...installment } of rows(data.installments)) {
+    installment.status = data.statuses[installment.status];
+    (installmentsBySale[sale] ??= []).push(installment);
+  }
+
+  const salesByCustomer = {};
+  for (const { customer, ...sale } of rows(data.sales)) {
+    sale.saleinstallment_set = installmentsBySale[sale.pk] || [];
+    (salesByCustomer[customer] ??= []).push(sale);
+  }
+
+  return {
+    sales: data.sales_customers.map(pk => ({ pk: pk, sale_set: salesByCustomer[pk] || [] })),
+    customers: rows(data.customers),
+    last_update: data.last_update,
+    cursor: data.cursor,
+    deleted: data.deleted
+  };
+}
+
+// Apply the changes returned by a delta sync (?since=cursor) to the local database
+const applyDelta = async result => {
+  // Upsert changed customers and their sales
+  await storeSales(result.sales, true);
+  for (const customer of result.customers) {
+    await db.replace(customer.pk, customer, 'customers');
+  }
+  // Remove records which left the user's scope
+  for (const pk of result.deleted.sales) {
+    await db.remove(pk, 'sales');
+  }
+  for (const pk of result.deleted.customers) {
+    await db.remove(pk, 'customers');
+  }
+}
+
 // Fetch server for updated data and update local database
 const synchronizeLocalDatabase = async () => {
   syncContainer.classList.add('in-progress');
 
-  const response = await fetch(URL, {
+  // If there is a cursor from a previous sync, ask only for the changes made since then
+  const cursor = localStorage.getItem('app-sync-cursor');
+  const url = cursor ? `${URL}?since=${encodeURIComponent(cursor)}` : URL;
+
+  // The browser sends the ETag of its cached copy (If-None-Match) and the server answers
+  // with a 304 if the data hasn't changed since then
+  const response = await fetch(url, {
     method: 'GET',
     headers: {
       'Content-Type': 'application/json',
+      'Accept': `${COLUMNAR_TYPE}, application/json;q=0.9`,
     },
+    cache: 'no-cache',
   });
 
   if (response.ok) {
-    // Parse json response
-    const result = await response.json();
+    // Parse json response, the server can answer with the columnar format or the nested one
+    let result = await response.json();
+    if ((response.headers.get('Content-Type') || '').startsWith(COLUMNAR_TYPE)) {
+      result = decodeColumnar(result);
+    }
 
     if (result) {
-      // I get the value of app-last-update to check if have been changes since the last update
-      const lastUpdate = await localStorage.getItem('app-last-update');
-      if (!lastUpdate || result.last_update != lastUpdate) {
-        // If app-last-update value doesn't exists or has changed
-        localStorage.setItem('app-last-update', result.last_update);
-        // Check if there are pending request
-        const checkStoredRequests = await db.getAllKeys(COLLECTIONS_STORE_NAME);
+      // Check if there are pending request
+      const checkStoredRequests = await db.getAllKeys(COLLECTIONS_STORE_NAME);
+
+      if (result.deleted) {
+        // Delta sync: changes are applied over the current database
         if (checkStoredRequests.length > 0) {
           // If there are pending requests, then show a notification to the user
           console.log('Hay requests pendientes');
-        } else {
-          // If there are no pending requests, then update the database
-          // Empty database
-          db.emptyStore('sales');
-          db.emptyStore('installments');
-          db.emptyStore('customers');
-          // Insert sales
-          for (var s of result.sales) {
-            const data = {
-              'customer': s.pk,
-              'sales': s.sale_set
-            }
-            db.add(data, 'sales');
+        } else if (result.sales.length || result.customers.length || result.deleted.sales.length || result.deleted.customers.length) {
+          await applyDelta(result);
+          localStorage.setItem('app-sync-cursor', result.cursor);
+          localStorage.setItem('app-last-update', result.last_update);
+        }
+        // If nothing changed the cursor is kept, so the next sync asks for the same URL
+        // and it can be answered with a 304 if the data is still the same
+      } else {
+        // I get the value of app-last-update to check if have been changes since the last update
+        const lastUpdate = await localStorage.getItem('app-last-update');
+        if (!lastUpdate || result.last_update != lastUpdate) {
+          // If app-last-update value doesn't exists or has changed
+          localStorage.setItem('app-last-update', result.last_update);
+          if (checkStoredRequests.length > 0) {
+            // If there are pending requests, then show a notification to the user
+            console.log('Hay requests pendientes');
+          } else {
+            // If there are no pending requests, then update the database
+            // Empty database
+            await db.emptyStore('sales');
+            await db.emptyStore('installments');
+            await db.emptyStore('customers');
+            // Insert sales
+            await storeSales(result.sales);
+            // Insert customers
+            const customers = Object.values(result.customers);
+            db.addMany(customers, 'customers');
+            // Next syncs only download the changes made after this one
+            localStorage.setItem('app-sync-cursor', result.cursor);
           }
-          // Insert customers
-          const customers = Object.values(result.customers);
-          db.addMany(customers, 'customers');
+        } else {
+          // Local database is up to date, next syncs can start from this cursor
+          localStorage.setItem('app-sync-cursor', result.cursor);
         }
       }
 